@@ -0,0 +1,5 @@
+"""
+Benchmarks for the MPesa B2C application's hot paths.
+Those touching the database are meant to be run against a throwaway site, e.g.
+bench --site test_site execute navari_mpesa_b2c.benchmarks.access_token_lookup.run
+"""
@@ -0,0 +1,123 @@
+"""
+Times the Daraja Access Tokens lookup as the table grows to a million historical rows.
+
+bench --site test_site execute navari_mpesa_b2c.benchmarks.access_token_lookup.run
+
+All inserted rows are rolled back once the benchmark completes.
+"""
+
+import datetime
+import timeit
+
+import frappe
+
+from navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.mpesa_b2c_payment import (
+    get_latest_access_token_record,
+)
+
+CHECKPOINTS = (1_000, 10_000, 100_000, 1_000_000)
+INSERT_CHUNK_SIZE = 10_000
+REPEAT = 200
+
+LEGACY_QUERY = """
+    SELECT name, access_token
+    FROM `tabDaraja Access Tokens`
+    WHERE expiry_time > %s
+    ORDER BY creation DESC
+    LIMIT 1
+"""
+
+
+def run(checkpoints: tuple[int, ...] = CHECKPOINTS, repeat: int = REPEAT) -> None:
+    """Prints the mean lookup time, in milliseconds, at each table size checkpoint"""
+    now = datetime.datetime.now()
+    first_name = (
+        frappe.db.sql("SELECT IFNULL(MAX(name), 0) FROM `tabDaraja Access Tokens`")[0][0]
+        + 1
+    )
+    fields = [
+        "name",
+        "access_token",
+        "token_fetch_time",
+        "expiry_time",
+        "creation",
+        "modified",
+        "owner",
+        "modified_by",
+    ]
+
+    try:
+        # The one valid token
+        frappe.db.bulk_insert(
+            "Daraja Access Tokens",
+            fields,
+            [
+                (
+                    first_name,
+                    "*****",
+                    now,
+                    now + datetime.timedelta(hours=1),
+                    now,
+                    now,
+                    "Administrator",
+                    "Administrator",
+                )
+            ],
+        )
+
+        inserted = 0
+        print(f"{'rows':>10} {'indexed lookup (ms)':>20} {'legacy query (ms)':>18}")
+
+        for checkpoint in checkpoints:
+            while inserted < checkpoint:
+                chunk = min(INSERT_CHUNK_SIZE, checkpoint - inserted)
+                frappe.db.bulk_insert(
+                    "Daraja Access Tokens",
+                    fields,
+                    [
+                        _historical_token(first_name, inserted + offset + 1, now)
+                        for offset in range(chunk)
+                    ],
+                    chunk_size=INSERT_CHUNK_SIZE,
+                )
+                inserted += chunk
+
+            indexed = timeit.timeit(get_latest_access_token_record, number=repeat)
+            legacy = timeit.timeit(
+                lambda: frappe.db.sql(LEGACY_QUERY, (now,)), number=repeat
+            )
+            print(
+                f"{inserted:>10} {indexed / repeat * 1000:>20.3f} {legacy / repeat * 1000:>18.3f}"
+            )
+
+        print(
+            frappe.db.sql(
+                """
+                    EXPLAIN SELECT name, expiry_time
+                    FROM `tabDaraja Access Tokens`
+                    WHERE expiry_time > %s
+                    ORDER BY expiry_time DESC
+                    LIMIT 1
+                """,
+                (now,),
+                as_dict=True,
+            )
+        )
+
+    finally:
+        frappe.db.rollback()
+
+
+def _historical_token(first_name: int, age: int, now: datetime.datetime) -> tuple:
+    """An expired token fetched two hours and age seconds before now"""
+    fetch_time = now - datetime.timedelta(hours=2, seconds=age)
+    return (
+        first_name + age,
+        "*****",
+        fetch_time,
+        fetch_time + datetime.timedelta(hours=1),
+        fetch_time,
+        fetch_time,
+        "Administrator",
+        "Administrator",
+    )
@@ -0,0 +1,106 @@
+"""
+Compares parsing successful Results' ResultParameters with the previous if/elif parser,
+the table driven parser, and the table driven parser's batch (column) mode.
+
+bench --site test_site execute navari_mpesa_b2c.benchmarks.result_parameters.run
+"""
+
+import datetime
+import random
+import timeit
+
+from navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.result_parameters import (
+    parse_result_parameters,
+    parse_results_batch,
+)
+
+PAYLOADS = 10_000
+
+
+def run(payloads: int = PAYLOADS) -> None:
+    """Prints the time, in milliseconds, taken by each parser over the generated Results"""
+    results = [generate_result(index) for index in range(payloads)]
+
+    timings = {
+        "if/elif, strptime + strftime": lambda: [
+            legacy_extract_transaction_values(
+                result["ResultParameters"]["ResultParameter"], result["TransactionID"]
+            )
+            for result in results
+        ],
+        "table driven, sliced datetime": lambda: [
+            parse_result_parameters(
+                result["ResultParameters"]["ResultParameter"], result["TransactionID"]
+            )
+            for result in results
+        ],
+        "table driven, batch columns": lambda: parse_results_batch(results),
+    }
+
+    for label, function in timings.items():
+        elapsed = min(timeit.repeat(function, number=1, repeat=5))
+        print(f"{label:<35} {elapsed * 1_000:>10.1f} ms for {payloads} Results")
+
+
+def generate_result(index: int) -> dict:
+    """Returns a successful Result shaped like Safaricom's"""
+    transaction_id = f"RK{index:09d}"
+    completed = datetime.datetime(2023, 11, 7) + datetime.timedelta(
+        seconds=random.randint(0, 180 * 24 * 60 * 60)
+    )
+
+    return {
+        "TransactionID": transaction_id,
+        "ResultParameters": {
+            "ResultParameter": [
+                {"Key": "TransactionAmount", "Value": random.randint(10, 150_000)},
+                {"Key": "TransactionReceipt", "Value": transaction_id},
+                {"Key": "B2CRecipientIsRegisteredCustomer", "Value": "Y"},
+                {"Key": "B2CChargesPaidAccountAvailableFunds", "Value": -4510.00},
+                {"Key": "ReceiverPartyPublicName", "Value": "254708374149 - John Doe"},
+                {
+                    "Key": "TransactionCompletedDateTime",
+                    "Value": completed.strftime("%d.%m.%Y %H:%M:%S"),
+                },
+                {"Key": "B2CUtilityAccountAvailableFunds", "Value": 10116.00},
+                {"Key": "B2CWorkingAccountAvailableFunds", "Value": 900000.00},
+            ]
+        },
+    }
+
+
+def legacy_extract_transaction_values(
+    result_parameters: dict, transaction_id: str
+) -> dict[str, str | int]:
+    """The if/elif parser previously used by extract_transaction_values"""
+    transaction_values = {}
+
+    for item in result_parameters:
+        if item["Key"] == "TransactionAmount":
+            transaction_values["transaction_amount"] = item["Value"]
+
+        elif item["Key"] == "TransactionReceipt" and item["Value"] == transaction_id:
+            transaction_values["transaction_id"] = item["Value"]
+
+        elif item["Key"] == "B2CRecipientIsRegisteredCustomer":
+            transaction_values["recipient_is_registered_customer"] = item["Value"]
+
+        elif item["Key"] == "B2CChargesPaidAccountAvailableFunds":
+            transaction_values["charges_paid_acct_avlbl_funds"] = item["Value"]
+
+        elif item["Key"] == "ReceiverPartyPublicName":
+            transaction_values["receiver_public_name"] = item["Value"]
+
+        elif item["Key"] == "TransactionCompletedDateTime":
+            transaction_datetime = datetime.datetime.strptime(
+                item["Value"], "%d.%m.%Y %H:%M:%S"
+            ).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            transaction_values["transaction_completed_datetime"] = transaction_datetime
+
+        elif item["Key"] == "B2CUtilityAccountAvailableFunds":
+            transaction_values["utility_acct_avlbl_funds"] = item["Value"]
+
+        elif item["Key"] == "B2CWorkingAccountAvailableFunds":
+            transaction_values["working_acct_avlbl_funds"] = item["Value"]
+
+    return transaction_values
@@ -0,0 +1,64 @@
+"""
+Compares the cost of generating a SecurityCredential with the previous AES based
+openssl_encrypt_encode path and the RSA engine, with and without the parsed key cached.
+
+bench --site test_site execute navari_mpesa_b2c.benchmarks.security_credential.run
+"""
+
+import datetime
+import tempfile
+import timeit
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.encoding_credentials import (
+    load_public_key,
+    openssl_encrypt_encode,
+    rsa_encrypt_encode,
+)
+
+PASSWORD = b"Safaricom999!*!"
+REPEAT = 1_000
+
+
+def run(repeat: int = REPEAT) -> None:
+    """Prints the mean time, in microseconds, taken by each credential path"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "apisandbox.test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+        .public_bytes(serialization.Encoding.PEM)
+    )
+
+    with tempfile.NamedTemporaryFile(suffix=".cer") as certificate_file:
+        certificate_file.write(certificate)
+        certificate_file.flush()
+
+        public_key = load_public_key(certificate)
+        cached_credentials = {"credential": rsa_encrypt_encode(PASSWORD, public_key)}
+
+        timings = {
+            "openssl_encrypt_encode (file read + AES)": lambda: openssl_encrypt_encode(
+                PASSWORD, certificate_file.name
+            ),
+            "RSA, certificate parsed per call": lambda: rsa_encrypt_encode(
+                PASSWORD, load_public_key(certificate)
+            ),
+            "RSA, cached public key": lambda: rsa_encrypt_encode(PASSWORD, public_key),
+            "cached credential": lambda: cached_credentials["credential"],
+        }
+
+        for label, function in timings.items():
+            elapsed = timeit.timeit(function, number=repeat)
+            print(f"{label:<45} {elapsed / repeat * 1_000_000:>10.1f} us")
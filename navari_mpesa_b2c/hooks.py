@@ -68,7 +68,7 @@ required_apps = ["frappe/erpnext/hrms"]
 # ------------
 
 # before_install = "navari_mpesa_b2c.install.before_install"
-# after_install = "navari_mpesa_b2c.install.after_install"
+after_install = "navari_mpesa_b2c.install.after_install"
 
 # Uninstallation
 # ------------
@@ -122,34 +122,33 @@ required_apps = ["frappe/erpnext/hrms"]
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-#	"*": {
-#		"on_update": "method",
-#		"on_cancel": "method",
-#		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"MPesa B2C Settings": {
+		"on_update": "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.security_credentials.invalidate_security_credentials"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-#	"all": [
-#		"navari_mpesa_b2c.tasks.all"
-#	],
-#	"daily": [
-#		"navari_mpesa_b2c.tasks.daily"
-#	],
-#	"hourly": [
-#		"navari_mpesa_b2c.tasks.hourly"
-#	],
-#	"weekly": [
-#		"navari_mpesa_b2c.tasks.weekly"
-#	],
-#	"monthly": [
-#		"navari_mpesa_b2c.tasks.monthly"
-#	],
-# }
+scheduler_events = {
+	"all": [
+		"navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.callbacks.process_queued_callbacks"
+	],
+	"cron": {
+		"* * * * *": [
+			"navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.mpesa_b2c_payment.refresh_access_token_before_expiry",
+			"navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.retries.retry_timed_out_payments",
+		],
+		"*/5 * * * *": [
+			"navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions.post_pending_journal_entries",
+			"navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.status_poller.poll_pending_payments",
+		],
+	},
+	"hourly": [
+		"navari_mpesa_b2c.mpesa_b2c.doctype.daraja_access_tokens.daraja_access_tokens.delete_old_access_tokens"
+	],
+}
 
 # Testing
 # -------
@@ -0,0 +1,8 @@
+from navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.payment_items import (
+    add_selection_indexes,
+)
+
+
+def after_install() -> None:
+    """Patches are not run on install, so add the indexes they would have"""
+    add_selection_indexes()
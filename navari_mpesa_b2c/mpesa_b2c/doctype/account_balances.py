@@ -0,0 +1,188 @@
+"""Redis backed history of the M-Pesa account balances reported by payment Results"""
+
+import datetime
+from typing import Final
+
+import frappe
+from frappe.utils import get_datetime
+
+from .mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+
+BALANCES_KEY: Final[str] = "navari_mpesa_b2c:account_balances"
+BALANCE_HISTORY_RETENTION: Final[int] = 90 * 24 * 60 * 60
+MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE: Final[str] = "MPesa B2C Payments Transactions"
+
+# Balance -> MPesa B2C Payments Transactions field it is reported in
+BALANCE_FIELDS: Final[dict[str, str]] = {
+    "working": "working_acct_avlbl_funds",
+    "utility": "utility_acct_avlbl_funds",
+    "charges_paid": "charges_paid_acct_avlbl_funds",
+}
+
+# Replaces the latest balances only with newer ones, since Results arrive out of order,
+# then appends the balances to the history and drops those past the retention period.
+# Identical members collapse, so replaying a Result records its balances once.
+RECORD_BALANCES_SCRIPT: Final[str] = """
+local timestamp = tonumber(ARGV[1])
+local latest = tonumber(redis.call('HGET', KEYS[1], 'timestamp'))
+
+if not latest or timestamp >= latest then
+    redis.call(
+        'HSET', KEYS[1], 'timestamp', ARGV[1],
+        'working', ARGV[2], 'utility', ARGV[3], 'charges_paid', ARGV[4]
+    )
+end
+
+redis.call(
+    'ZADD', KEYS[2], timestamp,
+    ARGV[1] .. ':' .. ARGV[2] .. ':' .. ARGV[3] .. ':' .. ARGV[4]
+)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', timestamp - tonumber(ARGV[5]))
+
+return 1
+"""
+
+_record_balances_script = None
+
+
+def record_balances(
+    transaction_values: list[dict], shortcode: str | None = None
+) -> None:
+    """
+    Records the balances reported by successful Results, given as their parsed
+    transaction values, against the shortcode (by default the organisation's).
+    Each Result costs one script call, in a single round trip for all of them.
+    """
+    global _record_balances_script
+
+    if _record_balances_script is None:
+        _record_balances_script = frappe.cache().register_script(
+            RECORD_BALANCES_SCRIPT
+        )
+
+    keys = get_balance_keys(shortcode)
+    pipeline = frappe.cache().pipeline()
+
+    for values in transaction_values:
+        balances = [values.get(field) for field in BALANCE_FIELDS.values()]
+        if all(balance is None for balance in balances):
+            continue
+
+        timestamp = get_datetime(
+            values.get("transaction_completed_datetime") or datetime.datetime.now()
+        ).timestamp()
+
+        _record_balances_script(
+            keys=keys,
+            args=[
+                timestamp,
+                *(balance if balance is not None else "" for balance in balances),
+                BALANCE_HISTORY_RETENTION,
+            ],
+            client=pipeline,
+        )
+
+    pipeline.execute()
+
+
+def get_balance_keys(shortcode: str | None = None) -> list[str]:
+    """Returns the keys of the shortcode's latest balances and balance history"""
+    shortcode = shortcode or get_b2c_settings_snapshot().organisation_shortcode
+
+    return [
+        frappe.cache().make_key(f"{BALANCES_KEY}:latest:{shortcode}"),
+        frappe.cache().make_key(f"{BALANCES_KEY}:history:{shortcode}"),
+    ]
+
+
+@frappe.whitelist()
+def get_latest_balance(shortcode: str | None = None) -> dict | None:
+    """Returns the shortcode's latest reported balances"""
+    frappe.only_for(("System Manager", "Accounts Manager"))
+
+    return read_latest_balance(shortcode)
+
+
+def read_latest_balance(shortcode: str | None = None) -> dict | None:
+    """
+    Returns the shortcode's latest reported balances, e.g.
+    {"timestamp": 1699346750.0, "working": 900000.0, "utility": 10116.0,
+    "charges_paid": -4510.0}.
+    If none were recorded yet, they are read from the latest transaction.
+    """
+    latest_key, _ = get_balance_keys(shortcode)
+    pipeline = frappe.cache().pipeline()
+    pipeline.hgetall(latest_key)
+    (latest,) = pipeline.execute()
+
+    if latest:
+        return {
+            field.decode(): float(value) if value else None
+            for field, value in latest.items()
+        }
+
+    if shortcode and shortcode != get_b2c_settings_snapshot().organisation_shortcode:
+        return None
+
+    transaction = frappe.get_all(
+        MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE,
+        fields=["transaction_completed_datetime", *BALANCE_FIELDS.values()],
+        order_by="creation desc",
+        limit=1,
+    )
+    if not transaction:
+        return None
+
+    record_balances(transaction, shortcode)
+
+    return {
+        "timestamp": get_datetime(
+            transaction[0].transaction_completed_datetime or datetime.datetime.now()
+        ).timestamp(),
+        **{
+            balance: transaction[0].get(field)
+            for balance, field in BALANCE_FIELDS.items()
+        },
+    }
+
+
+@frappe.whitelist()
+def get_balance_history(
+    from_datetime: str,
+    to_datetime: str | None = None,
+    interval: int = 3600,
+    shortcode: str | None = None,
+) -> list[dict]:
+    """
+    Returns the shortcode's balances between the two datetimes, downsampled to one
+    point per interval seconds: the last balances reported within the interval,
+    along with the lowest working account balance reported in it.
+    """
+    frappe.only_for(("System Manager", "Accounts Manager"))
+
+    interval = max(int(interval), 1)
+    _, history_key = get_balance_keys(shortcode)
+    end = get_datetime(to_datetime) if to_datetime else datetime.datetime.now()
+
+    points: dict[int, dict] = {}
+    for member in frappe.cache().zrangebyscore(
+        history_key, get_datetime(from_datetime).timestamp(), end.timestamp()
+    ):
+        timestamp, *balances = member.decode().split(":")
+        bucket = int(float(timestamp) // interval * interval)
+        values = dict(
+            zip(
+                BALANCE_FIELDS,
+                (float(balance) if balance else None for balance in balances),
+            )
+        )
+
+        point = points.setdefault(bucket, {"timestamp": bucket, "min_working": None})
+        point.update(values)
+
+        if values["working"] is not None and (
+            point["min_working"] is None or values["working"] < point["min_working"]
+        ):
+            point["min_working"] = values["working"]
+
+    return list(points.values())
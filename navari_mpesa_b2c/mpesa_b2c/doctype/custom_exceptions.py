@@ -38,3 +38,23 @@ class InformationMismatchError(Exception):
     Raised when there's a mismatch in any of the B2C Payment's records
     and the corresponding B2C Payments Transaction's records
     """
+
+
+class InvalidBulkPaymentError(Exception):
+    """Raised when a bulk payment is initiated from an unsubmitted record or one without items"""
+
+
+class RateLimitExceededError(Exception):
+    """Raised when a request to Daraja cannot be sent within the configured rate limit in time"""
+
+
+class InsufficientFundsError(Exception):
+    """Raised when a bulk payment's total exceeds the funds available in the M-Pesa account"""
+
+
+class UnsupportedReferenceDoctypeError(Exception):
+    """Raised when fetching items to pay from a doctype payments cannot be made against"""
+
+
+class AccessTokenUnavailableError(Exception):
+    """Raised when no usable Daraja access token is cached or stored"""
@@ -1,10 +1,20 @@
 # Copyright (c) 2023, Navari Limited and contributors
 # For license information, please see license.txt
 
+import datetime
+from typing import Final
+
+import frappe
 from frappe.model.document import Document
 
 from ..custom_exceptions import InvalidTokenExpiryTimeError
 from .. import app_logger
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+
+DARAJA_ACCESS_TOKENS_DOCTYPE: Final[str] = "Daraja Access Tokens"
+DEFAULT_RETENTION_COUNT: Final[int] = 10
+DEFAULT_RETENTION_HOURS: Final[int] = 24
+DELETION_CHUNK_SIZE: Final[int] = 10_000
 
 
 class DarajaAccessTokens(Document):
@@ -18,3 +28,72 @@ class DarajaAccessTokens(Document):
             )
             app_logger.error(self.error)
             raise InvalidTokenExpiryTimeError(self.error)
+
+
+def delete_old_access_tokens() -> None:
+    """
+    Scheduled job that deletes expired access tokens, together with their encrypted values,
+    keeping the latest Access Tokens To Keep records and every record fetched within
+    the Access Token Retention (Hours) set in the MPesa B2C Settings
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+    retention_count = (
+        b2c_settings.access_token_retention_count or DEFAULT_RETENTION_COUNT
+    )
+    retention_hours = (
+        b2c_settings.access_token_retention_hours or DEFAULT_RETENTION_HOURS
+    )
+
+    # Names are auto-incremented, so the n-th highest name marks the n-th latest token
+    oldest_kept_token = frappe.db.sql(
+        """
+            SELECT name
+            FROM `tabDaraja Access Tokens`
+            ORDER BY name DESC
+            LIMIT 1 OFFSET %s
+        """,
+        (retention_count - 1,),
+    )
+    if not oldest_kept_token:
+        return
+
+    current_time = datetime.datetime.now()
+    filters = {
+        "oldest_kept_token": oldest_kept_token[0][0],
+        "retention_cutoff": current_time - datetime.timedelta(hours=retention_hours),
+        "current_time": current_time,
+        "chunk_size": DELETION_CHUNK_SIZE,
+    }
+    deleted = 0
+
+    while True:
+        tokens_to_delete = frappe.db.sql_list(
+            """
+                SELECT name
+                FROM `tabDaraja Access Tokens`
+                WHERE name < %(oldest_kept_token)s
+                    AND creation < %(retention_cutoff)s
+                    AND expiry_time <= %(current_time)s
+                ORDER BY name
+                LIMIT %(chunk_size)s
+            """,
+            filters,
+        )
+        if not tokens_to_delete:
+            break
+
+        frappe.db.delete(
+            DARAJA_ACCESS_TOKENS_DOCTYPE, {"name": ("in", tokens_to_delete)}
+        )
+        frappe.db.delete(
+            "__Auth",
+            {
+                "doctype": DARAJA_ACCESS_TOKENS_DOCTYPE,
+                "name": ("in", [str(token) for token in tokens_to_delete]),
+            },
+        )
+        # Commit each chunk to keep row locks short-lived
+        frappe.db.commit()  # nosemgrep
+        deleted += len(tokens_to_delete)
+
+    app_logger.info("Deleted %s old Daraja Access Tokens records", deleted)
@@ -10,13 +10,18 @@ import requests
 from frappe.tests.utils import FrappeTestCase
 from frappe.utils.password import get_decrypted_password
 
-from ..custom_exceptions import InvalidTokenExpiryTimeError
+from ..custom_exceptions import (
+    AccessTokenUnavailableError,
+    InvalidTokenExpiryTimeError,
+)
+from ..daraja_access_tokens import daraja_access_tokens
 from ..mpesa_b2c_payment import mpesa_b2c_payment
 from ..mpesa_b2c_payment.mpesa_b2c_payment import (
     get_access_tokens,
-    get_hashed_token,
+    get_latest_access_token_record,
     save_access_token_to_database,
 )
+from ..mpesa_b2c_payment.token_provider import AccessToken, AccessTokenProvider
 
 TOKEN_ACCESS_TIME = datetime.datetime.now()
 
@@ -103,18 +108,18 @@ class TestDarajaAccessTokens(FrappeTestCase):
                 }
             ).insert()
 
-    def test_get_hashed_token(self) -> None:
-        """Tests the get_hashed_token() function from the b2c_payment module"""
-        hashed_token = get_hashed_token()
+    def test_get_latest_access_token_record(self) -> None:
+        """Tests the un-expired access token record is found, not the expired one"""
+        latest_token = get_latest_access_token_record()
         token = frappe.db.get_value(
             "Daraja Access Tokens",
             {"token_fetch_time": TOKEN_ACCESS_TIME},
             ["name"],
         )
 
-        self.assertEqual(hashed_token, token)
+        self.assertEqual(latest_token.name, token)
 
-    @patch.object(mpesa_b2c_payment.requests, "get")
+    @patch.object(mpesa_b2c_payment, "daraja_request")
     def test_get_access_tokens(self, mock_response: MagicMock) -> None:
         """Tests the get_access_tokens() function from the b2c_payment module"""
         mock_response.return_value.status_code = 200
@@ -131,7 +136,9 @@ class TestDarajaAccessTokens(FrappeTestCase):
         self.assertEqual(token["expires_in"], "3599")
         self.assertEqual(status_code, 200)
 
-    @patch.object(mpesa_b2c_payment.requests, "get", side_effect=requests.HTTPError)
+    @patch.object(
+        mpesa_b2c_payment, "daraja_request", side_effect=requests.HTTPError
+    )
     def test_get_access_tokens_error_response(self, mock_request: MagicMock) -> None:
         """
         Tests instances the get_access_tokens() function from the b2c_payment receives an error response
@@ -146,8 +153,8 @@ class TestDarajaAccessTokens(FrappeTestCase):
         self.assertIsNone(response)
 
     @patch.object(
-        mpesa_b2c_payment.requests,
-        "get",
+        mpesa_b2c_payment,
+        "daraja_request",
         side_effect=requests.exceptions.ConnectionError,
     )
     def test_get_access_tokens_connection_error(self, mock_request: MagicMock) -> None:
@@ -188,3 +195,131 @@ class TestDarajaAccessTokens(FrappeTestCase):
 
         self.assertEqual(saved_token, "987abc321xyz")
         self.assertEqual(token, "987abc321xyz")
+
+    def test_access_token_provider_reuses_cached_token(self) -> None:
+        """Tests the token provider serves the refreshed token while it is valid"""
+        fetch_token = MagicMock(
+            return_value=AccessToken(
+                "abcdef123", datetime.datetime.now() + datetime.timedelta(hours=1)
+            )
+        )
+        provider = AccessTokenProvider(lambda: None, fetch_token)
+        provider.invalidate()
+        provider.refresh()
+
+        self.assertEqual(provider.get_token(), "abcdef123")
+        self.assertEqual(provider.get_token(), "abcdef123")
+        fetch_token.assert_called_once()
+
+        # A second worker's provider is served from the shared cache
+        other_fetch_token = MagicMock()
+        other_provider = AccessTokenProvider(lambda: None, other_fetch_token)
+
+        self.assertEqual(other_provider.get_token(), "abcdef123")
+        other_fetch_token.assert_not_called()
+
+        provider.invalidate()
+
+    def test_access_token_provider_skips_expiring_token(self) -> None:
+        """Tests expiring tokens are not served, and a refresh is requested instead"""
+        load_token = MagicMock(
+            return_value=AccessToken(
+                "expiring", datetime.datetime.now() + datetime.timedelta(seconds=30)
+            )
+        )
+        fetch_token = MagicMock()
+        request_refresh = MagicMock()
+        provider = AccessTokenProvider(load_token, fetch_token, request_refresh)
+        provider.invalidate()
+
+        with self.assertRaises(AccessTokenUnavailableError):
+            provider.get_token()
+
+        load_token.assert_called_once()
+        request_refresh.assert_called_once()
+        # The request itself never fetches a token
+        fetch_token.assert_not_called()
+
+        provider.invalidate()
+
+    def test_refresh_access_token_before_expiry(self) -> None:
+        """Tests the scheduled refresher only renews tokens close to expiry"""
+        with patch.object(
+            mpesa_b2c_payment.access_token_provider, "refresh"
+        ) as mock_refresh, patch.object(
+            mpesa_b2c_payment, "get_b2c_settings_snapshot"
+        ) as mock_settings:
+            mock_settings.return_value.consumer_key = "1234567890"
+            mock_settings.return_value.token_refresh_margin = 300
+
+            mpesa_b2c_payment.refresh_access_token_before_expiry()
+            mock_refresh.assert_not_called()
+
+            with patch.object(
+                mpesa_b2c_payment, "get_latest_access_token_record", return_value=None
+            ):
+                mock_refresh.return_value = AccessToken(
+                    "renewed", datetime.datetime.now() + datetime.timedelta(hours=1)
+                )
+                mpesa_b2c_payment.refresh_access_token_before_expiry()
+                mock_refresh.assert_called_once_with(force=True)
+
+    def test_refresh_margin_not_below_provider_margin(self) -> None:
+        """Tests tokens the provider stops serving are refreshed, whatever the margin"""
+        with patch.object(
+            mpesa_b2c_payment.access_token_provider, "refresh"
+        ) as mock_refresh, patch.object(
+            mpesa_b2c_payment, "get_b2c_settings_snapshot"
+        ) as mock_settings, patch.object(
+            mpesa_b2c_payment,
+            "get_latest_access_token_record",
+            return_value=frappe._dict(
+                expiry_time=datetime.datetime.now() + datetime.timedelta(seconds=45)
+            ),
+        ):
+            mock_settings.return_value.consumer_key = "1234567890"
+            mock_settings.return_value.token_refresh_margin = 30
+            mock_refresh.return_value = AccessToken(
+                "renewed", datetime.datetime.now() + datetime.timedelta(hours=1)
+            )
+
+            mpesa_b2c_payment.refresh_access_token_before_expiry()
+            mock_refresh.assert_called_once_with(force=True)
+
+    def test_delete_old_access_tokens(self) -> None:
+        """Tests expired tokens outside the retention window are deleted"""
+        old_fetch_time = TOKEN_ACCESS_TIME - datetime.timedelta(days=2)
+        old_tokens = []
+
+        for _ in range(3):
+            old_token = frappe.get_doc(
+                {
+                    "doctype": "Daraja Access Tokens",
+                    "access_token": "old-token",
+                    "token_fetch_time": old_fetch_time,
+                    "expiry_time": old_fetch_time + datetime.timedelta(hours=1),
+                }
+            ).insert()
+            old_token.db_set("creation", old_fetch_time)
+            old_tokens.append(old_token.name)
+
+        latest_token = frappe.get_doc(
+            {
+                "doctype": "Daraja Access Tokens",
+                "access_token": "latest-token",
+                "token_fetch_time": TOKEN_ACCESS_TIME,
+                "expiry_time": TOKEN_ACCESS_TIME + datetime.timedelta(hours=1),
+            }
+        ).insert()
+
+        with patch.object(
+            daraja_access_tokens, "get_b2c_settings_snapshot"
+        ) as mock_settings:
+            mock_settings.return_value.access_token_retention_count = 1
+            mock_settings.return_value.access_token_retention_hours = 1
+            daraja_access_tokens.delete_old_access_tokens()
+
+        for old_token in old_tokens:
+            self.assertFalse(frappe.db.exists("Daraja Access Tokens", old_token))
+
+        self.assertTrue(frappe.db.exists("Daraja Access Tokens", latest_token.name))
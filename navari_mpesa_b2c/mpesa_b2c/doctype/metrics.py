@@ -0,0 +1,54 @@
+"""Lightweight, Redis backed counters and timings recorded by the MPesa B2C application"""
+
+from typing import Final
+
+import frappe
+
+METRICS_KEY: Final[str] = "navari_mpesa_b2c:metrics"
+
+
+def record_metric(name: str, value: float) -> None:
+    """
+    Records an observation, e.g. a latency in seconds, against the named metric.
+    The metric's count, running total and last observed value are kept.
+    """
+    key = frappe.cache().make_key(METRICS_KEY)
+
+    pipeline = frappe.cache().pipeline()
+    pipeline.hincrby(key, f"{name}:count", 1)
+    pipeline.hincrbyfloat(key, f"{name}:total", value)
+    pipeline.hset(key, f"{name}:last", value)
+    pipeline.execute()
+
+
+def increment_counter(name: str, amount: int = 1) -> None:
+    """Increments the named counter, e.g. a failure count, by the given amount"""
+    key = frappe.cache().make_key(METRICS_KEY)
+
+    pipeline = frappe.cache().pipeline()
+    pipeline.hincrby(key, f"{name}:count", amount)
+    pipeline.execute()
+
+
+@frappe.whitelist()
+def get_metrics() -> dict[str, dict[str, float]]:
+    """
+    Returns all recorded metrics grouped by name, e.g.
+    {"token_refresh_latency": {"count": 3, "total": 1.2, "last": 0.4, "mean": 0.4}}
+    """
+    frappe.only_for("System Manager")
+
+    pipeline = frappe.cache().pipeline()
+    pipeline.hgetall(frappe.cache().make_key(METRICS_KEY))
+    (recorded,) = pipeline.execute()
+
+    metrics: dict[str, dict[str, float]] = {}
+    for field, value in recorded.items():
+        name, statistic = field.decode().rsplit(":", 1)
+        metrics.setdefault(name, {})[statistic] = float(value)
+
+    for statistics in metrics.values():
+        if statistics.get("count") and "total" in statistics:
+            statistics["mean"] = statistics["total"] / statistics["count"]
+
+    return metrics
@@ -0,0 +1,76 @@
+# Copyright (c) 2026, Navari Limited and contributors
+# For license information, please see license.txt
+
+import json
+from typing import Final
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime
+
+MPESA_B2C_CALLBACK_DOCTYPE: Final[str] = "MPesa B2C Callback"
+CALLBACK_DEDUP_KEY: Final[str] = "navari_mpesa_b2c:callback_received"
+CALLBACK_DEDUP_TTL: Final[int] = 3 * 24 * 60 * 60
+
+
+class MPesaB2CCallback(Document):
+    """A callback payload received from Safaricom, queued for background processing"""
+
+
+def queue_callback(payload: dict, callback_type: str = "Result") -> str:
+    """
+    Persists the raw callback payload, a Result or a Queue Timeout,
+    with a single insert and returns the record's name.
+    Validation, hooks and permission checks are skipped since the payload is only
+    stored here and interpreted by the background consumer.
+    """
+    callback = frappe.new_doc(MPESA_B2C_CALLBACK_DOCTYPE)
+    callback.name = frappe.generate_hash(length=10)
+    callback.creation = callback.modified = now_datetime()
+    callback.owner = callback.modified_by = frappe.session.user
+    callback.status = "Queued"
+    callback.callback_type = callback_type
+    callback.payload = json.dumps(payload)
+    callback.db_insert()
+
+    return callback.name
+
+
+def claim_callback(payload: dict, callback_type: str = "Result") -> bool:
+    """
+    Atomically records that the callback identified by its type, ConversationID and
+    TransactionID was received. Returns False if it already had been, e.g. when
+    Safaricom retries a callback, including to another worker at the same time.
+    """
+    key = get_dedup_key(payload, callback_type)
+    if key is None:
+        return True
+
+    return bool(frappe.cache().set(key, 1, nx=True, ex=CALLBACK_DEDUP_TTL))
+
+
+def release_callback(payload: dict, callback_type: str = "Result") -> None:
+    """
+    Forgets the callback was received,
+    so a retry of a callback that failed to be persisted is accepted
+    """
+    key = get_dedup_key(payload, callback_type)
+    if key is not None:
+        frappe.cache().delete(key)
+
+
+def get_dedup_key(payload: dict, callback_type: str) -> str | None:
+    conversation_id = payload.get("ConversationID")
+    transaction_id = payload.get("TransactionID")
+
+    if not (conversation_id or transaction_id):
+        return None
+
+    return frappe.cache().make_key(
+        f"{CALLBACK_DEDUP_KEY}:{callback_type}:{conversation_id}:{transaction_id}"
+    )
+
+
+def on_doctype_update() -> None:
+    """Index the consumer's lookup of queued callbacks, oldest first"""
+    frappe.db.add_index(MPESA_B2C_CALLBACK_DOCTYPE, ["status", "creation"])
@@ -0,0 +1,295 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import json
+from unittest.mock import MagicMock, call, patch
+from uuid import uuid4
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..custom_exceptions import AccessTokenUnavailableError
+from ..mpesa_b2c_callback.mpesa_b2c_callback import (
+    MPESA_B2C_CALLBACK_DOCTYPE,
+    claim_callback,
+    queue_callback,
+    release_callback,
+)
+from ..mpesa_b2c_payment import (
+    bulk_dispatcher,
+    callbacks,
+    mpesa_b2c_payment,
+    payment_lookup,
+    retries,
+)
+from ..mpesa_b2c_payment.bulk_dispatcher import PaymentOutcome, RequestCredentials
+from ..mpesa_b2c_payment.mpesa_b2c_payment import update_payment_status
+from ..mpesa_b2c_payment.test_mpesa_b2c_payment import make_b2c_payment
+
+TEST_RESULT = {
+    "ResultType": 0,
+    "ResultCode": 2001,
+    "ResultDesc": "The initiator information is invalid.",
+    "OriginatorConversationID": "callback-test-originator-id",
+    "ConversationID": "AG_20231107_callback_test",
+    "TransactionID": "RK71111111",
+}
+
+
+class TestMPesaB2CCallback(FrappeTestCase):
+    """MPesa B2C Callback Tests"""
+
+    def setUp(self) -> None:
+        # Each test pays under its own IDs, as OriginatorConversationIDs are unique
+        self.result = {
+            **TEST_RESULT,
+            "OriginatorConversationID": str(uuid4()),
+            "ConversationID": f"AG_{frappe.generate_hash(length=12)}",
+        }
+
+    def tearDown(self) -> None:
+        frappe.db.delete(MPESA_B2C_CALLBACK_DOCTYPE)
+        frappe.db.delete("MPesa B2C Payment", {"remarks": "callback test remarks"})
+        release_callback(self.result)
+
+    def test_queue_callback(self) -> None:
+        """Tests the raw payload is persisted as a queued callback"""
+        name = queue_callback(self.result)
+
+        callback = frappe.get_doc(MPESA_B2C_CALLBACK_DOCTYPE, name)
+        self.assertEqual(callback.status, "Queued")
+        self.assertEqual(json.loads(callback.payload), self.result)
+
+    def test_process_queued_callbacks(self) -> None:
+        """Tests queued callbacks are applied in a batch, and failures are recorded"""
+        payment = frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Payment",
+                "commandid": "BusinessPayment",
+                "remarks": "callback test remarks",
+                "originatorconversationid": self.result["OriginatorConversationID"],
+                "status": "Pending",
+                "partyb": "254708993268",
+                "amount": 10,
+                "occassion": "Testing",
+                "party_type": "Supplier",
+            }
+        ).insert()
+
+        processed = queue_callback(self.result)
+        failed = queue_callback(
+            {**self.result, "OriginatorConversationID": "unknown-originator-id"}
+        )
+
+        with patch.object(callbacks.frappe.db, "commit"), patch.object(
+            callbacks.time, "sleep"
+        ):
+            callbacks.process_queued_callbacks()
+
+        payment.reload()
+        self.assertEqual(payment.status, "Errored")
+        self.assertEqual(payment.error_code, str(self.result["ResultCode"]))
+        self.assertEqual(
+            frappe.db.get_value(MPESA_B2C_CALLBACK_DOCTYPE, processed, "status"),
+            "Processed",
+        )
+
+        failed_callback = frappe.get_doc(MPESA_B2C_CALLBACK_DOCTYPE, failed)
+        self.assertEqual(failed_callback.status, "Failed")
+        self.assertIn("unknown-originator-id", failed_callback.error)
+
+    def test_queue_timeouts_schedule_retries(self) -> None:
+        """Tests timed out payments are scheduled for retry until attempts run out"""
+        payment = frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Payment",
+                "commandid": "BusinessPayment",
+                "remarks": "callback test remarks",
+                "originatorconversationid": self.result["OriginatorConversationID"],
+                "status": "Pending",
+                "partyb": "254708993268",
+                "amount": 10,
+                "occassion": "Testing",
+                "party_type": "Supplier",
+            }
+        ).insert()
+
+        queue_callback(self.result, "Queue Timeout")
+        with patch.object(callbacks.frappe.db, "commit"), patch.object(
+            callbacks.time, "sleep"
+        ):
+            callbacks.process_queued_callbacks()
+
+        payment.reload()
+        self.assertEqual(payment.status, "Timed-Out")
+        self.assertIsNotNone(payment.next_retry_at)
+
+        payment.db_set(
+            {
+                "status": "Pending",
+                "retry_attempts": retries.DEFAULT_MAX_RETRY_ATTEMPTS,
+                "next_retry_at": None,
+            }
+        )
+        queue_callback(self.result, "Queue Timeout")
+        with patch.object(callbacks.frappe.db, "commit"), patch.object(
+            callbacks.time, "sleep"
+        ):
+            callbacks.process_queued_callbacks()
+
+        payment.reload()
+        self.assertEqual(payment.status, "Timed-Out")
+        self.assertIsNone(payment.next_retry_at)
+
+    def test_retry_committed_before_sending(self) -> None:
+        """Tests a retry's new ID and attempt are committed before it is sent"""
+        payment = frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Payment",
+                "commandid": "BusinessPayment",
+                "remarks": "callback test remarks",
+                "originatorconversationid": self.result["OriginatorConversationID"],
+                "status": "Timed-Out",
+                "next_retry_at": frappe.utils.add_to_date(None, minutes=-1),
+                "partyb": "254708993268",
+                "amount": 10,
+                "occassion": "Testing",
+                "party_type": "Supplier",
+            }
+        ).insert()
+        calls = MagicMock()
+
+        def dispatch(
+            payments: list[dict], credentials: RequestCredentials
+        ) -> list[PaymentOutcome]:
+            calls.dispatch(
+                frappe.db.get_value(
+                    "MPesa B2C Payment",
+                    payment.name,
+                    ["status", "originatorconversationid", "retry_attempts"],
+                )
+            )
+            return [PaymentOutcome(payment.name, 200, "{}", None)]
+
+        with patch.object(
+            retries.frappe.db, "commit", side_effect=calls.commit
+        ), patch.object(
+            retries,
+            "get_request_credentials",
+            return_value=RequestCredentials("credential", "token"),
+        ), patch.object(
+            retries, "dispatch_payments", side_effect=dispatch
+        ):
+            retries.retry_timed_out_payments()
+
+        self.assertEqual(calls.method_calls[0], call.commit())
+        (dispatched,) = calls.method_calls[1].args
+        status, originator_conversation_id, retry_attempts = dispatched
+        self.assertEqual(status, "Sending")
+        self.assertNotEqual(
+            originator_conversation_id, self.result["OriginatorConversationID"]
+        )
+        self.assertEqual(retry_attempts, 1)
+
+    def test_retry_not_sending_on_token_miss(self) -> None:
+        """Tests a retry whose request cannot be built stays scheduled, not Sending"""
+        next_retry_at = frappe.utils.add_to_date(None, minutes=-1)
+        payment = make_b2c_payment(
+            remarks="callback test remarks",
+            originatorconversationid=self.result["OriginatorConversationID"],
+            status="Timed-Out",
+            next_retry_at=next_retry_at,
+        ).insert()
+
+        with patch.object(
+            bulk_dispatcher.access_token_provider,
+            "get_token",
+            side_effect=AccessTokenUnavailableError,
+        ), patch.object(
+            bulk_dispatcher, "get_security_credential", return_value="credential"
+        ), patch.object(
+            retries, "dispatch_payments"
+        ) as mock_dispatch, patch.object(
+            retries.frappe.db, "commit"
+        ):
+            with self.assertRaises(AccessTokenUnavailableError):
+                retries.retry_timed_out_payments()
+
+        mock_dispatch.assert_not_called()
+        payment.reload()
+        self.assertEqual(payment.status, "Timed-Out")
+        self.assertEqual(
+            payment.originatorconversationid, self.result["OriginatorConversationID"]
+        )
+        self.assertEqual(payment.retry_attempts, 0)
+        self.assertEqual(payment.next_retry_at, next_retry_at)
+
+    def test_resolve_payments_by_conversation_ids(self) -> None:
+        """Tests Results are matched to payments by either conversation ID"""
+        payment = make_b2c_payment(remarks="callback test remarks").insert()
+        conversation_id = f"AG_{frappe.generate_hash(length=12)}"
+        update_payment_status(payment.name, conversationid=conversation_id)
+
+        payments = callbacks.resolve_payments(
+            {
+                "by-originator-id": {
+                    "OriginatorConversationID": payment.originatorconversationid
+                },
+                "by-conversation-id": {
+                    "OriginatorConversationID": "unknown-id",
+                    "ConversationID": conversation_id,
+                },
+                "unknown": {"OriginatorConversationID": "unknown-id"},
+            }
+        )
+
+        self.assertEqual(payments["by-originator-id"].name, payment.name)
+        self.assertEqual(payments["by-conversation-id"].name, payment.name)
+        self.assertNotIn("unknown", payments)
+
+    def test_resolve_payments_from_cache(self) -> None:
+        """Tests cached payments are used only while they still carry the ID"""
+        payment = make_b2c_payment(remarks="callback test remarks").insert()
+        other_payment = make_b2c_payment(remarks="callback test remarks").insert()
+        stale_id = str(uuid4())
+        payment_lookup.remember_payment(payment.name, payment.originatorconversationid)
+        payment_lookup.remember_payment(other_payment.name, stale_id)
+
+        payments = callbacks.resolve_payments(
+            {
+                "cached": {
+                    "OriginatorConversationID": payment.originatorconversationid
+                },
+                "stale": {"OriginatorConversationID": stale_id},
+            }
+        )
+
+        self.assertEqual(payments["cached"].name, payment.name)
+        self.assertNotIn("stale", payments)
+        self.assertIsNone(payment_lookup.get_cached_payment_name(stale_id))
+
+        payment_lookup.forget_payment(payment.originatorconversationid)
+        self.assertIsNone(
+            payment_lookup.get_cached_payment_name(payment.originatorconversationid)
+        )
+
+    def test_retry_delay_backs_off_with_jitter(self) -> None:
+        """Tests each retry waits between half and all of the doubled base delay"""
+        for attempts in range(4):
+            delay = retries.get_retry_delay(attempts, 60)
+            self.assertGreaterEqual(delay, 60 * 2**attempts / 2)
+            self.assertLessEqual(delay, 60 * 2**attempts)
+
+    def test_duplicate_callbacks_ignored(self) -> None:
+        """Tests retried callbacks are acknowledged but only queued once"""
+        with patch.object(mpesa_b2c_payment.frappe, "enqueue") as mock_enqueue:
+            for _ in range(3):
+                acknowledgement = mpesa_b2c_payment.results_callback_url(self.result)
+                self.assertEqual(acknowledgement["ResultCode"], 0)
+
+        mock_enqueue.assert_called_once()
+        self.assertEqual(frappe.db.count(MPESA_B2C_CALLBACK_DOCTYPE), 1)
+
+        self.assertFalse(claim_callback(self.result))
+        release_callback(self.result)
+        self.assertTrue(claim_callback(self.result))
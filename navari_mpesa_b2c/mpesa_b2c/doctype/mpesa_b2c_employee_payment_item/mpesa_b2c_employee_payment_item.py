@@ -1,9 +1,16 @@
 # Copyright (c) 2024, Navari Ltd and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class MPesaB2CEmployeePaymentItem(Document):
 	pass
+
+
+def on_doctype_update():
+	"""Index the lookup of the items already paying a record"""
+	frappe.db.add_index(
+		"MPesa B2C Employee Payment Item", ["reference_doctype", "record"]
+	)
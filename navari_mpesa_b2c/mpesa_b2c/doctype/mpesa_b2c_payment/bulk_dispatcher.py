@@ -0,0 +1,257 @@
+"""Concurrent dispatch of many B2C payment requests to Daraja"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, NamedTuple
+
+import requests
+
+from .. import app_logger
+from ..custom_exceptions import RateLimitExceededError
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .http_client import POOL_MAXSIZE, get_session, get_timeouts
+from .mpesa_b2c_payment import (
+    access_token_provider,
+    bulk_update_payment_status,
+    generate_payload,
+    get_conversation_id,
+)
+from .payment_lookup import remember_payment
+from .rate_limiter import acquire_async
+from .security_credentials import get_security_credential
+
+DEFAULT_MAX_CONCURRENT_REQUESTS: Final[int] = 10
+
+
+class PaymentOutcome(NamedTuple):
+    """The result of sending one payment's request to Daraja"""
+
+    name: str
+    status_code: int | None
+    response: str | None
+    error: str | None
+    # False if the request never went out, e.g. the rate limit could not be acquired
+    sent: bool = True
+    # True if the request went out but its response never arrived, e.g. a read timeout,
+    # so Daraja may still have accepted it
+    unconfirmed: bool = False
+
+    @property
+    def succeeded(self) -> bool:
+        """Whether Daraja accepted the payment request"""
+        return self.error is None
+
+
+class RequestCredentials(NamedTuple):
+    """The SecurityCredential and access token every payment request is sent with"""
+
+    security_credential: str
+    bearer_token: str
+
+
+def get_request_credentials() -> RequestCredentials | None:
+    """
+    Returns the SecurityCredential and access token to send payment requests with,
+    or None if there is no certificate file to build the credential from.
+    Raises AccessTokenUnavailableError if no access token is cached.
+    Callers marking payments in flight fetch these first, so a payment is never left
+    Sending by a request that could not be built.
+    """
+    security_credential = get_security_credential(get_b2c_settings_snapshot())
+
+    if not security_credential:
+        app_logger.error("No certificate file found in server, payments not sent")
+        return None
+
+    return RequestCredentials(security_credential, access_token_provider.get_token())
+
+
+def dispatch_payments(
+    payments: list[dict],
+    max_in_flight: int | None = None,
+    credentials: RequestCredentials | None = None,
+) -> list[PaymentOutcome]:
+    """
+    Sends payment requests for the given MPesa B2C Payment records concurrently,
+    with at most max_in_flight (by default the Max Concurrent Requests setting)
+    requests outstanding at a time.
+    The access token and security credential are fetched once for all payments,
+    unless already given as credentials.
+    Accepted payments are set to Pending and rejected ones to Errored, in batches.
+    Payments whose request was not sent are left as they were, for the caller to
+    send again.
+    """
+    if not payments:
+        return []
+
+    if credentials is None:
+        credentials = get_request_credentials()
+
+        if credentials is None:
+            return []
+
+    b2c_settings = get_b2c_settings_snapshot()
+    payloads = {
+        payment["name"]: generate_payload(
+            b2c_settings,
+            build_partial_payload(payment),
+            credentials.security_credential,
+        )
+        for payment in payments
+    }
+
+    outcomes = asyncio.run(
+        send_payloads(
+            payloads,
+            credentials.bearer_token,
+            b2c_settings.payment_url,
+            max_in_flight
+            or b2c_settings.max_concurrent_requests
+            or DEFAULT_MAX_CONCURRENT_REQUESTS,
+            get_timeouts(),
+        )
+    )
+
+    update_payment_statuses(outcomes)
+
+    # Cache the payments awaiting a Result under their conversation IDs
+    originator_conversation_ids = {
+        payment["name"]: payment["originatorconversationid"] for payment in payments
+    }
+    for outcome in outcomes:
+        if outcome.succeeded or outcome.unconfirmed:
+            remember_payment(
+                outcome.name,
+                originator_conversation_ids[outcome.name],
+                get_conversation_id(outcome.response),
+            )
+
+    return outcomes
+
+
+def build_partial_payload(payment: dict) -> dict[str, str | int]:
+    """Builds the payment specific part of the payload, as the client does for single payments"""
+    return {
+        "name": payment["name"],
+        "OriginatorConversationID": payment["originatorconversationid"],
+        "CommandID": payment["commandid"],
+        "Amount": payment["amount"],
+        "PartyB": payment["partyb"],
+        "Remarks": payment["remarks"],
+        "Occassion": payment["occassion"],
+    }
+
+
+async def send_payloads(
+    payloads: dict[str, str],
+    access_token: str,
+    url: str,
+    max_in_flight: int,
+    timeouts: tuple[float, float],
+) -> list[PaymentOutcome]:
+    """
+    POSTs each payment's payload to url, keeping at most max_in_flight requests outstanding.
+    Requests run on a thread pool sharing the worker's pooled session, so the pool's size
+    also bounds the concurrency. Each request first waits, on the event loop, for the
+    cluster-wide rate limit. Payments not sent because it was exceeded are returned
+    as unsent outcomes, so the outcomes of the requests that did go out are kept.
+    Requests whose response timed out are returned as unconfirmed outcomes.
+    Outcomes are returned in the order of payloads.
+    """
+    max_in_flight = max(1, min(max_in_flight, POOL_MAXSIZE))
+    semaphore = asyncio.Semaphore(max_in_flight)
+    loop = asyncio.get_running_loop()
+    session = get_session()
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+
+    def post(payload: str) -> requests.Response:
+        response = session.post(url, data=payload, headers=headers, timeout=timeouts)
+        response.raise_for_status()
+
+        return response
+
+    async def send(name: str, payload: str) -> PaymentOutcome:
+        async with semaphore:
+            try:
+                await acquire_async()
+
+            except RateLimitExceededError as error:
+                return PaymentOutcome(name, None, None, str(error), sent=False)
+
+            try:
+                response = await loop.run_in_executor(executor, post, payload)
+
+            except requests.ReadTimeout as error:
+                return PaymentOutcome(name, None, None, str(error), unconfirmed=True)
+
+            except requests.RequestException as error:
+                status_code = (
+                    error.response.status_code if error.response is not None else None
+                )
+                return PaymentOutcome(name, status_code, None, str(error))
+
+            return PaymentOutcome(name, response.status_code, response.text, None)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        return await asyncio.gather(
+            *(send(name, payload) for name, payload in payloads.items())
+        )
+
+
+def update_payment_statuses(outcomes: list[PaymentOutcome]) -> None:
+    """
+    Sets accepted payments to Pending, and rejected ones to Errored with the
+    HTTP status code and error as the error details, in bulk.
+    Payments whose request was not sent are not updated.
+    Unconfirmed payments may have been accepted, so they are set Pending, to be settled
+    by their callback or the status poller. Errored would let their records be paid
+    again.
+    """
+    updates = {}
+
+    for outcome in outcomes:
+        if not outcome.sent:
+            continue
+
+        if outcome.unconfirmed:
+            updates[outcome.name] = {"status": "Pending"}
+            app_logger.warning(
+                "Payment request for B2C Payment record: %s unconfirmed: %s",
+                outcome.name,
+                outcome.error,
+            )
+            continue
+
+        if outcome.succeeded:
+            updates[outcome.name] = {
+                "status": "Pending",
+                "conversationid": get_conversation_id(outcome.response),
+            }
+            continue
+
+        updates[outcome.name] = {
+            "status": "Errored",
+            "error_code": outcome.status_code or "Request Failed",
+            "error_description": outcome.error,
+        }
+        app_logger.error(
+            "Payment request for B2C Payment record: %s failed with: %s",
+            outcome.name,
+            outcome.error,
+        )
+
+    bulk_update_payment_status(updates)
+
+    accepted = sum(outcome.succeeded for outcome in outcomes)
+    unconfirmed = sum(outcome.unconfirmed for outcome in outcomes)
+    app_logger.info(
+        "Bulk payment requests sent: %s accepted, %s unconfirmed, %s failed, "
+        "%s not sent",
+        accepted,
+        unconfirmed,
+        len(updates) - accepted - unconfirmed,
+        len(outcomes) - len(updates),
+    )
@@ -0,0 +1,288 @@
+"""Background initiation of payments for every item of an MPesa B2C Payment"""
+
+from typing import Final
+
+import frappe
+from frappe.model.document import Document
+
+from .. import app_logger
+from ..custom_exceptions import InvalidBulkPaymentError
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .bulk_dispatcher import dispatch_payments, get_request_credentials
+from .funds_check import get_fundable_items
+from .mpesa_b2c_payment import (
+    MPESA_B2C_PAYMENT_DOCTYPE,
+    bulk_update_payment_status,
+    sanitise_phone_number,
+    update_payment_status,
+    validate_receiver_mobile_number,
+)
+
+MPESA_B2C_PAYMENT_ITEM_DOCTYPE: Final[str] = "MPesa B2C Employee Payment Item"
+DEFAULT_BULK_CHUNK_SIZE: Final[int] = 100
+BULK_PAYMENT_PROGRESS_EVENT: Final[str] = "mpesa_b2c_bulk_payment_progress"
+
+
+@frappe.whitelist(methods="POST")
+def initiate_bulk_payment(name: str) -> None:
+    """
+    Queues a background job that pays each item of the MPesa B2C Payment
+    and returns immediately
+    """
+    payment = frappe.get_doc(MPESA_B2C_PAYMENT_DOCTYPE, name)
+    payment.check_permission("write")
+
+    if payment.docstatus != 1 or not payment.items:
+        error = f"B2C Payment: {name} needs to be submitted and have items to be paid in bulk"
+        app_logger.error(error)
+        raise InvalidBulkPaymentError(error)
+
+    # Reject a batch the account cannot cover before queueing it
+    get_fundable_items(
+        payment, [item for item in payment.items if not item.b2c_payment]
+    )
+
+    frappe.enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.bulk_payment.process_bulk_payment",
+        queue="long",
+        timeout=3600,
+        job_id=f"mpesa_b2c_bulk_payment::{name}",
+        deduplicate=True,
+        payment_name=name,
+    )
+
+    app_logger.info("Bulk payment queued for B2C Payment record: %s", name)
+    frappe.response["message"] = "queued"
+
+
+def process_bulk_payment(payment_name: str) -> None:
+    """
+    Pays each item of the bulk MPesa B2C Payment through its own MPesa B2C Payment record.
+    Work is committed chunk by chunk: items already having a payment record are not
+    recreated and payments already sent are not resent, so a job that crashed can be
+    queued again and resumes where it stopped.
+    Items are first checked against the available funds. Items left out when the batch
+    is split are paid by initiating the bulk payment again once funds are topped up.
+    A "done" progress stage is published once the job stops, however it stops.
+    """
+    bulk_payment = frappe.get_doc(MPESA_B2C_PAYMENT_DOCTYPE, payment_name)
+
+    try:
+        pay_items(bulk_payment)
+
+    finally:
+        publish_progress(bulk_payment, "done")
+
+
+def pay_items(bulk_payment: Document) -> None:
+    """
+    Creates and sends the payments of the bulk payment's unpaid items.
+    Each chunk is committed as Sending before its requests go out, once the credentials
+    they are sent with are in hand. Payments a crashed job left Sending may have
+    reached Daraja, so they are set Pending, to be settled by their callbacks or the
+    status poller, rather than sent again.
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+    chunk_size = b2c_settings.bulk_chunk_size or DEFAULT_BULK_CHUNK_SIZE
+
+    reconcile_interrupted_payments(bulk_payment)
+
+    unpaid_items = [item for item in bulk_payment.items if not item.b2c_payment]
+    items_to_create = get_fundable_items(bulk_payment, unpaid_items)
+
+    for start in range(0, len(items_to_create), chunk_size):
+        for item in items_to_create[start : start + chunk_size]:
+            create_item_payment(bulk_payment, item)
+
+        frappe.db.commit()  # nosemgrep
+        publish_progress(bulk_payment, "created")
+
+    while True:
+        payments = frappe.get_all(
+            MPESA_B2C_PAYMENT_DOCTYPE,
+            filters={
+                "bulk_payment": bulk_payment.name,
+                "status": "Not Initiated",
+                "docstatus": 1,
+            },
+            fields=[
+                "name",
+                "originatorconversationid",
+                "commandid",
+                "amount",
+                "partyb",
+                "remarks",
+                "occassion",
+            ],
+            order_by="name",
+            limit=chunk_size,
+        )
+        if not payments:
+            break
+
+        # Raises, with the chunk still Not Initiated, if no access token is cached
+        credentials = get_request_credentials()
+        if credentials is None:
+            # Nothing can be sent, e.g. no certificate file. Stop rather than spin
+            return
+
+        bulk_update_payment_status(
+            {payment.name: {"status": "Sending"} for payment in payments}
+        )
+        frappe.db.commit()  # nosemgrep
+
+        outcomes = dispatch_payments(payments, credentials=credentials)
+
+        unsent = [outcome.name for outcome in outcomes if not outcome.sent]
+        if unsent:
+            bulk_update_payment_status(
+                {name: {"status": "Not Initiated"} for name in unsent}
+            )
+
+        frappe.db.commit()  # nosemgrep
+        publish_progress(bulk_payment, "sent")
+
+        if unsent:
+            # The rate limit is exhausted. Stop, the job can be queued again later
+            app_logger.warning(
+                "Bulk payment for B2C Payment record: %s stopped, %s payments not sent",
+                bulk_payment.name,
+                len(unsent),
+            )
+            return
+
+    # Items left without a payment were skipped for invalid receiver numbers
+    if skipped := sum(1 for item in items_to_create if not item.b2c_payment):
+        app_logger.error(
+            "Bulk payment for B2C Payment record: %s left %s items with invalid "
+            "receiver numbers unpaid",
+            bulk_payment.name,
+            skipped,
+        )
+        return
+
+    if len(items_to_create) < len(unpaid_items):
+        app_logger.info(
+            "Bulk payment for B2C Payment record: %s paid %s items, %s await funds",
+            bulk_payment.name,
+            len(items_to_create),
+            len(unpaid_items) - len(items_to_create),
+        )
+        return
+
+    update_payment_status(bulk_payment.name, status="Pending")
+    app_logger.info(
+        "Bulk payment for B2C Payment record: %s completed", bulk_payment.name
+    )
+
+
+def reconcile_interrupted_payments(bulk_payment: Document) -> None:
+    """Sets the item payments a crashed job left Sending to Pending"""
+    interrupted = frappe.get_all(
+        MPESA_B2C_PAYMENT_DOCTYPE,
+        filters={"bulk_payment": bulk_payment.name, "status": "Sending"},
+        pluck="name",
+    )
+    if not interrupted:
+        return
+
+    bulk_update_payment_status({name: {"status": "Pending"} for name in interrupted})
+    frappe.db.commit()  # nosemgrep
+
+    app_logger.warning(
+        "%s payments of B2C Payment record: %s were interrupted while Sending, "
+        "left for the status poller",
+        len(interrupted),
+        bulk_payment.name,
+    )
+
+
+def create_item_payment(bulk_payment: Document, item: Document) -> Document | None:
+    """
+    Creates and submits the MPesa B2C Payment paying a single item of the bulk payment,
+    and links it to the item. Items without a valid receiver number are skipped,
+    with the reason recorded in the item's error.
+    """
+    partyb = sanitise_phone_number(item.partyb or "")
+
+    if not validate_receiver_mobile_number(partyb):
+        error = f"Invalid receiver number: {item.partyb}, item not paid"
+        app_logger.error(
+            "Skipping item %s of B2C Payment record: %s, %s",
+            item.name,
+            bulk_payment.name,
+            error,
+        )
+        frappe.db.set_value(
+            MPESA_B2C_PAYMENT_ITEM_DOCTYPE,
+            item.name,
+            "error",
+            error,
+            update_modified=False,
+        )
+        item.error = error
+        return None
+
+    item_payment = frappe.get_doc(
+        {
+            "doctype": MPESA_B2C_PAYMENT_DOCTYPE,
+            "bulk_payment": bulk_payment.name,
+            "commandid": bulk_payment.commandid,
+            "remarks": bulk_payment.remarks,
+            "occassion": bulk_payment.occassion,
+            "party_type": bulk_payment.party_type,
+            "party": item.receiver_name,
+            "partyb": partyb,
+            "amount": item.amount,
+            "account_paid_from": bulk_payment.account_paid_from,
+            "account_paid_to": bulk_payment.account_paid_to,
+            "doctype_to_pay_against": bulk_payment.doctype_to_pay_against,
+            "start_date": bulk_payment.start_date,
+            "end_date": bulk_payment.end_date,
+        }
+    )
+    item_payment.insert(ignore_permissions=True)
+    item_payment.submit()
+
+    frappe.db.set_value(
+        MPESA_B2C_PAYMENT_ITEM_DOCTYPE,
+        item.name,
+        "b2c_payment",
+        item_payment.name,
+        update_modified=False,
+    )
+    item.b2c_payment = item_payment.name
+
+    return item_payment
+
+
+def publish_progress(bulk_payment: Document, stage: str) -> None:
+    """
+    Publishes the number of items with a payment created, sent, and skipped for an
+    invalid receiver number, to the client.
+    The "done" stage tells the client the job stopped.
+    """
+    statuses = frappe.get_all(
+        MPESA_B2C_PAYMENT_DOCTYPE,
+        filters={"bulk_payment": bulk_payment.name},
+        fields=["status", "count(name) as count"],
+        group_by="status",
+    )
+    counts = {row.status: row.count for row in statuses}
+
+    frappe.publish_realtime(
+        BULK_PAYMENT_PROGRESS_EVENT,
+        {
+            "stage": stage,
+            "total": len(bulk_payment.items),
+            "created": sum(counts.values()),
+            "sent": sum(counts.values())
+            - counts.get("Not Initiated", 0)
+            - counts.get("Sending", 0),
+            "skipped": sum(
+                1 for item in bulk_payment.items if item.error and not item.b2c_payment
+            ),
+        },
+        doctype=MPESA_B2C_PAYMENT_DOCTYPE,
+        docname=bulk_payment.name,
+    )
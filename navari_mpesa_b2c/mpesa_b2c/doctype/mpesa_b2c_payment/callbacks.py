@@ -0,0 +1,366 @@
+"""Background processing of the callbacks queued by the results callback endpoint"""
+
+import json
+import time
+from typing import Final, NamedTuple
+
+import frappe
+from frappe.utils import now_datetime
+
+from .. import app_logger
+from ..account_balances import record_balances
+from ..metrics import record_metric
+from ..mpesa_b2c_callback.mpesa_b2c_callback import MPESA_B2C_CALLBACK_DOCTYPE
+from ..mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions import (
+    B2C_PAYMENT_FIELDS,
+)
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .mpesa_b2c_payment import (
+    MPESA_B2C_PAYMENT_DOCTYPE,
+    MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE,
+    bulk_update_payment_status,
+    extract_transaction_values,
+    get_result_details,
+    save_transaction_to_database,
+)
+from .payment_lookup import forget_payment, get_cached_payment_name, remember_payment
+from .retries import get_timeout_updates
+
+DEFAULT_CALLBACK_BATCH_SIZE: Final[int] = 100
+DEFAULT_CALLBACK_FLUSH_INTERVAL: Final[float] = 1.0
+CALLBACK_SAVEPOINT: Final[str] = "mpesa_b2c_callback"
+
+
+class SuccessfulResult(NamedTuple):
+    """A queued successful Result and the B2C Payment it settles"""
+
+    callback: str
+    results: dict
+    payment: dict
+
+
+def process_queued_callbacks() -> None:
+    """
+    Processes queued callbacks in batches, oldest first, until none are left.
+    Each batch is committed once. Enqueued by the results callback endpoint and
+    run by the scheduler to pick up any callback whose job was lost.
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+    batch_size = b2c_settings.callback_batch_size or DEFAULT_CALLBACK_BATCH_SIZE
+    flush_interval = (
+        b2c_settings.callback_flush_interval or DEFAULT_CALLBACK_FLUSH_INTERVAL
+    )
+
+    while callbacks := get_callback_batch(batch_size, flush_interval):
+        process_callback_batch(callbacks)
+        frappe.db.commit()  # nosemgrep
+
+
+def get_callback_batch(batch_size: int, flush_interval: float) -> list[dict]:
+    """
+    Returns up to batch_size queued callbacks, oldest first.
+    A partial batch is held back until its oldest callback has waited flush_interval
+    seconds, so callbacks arriving in a burst are processed together.
+    """
+    callbacks = get_queued_callbacks(batch_size)
+
+    if callbacks and len(callbacks) < batch_size:
+        waited = (now_datetime() - callbacks[0].creation).total_seconds()
+
+        if waited < flush_interval:
+            time.sleep(flush_interval - waited)
+
+            # End the current snapshot so callbacks received while waiting are read
+            frappe.db.commit()  # nosemgrep
+            callbacks = get_queued_callbacks(batch_size)
+
+    return callbacks
+
+
+def get_queued_callbacks(limit: int) -> list[dict]:
+    """
+    Returns up to limit queued callbacks, oldest first, locked until the transaction
+    ends. Callbacks locked by a concurrent job are skipped, so each is claimed once.
+    """
+    callback = frappe.qb.DocType(MPESA_B2C_CALLBACK_DOCTYPE)
+
+    return (
+        frappe.qb.from_(callback)
+        .select(
+            callback.name, callback.payload, callback.callback_type, callback.creation
+        )
+        .where(callback.status == "Queued")
+        .orderby(callback.creation)
+        .limit(limit)
+        .for_update(skip_locked=True)
+    ).run(as_dict=True)
+
+
+def process_callback_batch(callbacks: list[dict]) -> None:
+    """
+    Applies a batch of queued Results and Queue Timeouts:
+    the B2C Payments are resolved, and locked, with indexed queries, a transaction
+    record is inserted for each successful Result, and status changes are applied
+    in bulk.
+    Pending payments that timed out are set to Timed-Out with their retry scheduled.
+    A failing transaction is rolled back on its own and its callback marked Failed,
+    leaving its payment untouched.
+    """
+    started = time.monotonic()
+
+    results = {callback.name: json.loads(callback.payload) for callback in callbacks}
+    timeouts = {
+        callback.name
+        for callback in callbacks
+        if callback.callback_type == "Queue Timeout"
+    }
+    payments = resolve_payments(results)
+
+    successful: list[SuccessfulResult] = []
+    errored: dict[str, tuple[int, str]] = {}
+    timed_out: dict[str, dict] = {}
+    processed: list[str] = []
+    failed: dict[str, str] = {}
+
+    for callback, result in results.items():
+        payment = payments.get(callback)
+
+        if payment is None:
+            failed[callback] = (
+                "No B2C Payment found for OriginatorConversationID: "
+                f"{result.get('OriginatorConversationID')}"
+            )
+            continue
+
+        if callback in timeouts:
+            # A Result may have settled the payment before its timeout was processed
+            if payment.status == "Pending":
+                timed_out[payment.name] = payment
+
+            processed.append(callback)
+            continue
+
+        (
+            _,
+            result_type,
+            result_code,
+            results_description,
+            transaction_id,
+        ) = get_result_details(result)
+
+        if result_type != 0:
+            app_logger.info(
+                "Duplicate Request Encountered for B2C Payment record: %s",
+                payment.name,
+            )
+            processed.append(callback)
+
+        elif result_code == 0:
+            successful.append(SuccessfulResult(callback, result, payment))
+
+        else:
+            app_logger.info(
+                "Transaction %s from B2C Payment %s Errored with code: %s, description: %s",
+                transaction_id,
+                payment.name,
+                result_code,
+                results_description,
+            )
+            errored[payment.name] = (result_code, results_description)
+            processed.append(callback)
+
+    settled, settled_values = set(), []
+    for result in successful:
+        frappe.db.savepoint(CALLBACK_SAVEPOINT)
+
+        try:
+            settled_values.append(save_successful_result(result))
+
+        except Exception:
+            frappe.db.rollback(save_point=CALLBACK_SAVEPOINT)
+            app_logger.exception("Failed to process callback: %s", result.callback)
+            failed[result.callback] = frappe.get_traceback()
+
+        else:
+            processed.append(result.callback)
+            settled.add(result.payment.name)
+
+    # Payments are only set Paid once their transaction is saved, so a Result failing
+    # to save never needs its payment's status reverted
+    payment_updates = {
+        payment_name: {
+            "status": "Errored",
+            "error_code": error_code,
+            "error_description": error_description,
+        }
+        for payment_name, (error_code, error_description) in errored.items()
+    }
+    payment_updates.update(
+        {payment_name: {"status": "Paid"} for payment_name in settled}
+    )
+    payment_updates.update(
+        get_timeout_updates(
+            [
+                payment
+                for payment_name, payment in timed_out.items()
+                if payment_name not in payment_updates
+            ]
+        )
+    )
+    bulk_update_payment_status(payment_updates)
+
+    # Settled payments expect no further Results, so need not stay cached
+    for payment in payments.values():
+        if payment.name in settled or payment.name in errored:
+            forget_payment(payment.originatorconversationid, payment.conversationid)
+
+    mark_callbacks(processed, failed)
+    record_balances(settled_values)
+
+    elapsed = time.monotonic() - started
+    record_metric("callback_batch_latency", elapsed)
+    record_metric("callback_throughput", len(callbacks) / elapsed if elapsed else 0)
+    app_logger.info(
+        "Processed %s callbacks (%s failed) at %.1f callbacks per second",
+        len(callbacks),
+        len(failed),
+        len(callbacks) / elapsed if elapsed else 0,
+    )
+
+
+def resolve_payments(results: dict[str, dict]) -> dict[str, dict]:
+    """
+    Returns the B2C Payment each Result, keyed by its callback, reports on.
+    Payments cached under the Results' conversation IDs are read by name with one
+    query, and kept if they still carry the ID. The rest are matched on the
+    OriginatorConversationID with one indexed query, and any left unmatched on the
+    ConversationID with another, and cached.
+    The payments are locked, so their status is read after any concurrent batch
+    settling them has committed.
+    """
+    payments = {}
+    fields = [
+        *B2C_PAYMENT_FIELDS,
+        "originatorconversationid",
+        "conversationid",
+        "retry_attempts",
+    ]
+
+    cached = {
+        callback: name
+        for callback, result in results.items()
+        if (
+            name := get_cached_payment_name(
+                result.get("OriginatorConversationID"), result.get("ConversationID")
+            )
+        )
+    }
+    if cached:
+        cached_payments = {
+            payment.name: payment
+            for payment in frappe.get_all(
+                MPESA_B2C_PAYMENT_DOCTYPE,
+                filters={"name": ["in", list(set(cached.values()))]},
+                fields=fields,
+                for_update=True,
+            )
+        }
+
+        for callback, name in cached.items():
+            payment, result = cached_payments.get(name), results[callback]
+
+            if payment and (
+                payment.originatorconversationid
+                == result.get("OriginatorConversationID")
+                or (
+                    payment.conversationid
+                    and payment.conversationid == result.get("ConversationID")
+                )
+            ):
+                payments[callback] = payment
+            else:
+                # Stale, e.g. dropped by another worker, so looked up through the index
+                forget_payment(
+                    result.get("OriginatorConversationID"), result.get("ConversationID")
+                )
+
+    for result_field, payment_field in (
+        ("OriginatorConversationID", "originatorconversationid"),
+        ("ConversationID", "conversationid"),
+    ):
+        unresolved = {
+            callback: result.get(result_field)
+            for callback, result in results.items()
+            if callback not in payments and result.get(result_field)
+        }
+        if not unresolved:
+            continue
+
+        matches = {
+            payment[payment_field]: payment
+            for payment in frappe.get_all(
+                MPESA_B2C_PAYMENT_DOCTYPE,
+                filters={payment_field: ["in", list(unresolved.values())]},
+                fields=fields,
+                for_update=True,
+            )
+        }
+
+        for callback, conversation_id in unresolved.items():
+            if conversation_id in matches:
+                payment = matches[conversation_id]
+                payments[callback] = payment
+                remember_payment(
+                    payment.name,
+                    payment.originatorconversationid,
+                    payment.conversationid,
+                )
+
+    return payments
+
+
+def save_successful_result(result: SuccessfulResult) -> dict:
+    """Saves the transaction reported by a successful Result and returns its values"""
+    transaction_values = extract_transaction_values(
+        result.results.get("ResultParameters").get("ResultParameter"),
+        result.results.get("TransactionID"),
+    )
+    transaction_values.update(
+        {
+            "b2c_payment_name": result.payment.name,
+            "account_paid_from": result.payment.account_paid_from,
+            "account_paid_to": result.payment.account_paid_to,
+        }
+    )
+
+    save_transaction_to_database(
+        MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE,
+        transaction_values,
+        # The payment is set to Paid by the batch's bulk update once this is saved
+        b2c_payment=frappe._dict(result.payment, status="Paid"),
+    )
+
+    return transaction_values
+
+
+def mark_callbacks(processed: list[str], failed: dict[str, str]) -> None:
+    """Marks the processed callbacks with a single update, and failed ones with their error"""
+    processed_at = now_datetime()
+
+    if processed:
+        callback = frappe.qb.DocType(MPESA_B2C_CALLBACK_DOCTYPE)
+        (
+            frappe.qb.update(callback)
+            .set(callback.status, "Processed")
+            .set(callback.processed_at, processed_at)
+            .where(callback.name.isin(processed))
+        ).run()
+
+    for callback_name, error in failed.items():
+        app_logger.error("Callback: %s failed with: %s", callback_name, error)
+        frappe.db.set_value(
+            MPESA_B2C_CALLBACK_DOCTYPE,
+            callback_name,
+            {"status": "Failed", "error": error, "processed_at": processed_at},
+            update_modified=False,
+        )
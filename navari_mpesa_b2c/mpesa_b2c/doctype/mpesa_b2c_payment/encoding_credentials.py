@@ -4,13 +4,41 @@ import base64
 import hashlib
 import os
 
+from cryptography import x509
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 KEY_LEN = 32
 IV_LEN = 16
 
 
+def load_public_key(certificate: bytes) -> RSAPublicKey:
+    """
+    Parses the RSA public key from a PEM or DER encoded X.509 certificate,
+    or from a PEM encoded public key
+    """
+    if b"-----BEGIN CERTIFICATE-----" in certificate:
+        return x509.load_pem_x509_certificate(certificate).public_key()
+
+    if b"-----BEGIN" in certificate:
+        return serialization.load_pem_public_key(certificate)
+
+    return x509.load_der_x509_certificate(certificate).public_key()
+
+
+def rsa_encrypt_encode(password: bytes, public_key: RSAPublicKey) -> bytes:
+    """
+    Encrypts the password with the certificate's public key using PKCS#1 v1.5 padding
+    and Base64 encodes it, as expected of Daraja's SecurityCredential
+    """
+    encrypted_password = public_key.encrypt(password, padding.PKCS1v15())
+
+    return base64.b64encode(encrypted_password)
+
+
 def evp_bytes_to_key(
     password: bytes, salt: bytes, key_len=KEY_LEN, iv_len=IV_LEN
 ) -> tuple[bytes, bytes]:
@@ -0,0 +1,94 @@
+"""Pre-flight check of a bulk payment's total against the M-Pesa account's funds"""
+
+from typing import Final
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from .. import app_logger
+from ..account_balances import read_latest_balance
+from ..custom_exceptions import InsufficientFundsError
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .mpesa_b2c_payment import MPESA_B2C_PAYMENT_DOCTYPE
+
+DEFAULT_FUNDS_CHECK_MODE: Final[str] = "Reject"
+AVAILABLE_FUNDS_HOOK: Final[str] = "mpesa_b2c_available_funds"
+
+
+def get_available_funds() -> float | None:
+    """
+    Returns the funds B2C payments can be made from, i.e. the utility account's latest
+    reported balance, or None if no balance is known.
+    Another source, e.g. a stub in tests, can be set through the
+    mpesa_b2c_available_funds hook, naming a method that takes no arguments.
+    """
+    if methods := frappe.get_hooks(AVAILABLE_FUNDS_HOOK):
+        return frappe.get_attr(methods[-1])()
+
+    balance = read_latest_balance()
+
+    return balance.get("utility") if balance else None
+
+
+def get_fundable_items(bulk_payment: Document, items: list[Document]) -> list[Document]:
+    """
+    Returns the items, yet to be given a payment, that the available funds cover,
+    after the bulk payment's payments created but not yet sent.
+    If the funds fall short, Reject mode raises InsufficientFundsError and Split mode
+    returns the leading items that fit, leaving the rest for a later initiation.
+    Nothing is checked when the mode is Disabled or no balance is known.
+    """
+    mode = get_b2c_settings_snapshot().funds_check_mode or DEFAULT_FUNDS_CHECK_MODE
+    if mode == "Disabled":
+        return items
+
+    available = get_available_funds()
+    if available is None:
+        app_logger.warning(
+            "No account balance known, B2C Payment record: %s not checked for funds",
+            bulk_payment.name,
+        )
+        return items
+
+    unsent = flt(
+        frappe.db.get_value(
+            MPESA_B2C_PAYMENT_DOCTYPE,
+            {
+                "bulk_payment": bulk_payment.name,
+                "status": ["in", ["Not Initiated", "Sending"]],
+                "docstatus": 1,
+            },
+            "sum(amount)",
+        )
+    )
+    required = unsent + sum(flt(item.amount) for item in items)
+
+    if required <= available:
+        return items
+
+    if mode == "Reject" or unsent > available:
+        error = (
+            f"B2C Payment: {bulk_payment.name} needs {required} but only "
+            f"{available} is available in the M-Pesa account"
+        )
+        app_logger.error(error)
+        raise InsufficientFundsError(error)
+
+    fundable, total = [], unsent
+    for item in items:
+        if total + flt(item.amount) > available:
+            break
+
+        fundable.append(item)
+        total += flt(item.amount)
+
+    app_logger.info(
+        "B2C Payment record: %s split, %s of %s items fit the available %s",
+        bulk_payment.name,
+        len(fundable),
+        len(items),
+        available,
+    )
+
+    return fundable
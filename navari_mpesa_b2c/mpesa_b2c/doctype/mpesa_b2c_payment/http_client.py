@@ -0,0 +1,98 @@
+"""Pooled, keep-alive HTTP client used for all requests to Daraja"""
+
+import os
+from typing import Final
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .rate_limiter import acquire
+
+DEFAULT_CONNECT_TIMEOUT: Final[float] = 5.0
+DEFAULT_READ_TIMEOUT: Final[float] = 30.0
+
+# Number of hosts (authorization, payment, ...) kept pooled, and connections kept per host
+POOL_CONNECTIONS: Final[int] = 4
+POOL_MAXSIZE: Final[int] = 20
+
+_session: requests.Session | None = None
+_session_pid: int | None = None
+
+
+def get_session() -> requests.Session:
+    """
+    Returns this worker's HTTP session.
+    Connections are kept alive and reused across payments. A new session is created
+    after a fork since connections cannot be shared between processes.
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        _session, _session_pid = session, os.getpid()
+
+    return _session
+
+
+def get_timeouts() -> tuple[float, float]:
+    """Returns the connect and read timeouts set in the MPesa B2C Settings"""
+    b2c_settings = get_b2c_settings_snapshot()
+
+    return (
+        b2c_settings.connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+        b2c_settings.read_timeout or DEFAULT_READ_TIMEOUT,
+    )
+
+
+def daraja_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Sends a request to Daraja over the worker's pooled session,
+    once the cluster-wide rate limit allows it
+    """
+    kwargs.setdefault("timeout", get_timeouts())
+    acquire()
+
+    return get_session().request(method, url, **kwargs)
+
+
+def get_connection_stats() -> dict[str, int | float]:
+    """
+    Returns the number of requests sent and connections opened by this worker's session.
+    A reuse ratio close to 1 means connections are being kept alive.
+    """
+    requests_sent, connections_opened = 0, 0
+
+    if _session is not None and _session_pid == os.getpid():
+        pool_manager = _session.get_adapter("https://").poolmanager
+
+        for pool_key in pool_manager.pools.keys():
+            pool = pool_manager.pools[pool_key]
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+
+    return {
+        "requests": requests_sent,
+        "connections_opened": connections_opened,
+        "reused_connections": max(requests_sent - connections_opened, 0),
+        "reuse_ratio": (
+            (requests_sent - connections_opened) / requests_sent
+            if requests_sent
+            else 0.0
+        ),
+    }
+
+
+@frappe.whitelist()
+def connection_stats() -> dict[str, int | float]:
+    """Returns the answering worker's connection reuse statistics"""
+    frappe.only_for("System Manager")
+
+    return get_connection_stats()
@@ -2,9 +2,60 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on("MPesa B2C Payment", {
+  setup: function (frm) {
+    frappe.realtime.on("mpesa_b2c_bulk_payment_progress", (progress) => {
+      frappe.show_progress(
+        __("Bulk Payment"),
+        progress.sent,
+        progress.total,
+        progress.skipped
+          ? __("{0} of {1} payment requests sent, {2} skipped for invalid numbers", [
+              progress.sent,
+              progress.total,
+              progress.skipped,
+            ])
+          : __("{0} of {1} payment requests sent", [progress.sent, progress.total])
+      );
+
+      // Items left out of a split batch are never sent
+      if (
+        progress.stage === "done" ||
+        progress.sent + progress.skipped === progress.total
+      ) {
+        frappe.hide_progress();
+        frm.reload_doc();
+      }
+    });
+  },
   refresh: function (frm) {
     if (
       frm.doc.docstatus === 1 &&
+      frm.doc.items?.length &&
+      frm.doc.status === "Not Initiated"
+    ) {
+      // Items are paid from a background job, each through its own B2C Payment record
+      frm.add_custom_button(
+        "Initiate Bulk Payment",
+        function () {
+          frappe.call({
+            method:
+              "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.bulk_payment.initiate_bulk_payment",
+            args: { name: frm.doc.name },
+            callback: function (response) {
+              if (response.message === "queued") {
+                frappe.show_alert({
+                  message: __("Bulk payment queued"),
+                  indicator: "green",
+                });
+              }
+            },
+          });
+        },
+        __("MPesa Actions")
+      );
+    } else if (
+      frm.doc.docstatus === 1 &&
+      !frm.doc.items?.length &&
       (frm.doc.status === "Not Initiated" || frm.doc.status === "Timed-Out")
     ) {
       // Only render the Initiate Payment button if document is saved, and
@@ -84,81 +135,51 @@ frappe.ui.form.on("MPesa B2C Payment", {
       };
     });
   },
-  doctype_to_pay_against: function (frm) {
+  doctype_to_pay_against: async function (frm) {
     frm.set_value("items", []);
     const doctype = frm.doc.doctype_to_pay_against;
 
-    console.log(frm.doc.start_date, frm.doc.end_date);
+    if (!doctype) {
+      return;
+    }
 
-    // Fetch relevant records and set relevant fields in items table
-    frappe.db
-      .get_list(doctype, {
-        fields: ["*"],
-        filters: {
-          // TODO: Fix problem with date filters not working properly
-          creation: [">", frm.doc.start_date],
-          creation: ["<=", frm.doc.end_date],
+    // Fetch the resolved items page by page, receivers and numbers included.
+    // Each page says where the next one starts
+    let next = {};
+    let fetched = 0;
+
+    while (next) {
+      const response = await frappe.call({
+        method:
+          "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.payment_items.get_payment_items",
+        args: {
+          doctype: doctype,
+          start_date: frm.doc.start_date,
+          end_date: frm.doc.end_date,
+          ...next,
         },
-      })
-      .then((response) => {
-        if (!response.length) {
-          throw new Error("No Data Fetched");
-        } else {
-          response.forEach(async (data) => {
-            let recordData = {
-              reference_doctype: doctype,
-              record: data.name,
-              receiver_name: data.employee ?? data.supplier,
-              partyb: null,
-              record_amount: data.base_rounded_total,
-            };
-
-            // Apply fetching contact strategy according to document
-            if (doctype === "Salary Slip") {
-              const contact = await frappe.db.get_value(
-                "Employee",
-                { name: data.employee ?? null },
-                ["cell_number"]
-              );
-
-              if (contact) {
-                recordData = {
-                  ...recordData,
-                  partyb: contact.message?.cell_number,
-                };
-              }
-            } else if (doctype === "Purchase Invoice") {
-              const contact = await frappe.db.get_value(
-                "Contact",
-                { name: ["like", `%${data.supplier}%`] },
-                ["*"]
-              );
-
-              if (contact) {
-                recordData = {
-                  ...recordData,
-                  partyb: contact.message?.phone ?? contact.message?.mobile_no,
-                };
-              }
-            }
+      });
+      const page = response.message;
 
-            // Update fields of child table with filtered data
-            const row = frm.add_child("items");
-            frappe.model.set_value(row.doctype, row.name, recordData);
-            cur_frm.refresh_fields("items");
-          });
-        }
-      })
-      .catch((error) => {
-        if (error.message === "No Data Fetched")
-          frappe.msgprint({
-            message: __(
-              `No records fetched for doctype <b>${doctype}</b> with the <b>date filters specified</b>`
-            ),
-            indicator: "red",
-            title: "Error",
-          });
+      page.items.forEach((item) => {
+        frm.add_child("items", item);
       });
+
+      fetched += page.items.length;
+      next = page.next;
+    }
+
+    frm.refresh_field("items");
+
+    if (!fetched) {
+      frappe.msgprint({
+        message: __(
+          `No records fetched for doctype <b>${doctype}</b> with the <b>date filters specified</b>`
+        ),
+        indicator: "red",
+        title: "Error",
+      });
+    }
   },
 });
 
@@ -1,22 +1,39 @@
 # Copyright (c) 2023, Navari Limited and contributors
 # For license information, please see license.txt
 
-import ast
 import base64
 import datetime
 import json
 import re
-from typing import Literal, Final
+import time
+from functools import partial
+from typing import Any, Literal, Final
 from uuid import uuid4
 
 import frappe
 import requests
 from frappe.model.document import Document
+from frappe.query_builder import Case
+from frappe.utils import now_datetime
 from frappe.utils.file_manager import get_file_path
 from frappe.utils.password import get_decrypted_password
 
 from .. import app_logger
-from .encoding_credentials import openssl_encrypt_encode
+from ..mpesa_b2c_settings.mpesa_b2c_settings import (
+    B2CSettingsSnapshot,
+    get_b2c_settings_snapshot,
+)
+from ..metrics import increment_counter, record_metric
+from ..mpesa_b2c_callback.mpesa_b2c_callback import (
+    claim_callback,
+    queue_callback,
+    release_callback,
+)
+from .http_client import daraja_request
+from .payment_lookup import forget_payment, remember_payment
+from .result_parameters import parse_result_parameters
+from .security_credentials import get_security_credential
+from .token_provider import TOKEN_EXPIRY_MARGIN, AccessToken, AccessTokenProvider
 
 from ..custom_exceptions import (
     IncorrectStatusError,
@@ -28,7 +45,9 @@ from ..custom_exceptions import (
 MPESA_B2C_SETTINGS_DOCTYPE: Final[str] = "MPesa B2C Settings"
 MPESA_B2C_PAYMENT_DOCTYPE: Final[str] = "MPesa B2C Payment"
 DARAJA_ACCESS_TOKENS_DOCTYPE: Final[str] = "Daraja Access Tokens"
+DEFAULT_TOKEN_REFRESH_MARGIN: Final[int] = 300
 MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE: Final[str] = "MPesa B2C Payments Transactions"
+BULK_UPDATE_BATCH_SIZE: Final[int] = 500
 
 
 class MPesaB2CPayment(Document):
@@ -66,18 +85,27 @@ class MPesaB2CPayment(Document):
                 app_logger.error(self.error)
                 raise InformationMismatchError(self.error)
 
+    def on_trash(self) -> None:
+        """Drop the cached lookups of this payment by its conversation IDs"""
+        forget_payment(self.originatorconversationid, self.conversationid)
+
+
+def on_doctype_update() -> None:
+    """Index the stale Pending payments the status poller looks for"""
+    frappe.db.add_index(MPESA_B2C_PAYMENT_DOCTYPE, ["status", "modified"])
+
 
 @frappe.whitelist(methods="POST")
 def initiate_payment(partial_payload: str) -> None:
     """
     This endpoint initiates the payment process.
-    The endpoint first checks if a valid (meaning un-expired) access token is available.
-    If none is found, it fetches one from the authorization url provided in the MPesa B2C Settings and
-    proceeds to initiate a payment request to the payment url also specified in the MPesa B2C Settings.
-    If a valid token is found, a payment initialization request is placed immediately.
+    The access token is served from the worker's or the site's token cache, falling back to the
+    Daraja Access Tokens doctype. If no valid (meaning un-expired) token is found anywhere, the
+    payment fails and a token is fetched in the background, to be retried once it is available.
+    The payment request is then placed to the payment url also specified in the MPesa B2C Settings.
     """
     partial_payload = json.loads(frappe.form_dict.partial_payload)
-    b2c_settings = frappe.db.get_singles_dict(MPESA_B2C_SETTINGS_DOCTYPE)
+    b2c_settings = get_b2c_settings_snapshot()
 
     payment_document = frappe.db.get_value(
         MPESA_B2C_PAYMENT_DOCTYPE,
@@ -85,95 +113,168 @@ def initiate_payment(partial_payload: str) -> None:
         ["name", "status"],
         as_dict=True,
     )
-    hashed_token = get_hashed_token()
+    bearer_token = access_token_provider.get_token()
 
-    if not hashed_token:
-        consumer_key, consumer_secret, authorization_url = get_b2c_settings(
-            b2c_settings
-        )
-        response, status_code = get_access_tokens(
-            consumer_key, consumer_secret, authorization_url
-        )
-
-        if status_code == requests.codes.ok:
-            # If response code is 200, proceed
-            bearer_token = save_access_token_to_database(response)
-            make_payment(bearer_token, b2c_settings, partial_payload, payment_document)
-    else:
-        bearer_token = get_decrypted_password(
-            DARAJA_ACCESS_TOKENS_DOCTYPE, hashed_token, "access_token"
-        )
-
-        make_payment(bearer_token, b2c_settings, partial_payload, payment_document)
+    make_payment(bearer_token, b2c_settings, partial_payload, payment_document)
 
 
 @frappe.whitelist(allow_guest=True)
-def results_callback_url(Result: dict) -> None:
+def results_callback_url(Result: dict) -> dict[str, int | str]:
     """
     Handles results response from Safaricom after successful B2C Payment request.
     For a complete description of the response parameters: https://developer.safaricom.co.ke/APIs/BusinessToCustomer
+    The payload is only persisted here and acknowledged immediately. It is processed by a
+    background job so Safaricom's request does not hold the web worker.
+    Retries of a callback already received are acknowledged without touching the database.
     """
-    results = ast.literal_eval(json.dumps(Result))
-    (
-        originator_conversation_id,
-        result_type,
-        result_code,
-        results_description,
-        transaction_id,
-    ) = get_result_details(results)
-
-    if result_type == 0:
-        if result_code == 0:
-            handle_successful_result_response(results)
-        else:
-            handle_unsuccessful_result_response(
-                transaction_id,
-                originator_conversation_id,
-                result_code,
-                results_description,
-            )
-    else:
-        handle_duplicate_request(originator_conversation_id)
+    return accept_callback(Result, "Result")
 
 
 @frappe.whitelist(allow_guest=True)
-def queue_timeout_url(response):
-    """Handles timeout responses from Safaricom"""
-    # TODO: Properly handle timeout responses. Not clearly specified in Safaricom's documentations
-    frappe.msgprint(f"{response}")
+def queue_timeout_url(Result: dict | None = None, **kwargs) -> dict[str, int | str]:
+    """
+    Handles timeout responses from Safaricom, sent when a payment request timed out
+    in Safaricom's queue. As with results, the payload is persisted and acknowledged.
+    The background job moves the payment to Timed-Out and schedules its retry.
+    """
+    return accept_callback(Result or kwargs, "Queue Timeout")
 
 
-def get_hashed_token() -> str | list[None]:
+def accept_callback(payload: dict, callback_type: str) -> dict[str, int | str]:
+    """Queues the callback for the background consumer, unless it is a retry, and acknowledges it"""
+    if not claim_callback(payload, callback_type):
+        increment_counter("duplicate_callbacks")
+        app_logger.info(
+            "Duplicate %s callback for ConversationID: %s, TransactionID: %s ignored",
+            callback_type,
+            payload.get("ConversationID"),
+            payload.get("TransactionID"),
+        )
+        return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+    # If the callback is not persisted, accept Safaricom's retry of it
+    frappe.db.after_rollback.add(partial(release_callback, payload, callback_type))
+    queue_callback(payload, callback_type)
+
+    frappe.enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.callbacks.process_queued_callbacks",
+        queue="short",
+        job_id="mpesa_b2c_callbacks",
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+def get_latest_access_token_record() -> dict | None:
     """
-    Checks if a valid (read un-expired) token is present in the database,
-    fetches and returns it. Otherwise, returns an empty list
+    Returns the name and expiry time of the un-expired access token record
+    expiring last, if any
     """
+    # Served by the index on expiry_time: reads a single index entry however many
+    # historical tokens the table holds
     current_time = datetime.datetime.now()
     hashed_token = frappe.db.sql(
-        f"""
-            SELECT name, access_token
+        """
+            SELECT name, expiry_time
             FROM `tabDaraja Access Tokens`
-            WHERE expiry_time > '{current_time.strftime("%Y-%m-%d %H:%M:%S")}'
-            ORDER BY creation DESC
+            WHERE expiry_time > %s
+            ORDER BY expiry_time DESC
             LIMIT 1
         """,
+        (current_time.strftime("%Y-%m-%d %H:%M:%S"),),
         as_dict=True,
     )
 
     if hashed_token:
-        return hashed_token[0].name
+        return hashed_token[0]
+
+    return None
 
-    return []
 
+def load_stored_access_token() -> AccessToken | None:
+    """Loads and decrypts the latest un-expired access token saved in the database"""
+    latest_token = get_latest_access_token_record()
 
-def get_b2c_settings(b2c_settings: Document) -> tuple[str, str, str]:
-    """Gets the consumer key, secret, and authorization url from the MPesa B2C Settings doctype"""
-    consumer_key = b2c_settings.get("consumer_key")
-    authorization_url = b2c_settings.get("authorization_url")
-    consumer_secret = get_decrypted_password(
-        MPESA_B2C_SETTINGS_DOCTYPE, MPESA_B2C_SETTINGS_DOCTYPE, "consumer_secret"
+    if not latest_token:
+        return None
+
+    bearer_token = get_decrypted_password(
+        DARAJA_ACCESS_TOKENS_DOCTYPE, latest_token.name, "access_token"
+    )
+    return AccessToken(bearer_token, latest_token.expiry_time)
+
+
+def fetch_access_token() -> AccessToken:
+    """
+    Fetches a new access token from the authorization url specified in the MPesa B2C Settings
+    and saves it to the database
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+
+    response, _ = get_access_tokens(
+        b2c_settings.consumer_key,
+        b2c_settings.consumer_secret,
+        b2c_settings.authorization_url,
+    )
+
+    return save_access_token(response)
+
+
+def enqueue_access_token_refresh() -> None:
+    """Queues a single background fetch of a new access token"""
+    frappe.enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.mpesa_b2c_payment.refresh_access_token_before_expiry",
+        queue="short",
+        job_id="mpesa_b2c_access_token_refresh",
+        deduplicate=True,
+    )
+
+
+access_token_provider = AccessTokenProvider(
+    load_stored_access_token, fetch_access_token, enqueue_access_token_refresh
+)
+
+
+def refresh_access_token_before_expiry() -> None:
+    """
+    Scheduled job that fetches a new access token once the latest stored token is within
+    the Token Refresh Margin set in the MPesa B2C Settings of expiring. Margins shorter
+    than the token provider's own expiry margin are raised to it.
+    This keeps token fetches off the payment request path.
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+
+    if not b2c_settings.consumer_key:
+        return
+
+    # A token is refreshed no later than the provider stops serving it
+    refresh_margin = max(
+        b2c_settings.token_refresh_margin or DEFAULT_TOKEN_REFRESH_MARGIN,
+        TOKEN_EXPIRY_MARGIN,
+    )
+    latest_token = get_latest_access_token_record()
+
+    if latest_token and latest_token.expiry_time - datetime.timedelta(
+        seconds=refresh_margin
+    ) > datetime.datetime.now():
+        return
+
+    refresh_start = time.perf_counter()
+    try:
+        access_token = access_token_provider.refresh(force=True)
+
+    except Exception:
+        increment_counter("token_refresh_failures")
+        app_logger.exception("Exception Encountered when refreshing access token")
+        raise
+
+    record_metric("token_refresh_latency", time.perf_counter() - refresh_start)
+    app_logger.info(
+        "Access token refreshed ahead of expiry, new token expires at %s",
+        access_token.expiry_time,
     )
-    return consumer_key, consumer_secret, authorization_url
 
 
 def get_access_tokens(
@@ -186,13 +287,13 @@ def get_access_tokens(
     encoded_credentials = base64.b64encode(keys.encode()).decode()
 
     try:
-        response = requests.get(
+        response = daraja_request(
+            "GET",
             url,
             headers={
                 "Authorization": f"Basic {encoded_credentials}",
                 "Content-Type": "application/json",
             },
-            timeout=60,
         )
 
         response.raise_for_status()  # Raise HTTPError if status code >= 400
@@ -217,6 +318,14 @@ def save_access_token_to_database(response: str) -> str:
     Deserialises the response object and saves the access token to the database,
     returning the access token
     """
+    return save_access_token(response).token
+
+
+def save_access_token(response: str) -> AccessToken:
+    """
+    Deserialises the response object and saves the access token to the database,
+    returning the access token together with its expiry time
+    """
     token_fetch_time = datetime.datetime.now()
     response = json.loads(response)
 
@@ -236,7 +345,7 @@ def save_access_token_to_database(response: str) -> str:
         token_fetch_time,
         expiry_time,
     )
-    return access_token
+    return AccessToken(access_token, expiry_time)
 
 
 def get_certificate_file(certificate_path: str) -> str | Literal[-1]:
@@ -257,7 +366,7 @@ def get_certificate_file(certificate_path: str) -> str | Literal[-1]:
 
 
 def generate_payload(
-    b2c_settings: Document,
+    b2c_settings: B2CSettingsSnapshot | dict,
     partial_payload: dict[str, str | int],
     security_credentials: str,
 ) -> str:
@@ -296,100 +405,6 @@ def get_result_details(results: dict) -> tuple[str, str, str | int, str, str | i
     )
 
 
-def handle_successful_result_response(results: dict) -> Document:
-    """
-    Handles the results callback's responses with a successful ResultCode, i.e. ResultCode of 0
-    """
-    mpesa_b2c_payment_document = frappe.db.get_value(
-        MPESA_B2C_PAYMENT_DOCTYPE,
-        {"originatorconversationid": results.get("OriginatorConversationID")},
-        ["name", "account_paid_from", "account_paid_to"],
-        as_dict=True,
-    )
-
-    result_parameters = results.get("ResultParameters").get("ResultParameter")
-    transaction_values = extract_transaction_values(
-        result_parameters, results.get("TransactionID")
-    )
-    transaction_values.update(
-        {
-            "b2c_payment_name": mpesa_b2c_payment_document.name,
-            "account_paid_from": mpesa_b2c_payment_document.account_paid_from,
-            "account_paid_to": mpesa_b2c_payment_document.account_paid_to,
-        }
-    )
-
-    update_doctype_single_values(
-        MPESA_B2C_PAYMENT_DOCTYPE, mpesa_b2c_payment_document, "status", "Paid"
-    )
-
-    transaction = save_transaction_to_database(
-        MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE, transaction_values
-    )
-
-    frappe.response["transaction"] = transaction
-    return transaction
-
-
-def handle_unsuccessful_result_response(
-    transaction_id: str,
-    originator_conversation_id: str,
-    result_code: int,
-    results_description: str,
-) -> None:
-    """
-    Handles the results callback's responses with an unsuccessful ResultCode, i.e. ResultCode != 0
-    """
-    mpesa_b2c_payment_document = frappe.db.get_value(
-        MPESA_B2C_PAYMENT_DOCTYPE,
-        {"originatorconversationid": originator_conversation_id},
-        ["name"],
-        as_dict=True,
-    )
-
-    app_logger.info(
-        "Transaction %s from B2C Payment %s Errored with code: %s, description: %s",
-        transaction_id,
-        mpesa_b2c_payment_document.name,
-        result_code,
-        results_description,
-    )
-    update_doctype_single_values(
-        MPESA_B2C_PAYMENT_DOCTYPE, mpesa_b2c_payment_document, "status", "Errored"
-    )
-    update_doctype_single_values(
-        MPESA_B2C_PAYMENT_DOCTYPE, mpesa_b2c_payment_document, "error_code", result_code
-    )
-    update_doctype_single_values(
-        MPESA_B2C_PAYMENT_DOCTYPE,
-        mpesa_b2c_payment_document,
-        "error_description",
-        results_description,
-    )
-
-
-def handle_duplicate_request(originator_conversation_id: str) -> None:
-    """
-    Logs instances where multiple requests from same B2C payment record are initiated.
-    Normally, only one payment can be initiated from the client.
-    """
-    mpesa_b2c_payment = frappe.db.get_value(
-        MPESA_B2C_PAYMENT_DOCTYPE,
-        {"originatorconversationid": originator_conversation_id},
-        ["name"],
-        as_dict=True,
-    )
-    frappe.msgprint(
-        "Duplicate request encountered!",
-        title="Duplicate Request Error",
-        indicator="orange",
-    )
-    app_logger.info(
-        "Duplicate Request Encountered for B2C Payment record: %s",
-        mpesa_b2c_payment.name,
-    )
-
-
 def extract_transaction_values(
     result_parameters: dict, transaction_id: str
 ) -> dict[str, str | int]:
@@ -400,50 +415,20 @@ def extract_transaction_values(
     B2CChargesPaidAccountAvailableFunds, ReceiverPartyPublicName, TransactionCompletedDateTime,
     B2CUtilityAccountAvailableFunds, B2CWorkingAccountAvailableFunds
     """
-    transaction_values = {}
-
-    for item in result_parameters:
-        if item["Key"] == "TransactionAmount":
-            transaction_values["transaction_amount"] = item["Value"]
-
-        elif item["Key"] == "TransactionReceipt" and item["Value"] == transaction_id:
-            transaction_values["transaction_id"] = item["Value"]
-
-        elif item["Key"] == "B2CRecipientIsRegisteredCustomer":
-            transaction_values["recipient_is_registered_customer"] = item["Value"]
-
-        elif item["Key"] == "B2CChargesPaidAccountAvailableFunds":
-            transaction_values["charges_paid_acct_avlbl_funds"] = item["Value"]
-
-        elif item["Key"] == "ReceiverPartyPublicName":
-            transaction_values["receiver_public_name"] = item["Value"]
-
-        elif item["Key"] == "TransactionCompletedDateTime":
-            transaction_datetime = datetime.datetime.strptime(
-                item["Value"], "%d.%m.%Y %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            transaction_values["transaction_completed_datetime"] = transaction_datetime
-
-        elif item["Key"] == "B2CUtilityAccountAvailableFunds":
-            transaction_values["utility_acct_avlbl_funds"] = item["Value"]
-
-        elif item["Key"] == "B2CWorkingAccountAvailableFunds":
-            transaction_values["working_acct_avlbl_funds"] = item["Value"]
-
-    return transaction_values
+    return parse_result_parameters(result_parameters, transaction_id)
 
 
 def send_payload(payload: str, access_token: str, url: str) -> tuple[str, int]:
     """Sends request to payment processing url with payload"""
     try:
-        response = requests.post(
+        response = daraja_request(
+            "POST",
             url,
             data=payload,
             headers={
                 "Authorization": f"Bearer {access_token}",
                 "Content-Type": "application/json",
             },
-            timeout=60,
         )
 
         response.raise_for_status()  # Raise HTTPError if status code >= 400
@@ -466,7 +451,7 @@ def send_payload(payload: str, access_token: str, url: str) -> tuple[str, int]:
 
 def make_payment(
     bearer_token: str,
-    b2c_settings: Document,
+    b2c_settings: B2CSettingsSnapshot,
     partial_payload: dict[str, str | int],
     payment_document: Document,
 ) -> None:
@@ -474,25 +459,23 @@ def make_payment(
     Handles making the Payment request.
     This function sends the final response to the client after initiating the payment request.
     """
-    initiator_password = get_decrypted_password(
-        MPESA_B2C_SETTINGS_DOCTYPE, MPESA_B2C_SETTINGS_DOCTYPE, "initiator_password"
-    )
     payment_url = b2c_settings.get("payment_url")
-    certificate_relative_path = b2c_settings.get("certificate_file")
 
-    certificate = get_certificate_file(certificate_relative_path)
-
-    if isinstance(certificate, str):
-        security_credentials = openssl_encrypt_encode(
-            initiator_password.encode(), certificate
-        )[8:].decode()
+    security_credentials = get_security_credential(b2c_settings)
 
+    if security_credentials:
         payload = generate_payload(b2c_settings, partial_payload, security_credentials)
 
         response, status_code = send_payload(payload, bearer_token, payment_url)
+        conversation_id = get_conversation_id(response)
 
-        update_doctype_single_values(
-            MPESA_B2C_PAYMENT_DOCTYPE, payment_document, "status", "Pending"
+        update_payment_status(
+            payment_document.name, status="Pending", conversationid=conversation_id
+        )
+        remember_payment(
+            payment_document.name,
+            partial_payload.get("OriginatorConversationID"),
+            conversation_id,
         )
 
         app_logger.info(
@@ -512,45 +495,87 @@ def make_payment(
     return
 
 
-def update_doctype_single_values(
-    doctype: str, document_to_update: Document, field: str, new_value: str
-) -> None:
+def get_conversation_id(response: str | None) -> str | None:
+    """Returns the ConversationID Safaricom assigned in its response to a payment request"""
+    try:
+        return json.loads(response).get("ConversationID")
+
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def update_payment_status(payment_name: str, **fields: Any) -> None:
     """
-    Updates the specified doctype's field with the specified values.
-    Note: Only one field is updated at a time
+    Updates any set of the B2C Payment's fields, e.g. status, error_code and
+    error_description, with a single statement and a single modified bump
     """
     frappe.db.set_value(
-        doctype, document_to_update.name, field, new_value, update_modified=True
+        MPESA_B2C_PAYMENT_DOCTYPE, payment_name, fields, update_modified=True
     )
 
     app_logger.info(
-        "%s's %s's %s updated to %s",
-        doctype,
-        document_to_update.name,
-        field,
-        new_value,
+        "%s's %s updated with %s", MPESA_B2C_PAYMENT_DOCTYPE, payment_name, fields
     )
 
 
+def bulk_update_payment_status(updates: dict[str, dict[str, Any]]) -> None:
+    """
+    Applies the field updates of many B2C Payments, given as {payment name: {field: value}},
+    with one UPDATE per BULK_UPDATE_BATCH_SIZE payments.
+    Each field is set through a CASE on the payment's name, so payments may receive
+    different fields and values in the same statement.
+    """
+    payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE)
+    payment_names = list(updates)
+
+    for start in range(0, len(payment_names), BULK_UPDATE_BATCH_SIZE):
+        batch = payment_names[start : start + BULK_UPDATE_BATCH_SIZE]
+        fields = {field for name in batch for field in updates[name]}
+
+        query = (
+            frappe.qb.update(payment)
+            .set(payment.modified, now_datetime())
+            .set(payment.modified_by, frappe.session.user)
+            .where(payment.name.isin(batch))
+        )
+
+        for field in sorted(fields):
+            values = Case()
+
+            for name in batch:
+                if field in updates[name]:
+                    values = values.when(payment.name == name, updates[name][field])
+
+            query = query.set(payment[field], values.else_(payment[field]))
+
+        query.run()
+
+    app_logger.info("%s B2C Payments updated in bulk", len(payment_names))
+
+
 def save_transaction_to_database(
     doctype: str,
     update_values: dict[str, str | int | float],
+    b2c_payment: dict | None = None,
 ) -> Document:
     """
     Saves the transaction details to database as an MPesa B2C Payments Transactions record
-    after successful B2C Payment and returns the record
+    after successful B2C Payment and returns the record.
+    The B2C Payment's fields, if already loaded, are passed on so the transaction's
+    validation does not read them again.
     """
     update_values.update({"doctype": doctype})
 
     transaction = frappe.get_doc(update_values)
+    transaction.flags.b2c_payment = b2c_payment
     transaction.insert(ignore_permissions=True)
 
     app_logger.info(
         "Transaction ID: %s, originator conversation id: %s, amount: %s, transaction time: %s saved.",
-        update_values["transaction_id"],
-        update_values["b2c_payment_name"],
-        update_values["transaction_amount"],
-        update_values["transaction_completed_datetime"],
+        update_values.get("transaction_id"),
+        update_values.get("b2c_payment_name"),
+        update_values.get("transaction_amount"),
+        update_values.get("transaction_completed_datetime"),
     )
 
     return transaction
@@ -0,0 +1,243 @@
+"""Server side resolution of the items an MPesa B2C Payment pays against records"""
+
+import datetime
+from typing import Final, NamedTuple
+
+import frappe
+from frappe.query_builder import Order
+from frappe.query_builder.functions import Coalesce
+from pypika.terms import ExistsCriterion
+from frappe.utils import cint, getdate
+
+from .. import app_logger
+from ..custom_exceptions import UnsupportedReferenceDoctypeError
+from .mpesa_b2c_payment import sanitise_phone_number
+
+MPESA_B2C_PAYMENT_DOCTYPE: Final[str] = "MPesa B2C Payment"
+MPESA_B2C_PAYMENT_ITEM_DOCTYPE: Final[str] = "MPesa B2C Employee Payment Item"
+DEFAULT_PAGE_LENGTH: Final[int] = 500
+MAX_PAGE_LENGTH: Final[int] = 2000
+
+# Statuses of payments that are paying, or have paid, their record
+LIVE_PAYMENT_STATUSES: Final[tuple[str, ...]] = (
+    "Not Initiated",
+    "Sending",
+    "Pending",
+    "Paid",
+)
+
+
+class ItemSource(NamedTuple):
+    """The date, receiver and amount fields of a doctype payments can be made against"""
+
+    date_field: str
+    party_type: str
+    party_field: str
+    amount_field: str
+    # Set for doctypes whose party may be of any party type
+    party_type_field: str | None = None
+
+
+# Records are selected on the date they are posted for, or for Salary Slips, the end
+# of the period they pay, as indexed by the add_payment_selection_indexes patch
+ITEM_SOURCES: Final[dict[str, ItemSource]] = {
+    "Salary Slip": ItemSource("end_date", "Employee", "employee", "base_rounded_total"),
+    "Expense Claim": ItemSource("posting_date", "Employee", "employee", "grand_total"),
+    "Employee Advance": ItemSource(
+        "posting_date", "Employee", "employee", "advance_amount"
+    ),
+    "Purchase Invoice": ItemSource(
+        "posting_date", "Supplier", "supplier", "base_rounded_total"
+    ),
+    "Payment Entry": ItemSource(
+        "posting_date", "Supplier", "party", "paid_amount", "party_type"
+    ),
+}
+
+
+@frappe.whitelist()
+def get_payment_items(
+    doctype: str,
+    start_date: str,
+    end_date: str,
+    after_date: str | None = None,
+    after_name: str | None = None,
+    page_length: int = DEFAULT_PAGE_LENGTH,
+) -> dict[str, list[dict] | dict | None]:
+    """
+    Returns a page of the items paying the doctype's submitted records dated within
+    the period, and not already paid, or being paid, through another submitted
+    MPesa B2C Payment.
+    Each record's receiver, sanitised phone number (partyb) and amount are resolved.
+    Returned as {"items": [...], "next": {"after_date": ..., "after_name": ...}},
+    where next, if not None, holds the arguments fetching the following page.
+    Employees' numbers are read through a join on the records' query, and suppliers'
+    from their contacts with one further query per page.
+    """
+    source = ITEM_SOURCES.get(doctype)
+    if source is None:
+        error = f"B2C Payments cannot be made against {doctype} records"
+        app_logger.error(error)
+        raise UnsupportedReferenceDoctypeError(error)
+
+    frappe.has_permission(doctype, "read", throw=True)
+
+    page_length = min(cint(page_length) or DEFAULT_PAGE_LENGTH, MAX_PAGE_LENGTH)
+    records = get_records(
+        doctype,
+        source,
+        getdate(start_date),
+        getdate(end_date),
+        (getdate(after_date), after_name) if after_date and after_name else None,
+        page_length + 1,
+    )
+    has_more = len(records) > page_length
+    records = records[:page_length]
+
+    if source.party_type == "Supplier":
+        phone_numbers = get_supplier_phone_numbers({record.party for record in records})
+
+        for record in records:
+            record.phone_number = phone_numbers.get(record.party)
+
+    return {
+        "items": [
+            {
+                "reference_doctype": doctype,
+                "record": record.name,
+                "receiver_name": record.party,
+                "partyb": sanitise_phone_number(record.phone_number or ""),
+                "record_amount": record.amount,
+                "amount": record.amount,
+            }
+            for record in records
+        ],
+        "next": (
+            {"after_date": str(records[-1].date), "after_name": records[-1].name}
+            if has_more
+            else None
+        ),
+    }
+
+
+def get_records(
+    doctype: str,
+    source: ItemSource,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    after: tuple[datetime.date, str] | None,
+    limit: int,
+) -> list[dict]:
+    """
+    Returns up to limit of the doctype's unpaid, submitted records dated within the
+    period, ordered by date and name and resuming after the given (date, name),
+    with their party and amount, and for employees, the employee's cell number.
+    The range and order are served by the (docstatus, date, name) index.
+    A record is unpaid unless an item of a submitted payment is yet to be sent, or
+    its item payment is live or has a retry scheduled. Records whose payment Errored,
+    or Timed-Out with its retries used up, or whose item was skipped for an invalid
+    receiver number, can be paid again.
+    """
+    record = frappe.qb.DocType(doctype)
+    item = frappe.qb.DocType(MPESA_B2C_PAYMENT_ITEM_DOCTYPE)
+    payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE)
+    item_payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE).as_("item_payment")
+    date = record[source.date_field]
+
+    already_paid = (
+        frappe.qb.from_(item)
+        .join(payment)
+        .on(payment.name == item.parent)
+        .left_join(item_payment)
+        .on(item_payment.name == item.b2c_payment)
+        .select(item.name)
+        .where(item.reference_doctype == doctype)
+        .where(item.record == record.name)
+        .where(payment.docstatus == 1)
+        .where(
+            (
+                (Coalesce(item.b2c_payment, "") == "")
+                & (Coalesce(item.error, "") == "")
+            )
+            | item_payment.status.isin(LIVE_PAYMENT_STATUSES)
+            | (
+                (item_payment.status == "Timed-Out")
+                & item_payment.next_retry_at.isnotnull()
+            )
+        )
+    )
+
+    query = (
+        frappe.qb.from_(record)
+        .select(
+            record.name,
+            date.as_("date"),
+            record[source.party_field].as_("party"),
+            record[source.amount_field].as_("amount"),
+        )
+        .where(record.docstatus == 1)
+        .where(date.between(start_date, end_date))
+        .where(ExistsCriterion(already_paid).negate())
+        .orderby(date)
+        .orderby(record.name)
+        .limit(limit)
+    )
+
+    if after is not None:
+        after_date, after_name = after
+        query = query.where(
+            (date > after_date) | ((date == after_date) & (record.name > after_name))
+        )
+
+    if source.party_type_field:
+        query = query.where(record[source.party_type_field] == source.party_type)
+
+    if source.party_type == "Employee":
+        employee = frappe.qb.DocType("Employee")
+        query = query.left_join(employee).on(
+            employee.name == record[source.party_field]
+        )
+        query = query.select(employee.cell_number.as_("phone_number"))
+
+    return query.run(as_dict=True)
+
+
+def add_selection_indexes() -> None:
+    """
+    Adds the (docstatus, date, name) index each doctype's records are selected through,
+    for the doctypes installed on the site
+    """
+    for doctype, source in ITEM_SOURCES.items():
+        if frappe.db.table_exists(doctype):
+            frappe.db.add_index(doctype, ["docstatus", source.date_field, "name"])
+
+
+def get_supplier_phone_numbers(suppliers: set[str]) -> dict[str, str]:
+    """
+    Returns each supplier's phone number from its contacts, linked through
+    Dynamic Links, preferring the primary contact and its mobile number
+    """
+    if not suppliers:
+        return {}
+
+    contact = frappe.qb.DocType("Contact")
+    link = frappe.qb.DocType("Dynamic Link")
+
+    contacts = (
+        frappe.qb.from_(link)
+        .join(contact)
+        .on(contact.name == link.parent)
+        .select(link.link_name, contact.mobile_no, contact.phone)
+        .where(link.parenttype == "Contact")
+        .where(link.link_doctype == "Supplier")
+        .where(link.link_name.isin(list(suppliers)))
+        .orderby(contact.is_primary_contact, order=Order.desc)
+        .orderby(contact.creation)
+    ).run(as_dict=True)
+
+    phone_numbers = {}
+    for row in contacts:
+        if row.link_name not in phone_numbers and (row.mobile_no or row.phone):
+            phone_numbers[row.link_name] = row.mobile_no or row.phone
+
+    return phone_numbers
@@ -0,0 +1,85 @@
+"""Cached lookup of B2C Payments by the conversation IDs Safaricom reports back"""
+
+from collections import OrderedDict
+from typing import Final
+
+import frappe
+
+PAYMENT_LOOKUP_KEY: Final[str] = "navari_mpesa_b2c:payment_lookup"
+PAYMENT_LOOKUP_TTL: Final[int] = 7 * 24 * 60 * 60
+LOCAL_CACHE_SIZE: Final[int] = 1024
+
+# (site, field, conversation ID) -> payment name, least recently used first
+_payment_names: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+
+
+def get_cached_payment_name(
+    originator_conversation_id: str | None = None, conversation_id: str | None = None
+) -> str | None:
+    """
+    Returns the cached name of the B2C Payment with the given OriginatorConversationID,
+    or failing that, ConversationID, from this worker's LRU cache, then from Redis.
+    Entries are dropped when a payment is settled, retried under a new ID or deleted,
+    but another worker's LRU may still hold them, so callers check the payment found
+    still carries the ID.
+    """
+    for field, value in (
+        ("originatorconversationid", originator_conversation_id),
+        ("conversationid", conversation_id),
+    ):
+        if not value:
+            continue
+
+        local_key = (frappe.local.site, field, value)
+        if local_key in _payment_names:
+            _payment_names.move_to_end(local_key)
+            return _payment_names[local_key]
+
+        name = frappe.cache().get_value(get_lookup_key(field, value))
+        if name is not None:
+            remember_locally(local_key, name)
+            return name
+
+    return None
+
+
+def remember_payment(
+    name: str,
+    originator_conversation_id: str | None,
+    conversation_id: str | None = None,
+) -> None:
+    """Caches the payment's name under its conversation IDs, e.g. once it is sent"""
+    for field, value in (
+        ("originatorconversationid", originator_conversation_id),
+        ("conversationid", conversation_id),
+    ):
+        if value:
+            frappe.cache().set_value(
+                get_lookup_key(field, value), name, expires_in_sec=PAYMENT_LOOKUP_TTL
+            )
+            remember_locally((frappe.local.site, field, value), name)
+
+
+def forget_payment(
+    originator_conversation_id: str | None, conversation_id: str | None = None
+) -> None:
+    """Drops the payment's cached conversation IDs"""
+    for field, value in (
+        ("originatorconversationid", originator_conversation_id),
+        ("conversationid", conversation_id),
+    ):
+        if value:
+            frappe.cache().delete_value(get_lookup_key(field, value))
+            _payment_names.pop((frappe.local.site, field, value), None)
+
+
+def get_lookup_key(field: str, value: str) -> str:
+    return f"{PAYMENT_LOOKUP_KEY}:{field}:{value}"
+
+
+def remember_locally(local_key: tuple[str, str, str], name: str) -> None:
+    _payment_names[local_key] = name
+    _payment_names.move_to_end(local_key)
+
+    if len(_payment_names) > LOCAL_CACHE_SIZE:
+        _payment_names.popitem(last=False)
@@ -0,0 +1,138 @@
+"""Cluster-wide token bucket limiting the rate of requests sent to Daraja"""
+
+import asyncio
+import time
+from typing import Final
+
+import frappe
+
+from .. import app_logger
+from ..custom_exceptions import RateLimitExceededError
+from ..metrics import record_metric
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+
+RATE_LIMIT_KEY: Final[str] = "navari_mpesa_b2c:rate_limit"
+DEFAULT_MAX_WAIT: Final[float] = 60.0
+
+# Refills the bucket for the time elapsed since the last request, by Redis' clock so all
+# workers agree, then takes a token if one is available.
+# Returns 0 when a token was taken, otherwise the milliseconds until one is available.
+TOKEN_BUCKET_SCRIPT: Final[str] = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+
+return wait
+"""
+
+_token_bucket_script = None
+
+
+def get_rate_limit() -> tuple[float, int] | None:
+    """
+    Returns the requests per second and burst size set in the MPesa B2C Settings,
+    or None if rate limiting is disabled
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+
+    if not b2c_settings.rate_limit_tps:
+        return None
+
+    return (
+        b2c_settings.rate_limit_tps,
+        b2c_settings.rate_limit_burst or max(1, int(b2c_settings.rate_limit_tps)),
+    )
+
+
+def get_bucket_key() -> str:
+    """Returns the bucket's key, shared by every worker sending for the organisation's shortcode"""
+    return frappe.cache().make_key(
+        f"{RATE_LIMIT_KEY}:{get_b2c_settings_snapshot().organisation_shortcode}"
+    )
+
+
+def try_acquire(key: str, rate: float, burst: int) -> float:
+    """
+    Takes a token from the bucket stored at key.
+    Returns 0 if a token was taken, otherwise the seconds to wait before trying again.
+    """
+    global _token_bucket_script
+
+    if _token_bucket_script is None:
+        _token_bucket_script = frappe.cache().register_script(TOKEN_BUCKET_SCRIPT)
+
+    wait = _token_bucket_script(keys=[key], args=[rate, burst])
+
+    return int(wait) / 1000
+
+
+def acquire(max_wait: float = DEFAULT_MAX_WAIT) -> float:
+    """
+    Blocks until the rate limit allows another request to Daraja.
+    Returns the seconds waited, and raises RateLimitExceededError if
+    a request could not be sent within max_wait seconds.
+    """
+    rate_limit = get_rate_limit()
+    if rate_limit is None:
+        return 0.0
+
+    key, started = get_bucket_key(), time.monotonic()
+
+    while wait := try_acquire(key, *rate_limit):
+        check_wait(started, wait, max_wait)
+        time.sleep(wait)
+
+    return record_wait(started)
+
+
+async def acquire_async(max_wait: float = DEFAULT_MAX_WAIT) -> float:
+    """As acquire, but yields to the event loop rather than blocking while waiting"""
+    rate_limit = get_rate_limit()
+    if rate_limit is None:
+        return 0.0
+
+    key, started = get_bucket_key(), time.monotonic()
+
+    while wait := try_acquire(key, *rate_limit):
+        check_wait(started, wait, max_wait)
+        await asyncio.sleep(wait)
+
+    return record_wait(started)
+
+
+def check_wait(started: float, wait: float, max_wait: float) -> None:
+    """Raises RateLimitExceededError if waiting wait more seconds would exceed max_wait"""
+    if time.monotonic() - started + wait > max_wait:
+        error = f"Daraja rate limit not available within {max_wait} seconds"
+        app_logger.error(error)
+        raise RateLimitExceededError(error)
+
+
+def record_wait(started: float) -> float:
+    """Records the seconds spent waiting for the rate limit since started"""
+    waited = time.monotonic() - started
+    record_metric("rate_limiter_wait", waited)
+
+    return waited
@@ -0,0 +1,90 @@
+"""Table driven parsing of the ResultParameters of successful B2C Payment Results"""
+
+import datetime
+from typing import Callable, Final, Iterable
+
+# ResultParameter Key -> MPesa B2C Payments Transactions field
+RESULT_PARAMETER_FIELDS: Final[dict[str, str]] = {
+    "TransactionAmount": "transaction_amount",
+    "TransactionReceipt": "transaction_id",
+    "B2CRecipientIsRegisteredCustomer": "recipient_is_registered_customer",
+    "B2CChargesPaidAccountAvailableFunds": "charges_paid_acct_avlbl_funds",
+    "ReceiverPartyPublicName": "receiver_public_name",
+    "TransactionCompletedDateTime": "transaction_completed_datetime",
+    "B2CUtilityAccountAvailableFunds": "utility_acct_avlbl_funds",
+    "B2CWorkingAccountAvailableFunds": "working_acct_avlbl_funds",
+}
+TRANSACTION_FIELDS: Final[tuple[str, ...]] = tuple(RESULT_PARAMETER_FIELDS.values())
+
+SAFARICOM_DATETIME_FORMAT: Final[str] = "%d.%m.%Y %H:%M:%S"
+
+
+def decode_completed_datetime(value: str) -> str:
+    """
+    Converts Safaricom's "dd.mm.YYYY HH:MM:SS" to "YYYY-mm-dd HH:MM:SS.000".
+    The usual zero padded value is rearranged by slicing. Anything else goes through strptime.
+    """
+    if (
+        len(value) == 19
+        and value[2] == value[5] == "."
+        and value[10] == " "
+        and value[13] == value[16] == ":"
+        and (value[0:2] + value[3:5] + value[6:10]).isdigit()
+        and (value[11:13] + value[14:16] + value[17:19]).isdigit()
+    ):
+        return f"{value[6:10]}-{value[3:5]}-{value[0:2]} {value[11:19]}.000"
+
+    return datetime.datetime.strptime(value, SAFARICOM_DATETIME_FORMAT).strftime(
+        "%Y-%m-%d %H:%M:%S.%f"
+    )[:-3]
+
+
+VALUE_DECODERS: Final[dict[str, Callable[[str], str]]] = {
+    "TransactionCompletedDateTime": decode_completed_datetime,
+}
+
+
+def parse_result_parameters(
+    result_parameters: list[dict], transaction_id: str
+) -> dict[str, str | int]:
+    """
+    Returns the transaction fields found in a Result's ResultParameters.
+    The TransactionReceipt is only kept if it matches the Result's TransactionID.
+    """
+    transaction_values = {}
+
+    for item in result_parameters:
+        key = item["Key"]
+        field = RESULT_PARAMETER_FIELDS.get(key)
+
+        if field is None:
+            continue
+
+        value = item["Value"]
+
+        if key == "TransactionReceipt" and value != transaction_id:
+            continue
+
+        decoder = VALUE_DECODERS.get(key)
+        transaction_values[field] = decoder(value) if decoder else value
+
+    return transaction_values
+
+
+def parse_results_batch(results: Iterable[dict]) -> dict[str, list]:
+    """
+    Parses many successful Results, e.g. when replaying stored callbacks, into columns:
+    one list per transaction field, holding each Result's value or None, in order.
+    Rows for bulk inserts are then zip(*columns.values()).
+    """
+    columns: dict[str, list] = {field: [] for field in TRANSACTION_FIELDS}
+
+    for result in results:
+        transaction_values = parse_result_parameters(
+            result["ResultParameters"]["ResultParameter"], result.get("TransactionID")
+        )
+
+        for field, column in columns.items():
+            column.append(transaction_values.get(field))
+
+    return columns
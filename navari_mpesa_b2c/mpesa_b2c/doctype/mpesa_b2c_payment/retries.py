@@ -0,0 +1,147 @@
+"""Scheduled re-initiation of B2C Payments that timed out in Safaricom's queue"""
+
+import datetime
+import random
+from typing import Final
+from uuid import uuid4
+
+import frappe
+
+from .. import app_logger
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+from .bulk_dispatcher import dispatch_payments, get_request_credentials
+from .bulk_payment import DEFAULT_BULK_CHUNK_SIZE
+from .mpesa_b2c_payment import (
+    MPESA_B2C_PAYMENT_DOCTYPE,
+    bulk_update_payment_status,
+)
+from .payment_lookup import forget_payment
+
+DEFAULT_MAX_RETRY_ATTEMPTS: Final[int] = 3
+DEFAULT_RETRY_BASE_DELAY: Final[int] = 60
+
+
+def get_timeout_updates(payments: list[dict]) -> dict[str, dict]:
+    """
+    Returns the updates moving timed out payments to Timed-Out, each with its retry
+    scheduled after an exponential backoff with jitter.
+    Payments that have used up their retry attempts are left Timed-Out with no retry.
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+    max_attempts = b2c_settings.max_retry_attempts or DEFAULT_MAX_RETRY_ATTEMPTS
+    base_delay = b2c_settings.retry_base_delay or DEFAULT_RETRY_BASE_DELAY
+    now = datetime.datetime.now()
+
+    updates = {}
+    for payment in payments:
+        attempts = payment.retry_attempts or 0
+        next_retry_at = None
+
+        if attempts < max_attempts:
+            next_retry_at = now + datetime.timedelta(
+                seconds=get_retry_delay(attempts, base_delay)
+            )
+        else:
+            app_logger.error(
+                "B2C Payment record: %s timed out after %s retries, not retrying",
+                payment.name,
+                attempts,
+            )
+
+        updates[payment.name] = {"status": "Timed-Out", "next_retry_at": next_retry_at}
+
+    return updates
+
+
+def get_retry_delay(attempts: int, base_delay: float) -> float:
+    """
+    Returns the seconds to wait before retrying a payment already retried attempts
+    times: between half and all of the base delay doubled per attempt, picked at
+    random so payments timing out together are not all retried at the same moment.
+    """
+    delay = base_delay * 2**attempts
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_timed_out_payments() -> None:
+    """
+    Re-initiates, in batches through the bulk dispatcher, the Timed-Out payments
+    whose retry is due. Each retry is sent under a new OriginatorConversationID,
+    committed, with its attempt count and the payment set Sending, before the
+    request is sent. The credentials are built first, so a retry that cannot be
+    sent is never left Sending.
+    Runs from the scheduler.
+    """
+    batch_size = (
+        get_b2c_settings_snapshot().bulk_chunk_size or DEFAULT_BULK_CHUNK_SIZE
+    )
+
+    while payments := frappe.get_all(
+        MPESA_B2C_PAYMENT_DOCTYPE,
+        filters={
+            "status": "Timed-Out",
+            "next_retry_at": ["<=", datetime.datetime.now()],
+        },
+        fields=[
+            "name",
+            "originatorconversationid",
+            "commandid",
+            "amount",
+            "partyb",
+            "remarks",
+            "occassion",
+            "retry_attempts",
+            "next_retry_at",
+        ],
+        order_by="next_retry_at",
+        limit=batch_size,
+    ):
+        # Raises, with the retries still scheduled, if no access token is cached
+        credentials = get_request_credentials()
+        if credentials is None:
+            # Nothing can be sent, e.g. no certificate file
+            return
+
+        updates = {
+            payment.name: {
+                "status": "Sending",
+                "originatorconversationid": str(uuid4()),
+                "retry_attempts": (payment.retry_attempts or 0) + 1,
+                "next_retry_at": None,
+            }
+            for payment in payments
+        }
+        bulk_update_payment_status(updates)
+        # Persist the new IDs, and the payments as in flight, before any request goes
+        # out, so the Result of a retry always finds its payment
+        frappe.db.commit()  # nosemgrep
+
+        for payment in payments:
+            # Results for the previous ID are no longer expected
+            forget_payment(payment.originatorconversationid)
+            payment.originatorconversationid = updates[payment.name][
+                "originatorconversationid"
+            ]
+
+        outcomes = dispatch_payments(payments, credentials=credentials)
+        unsent = {outcome.name for outcome in outcomes if not outcome.sent}
+
+        if unsent:
+            # Keep the retries that were not sent scheduled, and stop until the next run
+            bulk_update_payment_status(
+                {
+                    payment.name: {
+                        "status": "Timed-Out",
+                        "retry_attempts": payment.retry_attempts or 0,
+                        "next_retry_at": payment.next_retry_at,
+                    }
+                    for payment in payments
+                    if payment.name in unsent
+                }
+            )
+            frappe.db.commit()  # nosemgrep
+            return
+
+        frappe.db.commit()  # nosemgrep
+        app_logger.info("Retried %s timed out B2C Payments", len(payments))
@@ -0,0 +1,91 @@
+"""Caches the SecurityCredential sent with B2C payment requests"""
+
+import hashlib
+from typing import TYPE_CHECKING, Final
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils.file_manager import get_file_path
+
+from .. import app_logger
+from .encoding_credentials import RSAPublicKey, load_public_key, rsa_encrypt_encode
+
+if TYPE_CHECKING:
+    from ..mpesa_b2c_settings.mpesa_b2c_settings import B2CSettingsSnapshot
+
+SECURITY_CREDENTIAL_KEY: Final[str] = "navari_mpesa_b2c:security_credential"
+SECURITY_CREDENTIAL_TTL: Final[int] = 24 * 60 * 60
+
+# Per site: the settings version the credential was generated for, and the credential
+_security_credentials: dict[str, tuple[str, str]] = {}
+
+# Parsed public keys by certificate hash
+_public_keys: dict[str, RSAPublicKey] = {}
+
+
+def get_security_credential(b2c_settings: "B2CSettingsSnapshot") -> str | None:
+    """
+    Returns the SecurityCredential for the initiator password and certificate file
+    in the given settings, or None if no certificate file is found.
+    The credential is the initiator password RSA encrypted with the certificate's
+    public key. It is generated once per (certificate hash, settings version) and shared
+    by all workers through Redis, so neither the certificate nor the encryption is
+    touched on every payment.
+    """
+    cached = _security_credentials.get(frappe.local.site)
+    if cached is not None and cached[0] == b2c_settings.version:
+        return cached[1]
+
+    if not b2c_settings.certificate_file:
+        app_logger.error(
+            "No valid Authentication Certificate file (*.cer or *.pem) found in the server."
+        )
+        return None
+
+    with open(get_file_path(b2c_settings.certificate_file), "rb") as certificate_file:
+        certificate = certificate_file.read()
+
+    certificate_hash = hashlib.sha256(certificate).hexdigest()
+    key = f"{SECURITY_CREDENTIAL_KEY}:{certificate_hash}:{b2c_settings.version}"
+
+    security_credential = frappe.cache().get_value(key)
+    if security_credential is None:
+        security_credential = rsa_encrypt_encode(
+            b2c_settings.initiator_password.encode(),
+            get_public_key(certificate_hash, certificate),
+        ).decode()
+        frappe.cache().set_value(
+            key, security_credential, expires_in_sec=SECURITY_CREDENTIAL_TTL
+        )
+        app_logger.info(
+            "Security credential generated for certificate %s", certificate_hash
+        )
+
+    _security_credentials[frappe.local.site] = (
+        b2c_settings.version,
+        security_credential,
+    )
+    return security_credential
+
+
+def get_public_key(certificate_hash: str, certificate: bytes) -> RSAPublicKey:
+    """Returns the certificate's public key, parsing it only once per certificate"""
+    public_key = _public_keys.get(certificate_hash)
+
+    if public_key is None:
+        public_key = load_public_key(certificate)
+        _public_keys[certificate_hash] = public_key
+
+    return public_key
+
+
+def invalidate_security_credentials(
+    doc: Document | None = None, method: str | None = None
+) -> None:
+    """
+    Drops all cached security credentials.
+    Hooked to the MPesa B2C Settings' on_update event.
+    """
+    _security_credentials.pop(frappe.local.site, None)
+    _public_keys.clear()
+    frappe.cache().delete_keys(SECURITY_CREDENTIAL_KEY)
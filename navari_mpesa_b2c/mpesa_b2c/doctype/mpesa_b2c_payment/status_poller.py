@@ -0,0 +1,284 @@
+"""Reconciliation of Pending B2C Payments through Daraja's Transaction Status API"""
+
+import asyncio
+import datetime
+import json
+from typing import Final, Iterator
+from urllib.parse import urlencode
+
+import frappe
+from frappe.utils import now_datetime
+from pypika.terms import ExistsCriterion
+
+from .. import app_logger
+from ..mpesa_b2c_settings.mpesa_b2c_settings import (
+    B2CSettingsSnapshot,
+    get_b2c_settings_snapshot,
+)
+from .bulk_dispatcher import DEFAULT_MAX_CONCURRENT_REQUESTS, send_payloads
+from .bulk_payment import DEFAULT_BULK_CHUNK_SIZE
+from .http_client import get_timeouts
+from .mpesa_b2c_payment import (
+    MPESA_B2C_PAYMENT_DOCTYPE,
+    accept_callback,
+    access_token_provider,
+    bulk_update_payment_status,
+)
+from .security_credentials import get_security_credential
+
+MPESA_B2C_PAYMENT_ITEM_DOCTYPE: Final[str] = "MPesa B2C Employee Payment Item"
+DEFAULT_STATUS_QUERY_AFTER: Final[int] = 15
+SHORTCODE_IDENTIFIER_TYPE: Final[str] = "4"
+
+# Transaction Status values after which the payment will never be completed
+FAILED_TRANSACTION_STATUSES: Final[frozenset[str]] = frozenset(
+    {"Failed", "Declined", "Cancelled", "Expired"}
+)
+# M-Pesa does not report a ResultCode for failed transactions found by a status query
+FAILED_TRANSACTION_RESULT_CODE: Final[int] = -1
+
+# Transaction Status ResultParameter Key -> payment Result ResultParameter Key
+STATUS_RESULT_PARAMETERS: Final[dict[str, str]] = {
+    "Amount": "TransactionAmount",
+    "ReceiptNo": "TransactionReceipt",
+    "CreditPartyName": "ReceiverPartyPublicName",
+}
+
+
+def poll_pending_payments() -> None:
+    """
+    Queries the status of payments left Pending longer than the Query Pending Payments
+    After setting, in batches sent concurrently within the rate limit.
+    Each queried payment's modified time is bumped, so it is queried again only
+    once it has been Pending that long since.
+    Runs from the scheduler. The results arrive at transaction_status_result_url.
+    """
+    b2c_settings = get_b2c_settings_snapshot()
+
+    if not (
+        b2c_settings.transaction_status_url
+        and b2c_settings.transaction_status_results_url
+    ):
+        return
+
+    security_credential = get_security_credential(b2c_settings)
+    if not security_credential:
+        app_logger.error("No certificate file found in server, status queries aborted")
+        return
+
+    stale_before = now_datetime() - datetime.timedelta(
+        minutes=b2c_settings.status_query_after or DEFAULT_STATUS_QUERY_AFTER
+    )
+
+    for payments in get_stale_pending_payments(
+        stale_before, b2c_settings.bulk_chunk_size or DEFAULT_BULK_CHUNK_SIZE
+    ):
+        payloads = {
+            payment.name: generate_status_query_payload(
+                b2c_settings, payment, security_credential
+            )
+            for payment in payments
+        }
+
+        outcomes = asyncio.run(
+            send_payloads(
+                payloads,
+                access_token_provider.get_token(),
+                b2c_settings.transaction_status_url,
+                b2c_settings.max_concurrent_requests or DEFAULT_MAX_CONCURRENT_REQUESTS,
+                get_timeouts(),
+            )
+        )
+
+        for outcome in outcomes:
+            if not outcome.succeeded:
+                app_logger.error(
+                    "Status query for B2C Payment record: %s failed with: %s",
+                    outcome.name,
+                    outcome.error,
+                )
+
+        # Failed queries are also pushed back, so an unreachable API is not hammered
+        bulk_update_payment_status({outcome.name: {} for outcome in outcomes})
+        frappe.db.commit()  # nosemgrep
+
+        app_logger.info("Queried the status of %s Pending B2C Payments", len(outcomes))
+
+
+def get_stale_pending_payments(
+    stale_before: datetime.datetime, batch_size: int
+) -> Iterator[list[dict]]:
+    """
+    Yields, batch_size at a time, the Pending payments last modified before
+    stale_before. Batches are read through the (status, modified) index,
+    resuming after the last payment yielded, so only one batch is held in memory.
+    Bulk payments are left out: their own request is never sent, each item is
+    paid, and queried, through its own payment.
+    """
+    payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE)
+    item = frappe.qb.DocType(MPESA_B2C_PAYMENT_ITEM_DOCTYPE)
+    has_items = (
+        frappe.qb.from_(item)
+        .select(item.name)
+        .where(item.parent == payment.name)
+        .where(item.parenttype == MPESA_B2C_PAYMENT_DOCTYPE)
+    )
+    last = None
+
+    while True:
+        query = (
+            frappe.qb.from_(payment)
+            .select(payment.name, payment.modified, payment.originatorconversationid)
+            .where(payment.status == "Pending")
+            .where(payment.modified < stale_before)
+            .where(ExistsCriterion(has_items).negate())
+            .orderby(payment.modified)
+            .orderby(payment.name)
+            .limit(batch_size)
+        )
+
+        if last is not None:
+            query = query.where(
+                (payment.modified > last.modified)
+                | ((payment.modified == last.modified) & (payment.name > last.name))
+            )
+
+        payments = query.run(as_dict=True)
+        if not payments:
+            return
+
+        yield payments
+        last = payments[-1]
+
+
+def generate_status_query_payload(
+    b2c_settings: B2CSettingsSnapshot, payment: dict, security_credential: str
+) -> str:
+    """
+    Generates the Transaction Status request for a payment, looked up by its
+    OriginatorConversationID, which is also passed back in the result URL
+    """
+    result_url = get_status_result_url(
+        b2c_settings.transaction_status_results_url, payment.originatorconversationid
+    )
+
+    return json.dumps(
+        {
+            "Initiator": b2c_settings.initiator_name,
+            "SecurityCredential": security_credential,
+            "CommandID": "TransactionStatusQuery",
+            "TransactionID": "",
+            "OriginalConversationID": payment.originatorconversationid,
+            "PartyA": b2c_settings.organisation_shortcode,
+            "IdentifierType": SHORTCODE_IDENTIFIER_TYPE,
+            "ResultURL": result_url,
+            "QueueTimeOutURL": result_url,
+            "Remarks": "Pending payment status check",
+            "Occasion": payment.name,
+        }
+    )
+
+
+def get_status_result_url(results_url: str, originator_conversation_id: str) -> str:
+    separator = "&" if "?" in results_url else "?"
+    query = urlencode({"originator_conversation_id": originator_conversation_id})
+
+    return f"{results_url}{separator}{query}"
+
+
+@frappe.whitelist(allow_guest=True)
+def transaction_status_result_url(
+    Result: dict | None = None, originator_conversation_id: str | None = None, **kwargs
+) -> dict[str, int | str]:
+    """
+    Handles Transaction Status results of the status poller.
+    Conclusive results are converted to the payment Result they stand for and
+    queued exactly as results callbacks are. Others are acknowledged and dropped,
+    leaving the payment Pending until its next query.
+    """
+    result = normalise_status_result(Result or kwargs, originator_conversation_id)
+
+    if result is None:
+        return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+    return accept_callback(result, "Result")
+
+
+def normalise_status_result(
+    status_result: dict, originator_conversation_id: str | None
+) -> dict | None:
+    """
+    Converts a Transaction Status result into the Result the payment's own callback
+    would have carried, or returns None if it says nothing conclusive,
+    e.g. the transaction was not found or is still being processed.
+    Completed transactions missing the receipt, amount or finalised time a
+    transaction is saved with are also left for the next query.
+    """
+    if not originator_conversation_id or str(status_result.get("ResultCode")) != "0":
+        return None
+
+    status_parameters = {
+        item["Key"]: item.get("Value")
+        for item in (status_result.get("ResultParameters") or {}).get(
+            "ResultParameter", []
+        )
+    }
+    transaction_status = status_parameters.get("TransactionStatus")
+    receipt = status_parameters.get("ReceiptNo")
+
+    result = {
+        "ResultType": 0,
+        "OriginatorConversationID": originator_conversation_id,
+        "ConversationID": status_parameters.get("ConversationID"),
+        "TransactionID": receipt,
+    }
+
+    if transaction_status == "Completed":
+        # FinalisedTime is reported as YYYYmmddHHMMSS
+        finalised_time = str(status_parameters.get("FinalisedTime") or "")
+
+        if not (
+            receipt
+            and status_parameters.get("Amount") is not None
+            and len(finalised_time) == 14
+            and finalised_time.isdigit()
+        ):
+            # The transaction cannot be saved without these, query it again later
+            app_logger.warning(
+                "Incomplete Completed status result for OriginatorConversationID: %s",
+                originator_conversation_id,
+            )
+            return None
+
+        result_parameters = [
+            {"Key": result_key, "Value": status_parameters[status_key]}
+            for status_key, result_key in STATUS_RESULT_PARAMETERS.items()
+            if status_parameters.get(status_key) is not None
+        ]
+        result_parameters.append(
+            {
+                "Key": "TransactionCompletedDateTime",
+                "Value": f"{finalised_time[6:8]}.{finalised_time[4:6]}."
+                f"{finalised_time[0:4]} {finalised_time[8:10]}:"
+                f"{finalised_time[10:12]}:{finalised_time[12:14]}",
+            }
+        )
+
+        return {
+            **result,
+            "ResultCode": 0,
+            "ResultDesc": status_result.get("ResultDesc"),
+            "ResultParameters": {"ResultParameter": result_parameters},
+        }
+
+    if transaction_status in FAILED_TRANSACTION_STATUSES:
+        reason = status_parameters.get("TransactionReason") or status_result.get(
+            "ResultDesc"
+        )
+        return {
+            **result,
+            "ResultCode": FAILED_TRANSACTION_RESULT_CODE,
+            "ResultDesc": f"Transaction {transaction_status}: {reason}",
+        }
+
+    return None
@@ -0,0 +1,193 @@
+# Copyright (c) 2023, Navari Limited and Contributors
+# See license.txt
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from ..custom_exceptions import RateLimitExceededError
+from ..mpesa_b2c_payment import bulk_dispatcher
+from ..mpesa_b2c_payment.bulk_dispatcher import (
+    build_partial_payload,
+    send_payloads,
+    update_payment_statuses,
+)
+
+REJECTED_PARTY = "254700000000"
+
+
+class StubDarajaHandler(BaseHTTPRequestHandler):
+    """Accepts payment requests, rejecting those sent to REJECTED_PARTY"""
+
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        with self.lock:
+            StubDarajaHandler.in_flight += 1
+            StubDarajaHandler.max_in_flight = max(
+                StubDarajaHandler.max_in_flight, StubDarajaHandler.in_flight
+            )
+
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(0.05)
+
+        with self.lock:
+            StubDarajaHandler.in_flight -= 1
+
+        status_code = 400 if payload["PartyB"] == REJECTED_PARTY else 200
+        body = json.dumps(
+            {
+                "OriginatorConversationID": payload["OriginatorConversationID"],
+                "ResponseCode": "0" if status_code == 200 else "1",
+            }
+        ).encode()
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class TestBulkDispatcher(FrappeTestCase):
+    """Bulk payment dispatch tests against a local stub of the payment endpoint"""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubDarajaHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/paymentrequest"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_send_payloads_bounded_concurrency(self) -> None:
+        """Tests all payloads are sent without exceeding the in-flight limit"""
+        StubDarajaHandler.max_in_flight = 0
+        payloads = {
+            f"MPESA-B2C-{index}": json.dumps(
+                build_partial_payload(
+                    {
+                        "name": f"MPESA-B2C-{index}",
+                        "originatorconversationid": f"conversation-{index}",
+                        "commandid": "SalaryPayment",
+                        "amount": 10,
+                        "partyb": REJECTED_PARTY if index == 3 else "254712345678",
+                        "remarks": "test remarks",
+                        "occassion": "Testing",
+                    }
+                )
+            )
+            for index in range(20)
+        }
+
+        outcomes = asyncio.run(
+            send_payloads(payloads, "token", self.url, 4, (5.0, 5.0))
+        )
+
+        self.assertEqual([outcome.name for outcome in outcomes], list(payloads))
+        self.assertLessEqual(StubDarajaHandler.max_in_flight, 4)
+        self.assertGreater(StubDarajaHandler.max_in_flight, 1)
+
+        rejected = [outcome for outcome in outcomes if not outcome.succeeded]
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(rejected[0].name, "MPESA-B2C-3")
+        self.assertEqual(rejected[0].status_code, 400)
+
+        accepted = outcomes[0]
+        self.assertEqual(accepted.status_code, 200)
+        self.assertEqual(
+            json.loads(accepted.response)["OriginatorConversationID"],
+            "conversation-0",
+        )
+
+    def test_send_payloads_rate_limit_exceeded(self) -> None:
+        """Tests payments sent before the rate limit ran out keep their outcomes"""
+        payloads = {
+            f"MPESA-B2C-{index}": json.dumps(
+                build_partial_payload(
+                    {
+                        "name": f"MPESA-B2C-{index}",
+                        "originatorconversationid": f"conversation-{index}",
+                        "commandid": "SalaryPayment",
+                        "amount": 10,
+                        "partyb": "254712345678",
+                        "remarks": "test remarks",
+                        "occassion": "Testing",
+                    }
+                )
+            )
+            for index in range(5)
+        }
+        acquired = 0
+
+        async def acquire_async() -> float:
+            nonlocal acquired
+            acquired += 1
+
+            if acquired > 3:
+                raise RateLimitExceededError("Rate limit exceeded")
+
+            return 0
+
+        with patch.object(bulk_dispatcher, "acquire_async", side_effect=acquire_async):
+            outcomes = asyncio.run(
+                send_payloads(payloads, "token", self.url, 1, (5.0, 5.0))
+            )
+
+        self.assertEqual([outcome.name for outcome in outcomes], list(payloads))
+        self.assertEqual(
+            [outcome.sent for outcome in outcomes], [True] * 3 + [False] * 2
+        )
+        self.assertTrue(all(outcome.succeeded for outcome in outcomes[:3]))
+
+        with patch.object(bulk_dispatcher, "bulk_update_payment_status") as mock_update:
+            update_payment_statuses(outcomes)
+
+        # Payments never sent are left Not Initiated
+        self.assertEqual(list(mock_update.call_args.args[0]), list(payloads)[:3])
+
+    def test_send_payloads_read_timeout(self) -> None:
+        """Tests requests whose response times out are left Pending, not Errored"""
+        payloads = {
+            "MPESA-B2C-0": json.dumps(
+                build_partial_payload(
+                    {
+                        "name": "MPESA-B2C-0",
+                        "originatorconversationid": "conversation-0",
+                        "commandid": "SalaryPayment",
+                        "amount": 10,
+                        "partyb": "254712345678",
+                        "remarks": "test remarks",
+                        "occassion": "Testing",
+                    }
+                )
+            )
+        }
+
+        # The stub takes longer to respond than the read timeout
+        outcomes = asyncio.run(
+            send_payloads(payloads, "token", self.url, 1, (5.0, 0.01))
+        )
+
+        self.assertTrue(outcomes[0].unconfirmed)
+        self.assertFalse(outcomes[0].succeeded)
+
+        with patch.object(bulk_dispatcher, "bulk_update_payment_status") as mock_update:
+            update_payment_statuses(outcomes)
+
+        mock_update.assert_called_once_with({"MPESA-B2C-0": {"status": "Pending"}})
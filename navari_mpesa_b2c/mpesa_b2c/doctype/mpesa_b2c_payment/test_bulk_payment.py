@@ -0,0 +1,161 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..custom_exceptions import AccessTokenUnavailableError
+from ..mpesa_b2c_payment import bulk_dispatcher, bulk_payment
+from ..mpesa_b2c_payment.bulk_dispatcher import PaymentOutcome, RequestCredentials
+from .test_mpesa_b2c_payment import make_bulk_b2c_payment
+
+
+CREDENTIALS = RequestCredentials("credential", "token")
+
+
+class TestBulkPayment(FrappeTestCase):
+    """Bulk payment job tests, with the requests to Daraja stubbed out"""
+
+    def test_resumes(self) -> None:
+        """Tests a payment is created per valid item, and not again on resume"""
+        parent = make_bulk_b2c_payment(
+            [
+                {"partyb": "0712345678", "amount": 10},
+                {"partyb": "254712345679", "amount": 20},
+                {"partyb": "12345", "amount": 30},
+            ]
+        )
+
+        def dispatch(
+            payments: list[dict], credentials: RequestCredentials
+        ) -> list[PaymentOutcome]:
+            for payment in payments:
+                # Payments are marked in flight before their requests go out
+                self.assertEqual(
+                    frappe.db.get_value("MPesa B2C Payment", payment.name, "status"),
+                    "Sending",
+                )
+                frappe.db.set_value(
+                    "MPesa B2C Payment", payment.name, "status", "Pending"
+                )
+
+            return [
+                PaymentOutcome(payment.name, 200, "{}", None) for payment in payments
+            ]
+
+        with patch.object(
+            bulk_payment, "get_request_credentials", return_value=CREDENTIALS
+        ), patch.object(
+            bulk_payment, "dispatch_payments", side_effect=dispatch
+        ) as mock_dispatch, patch.object(
+            bulk_payment.frappe.db, "commit"
+        ):
+            bulk_payment.process_bulk_payment(parent.name)
+            bulk_payment.process_bulk_payment(parent.name)
+
+        item_payments = frappe.get_all(
+            "MPesa B2C Payment",
+            filters={"bulk_payment": parent.name},
+            fields=["partyb", "amount", "status"],
+            order_by="amount",
+        )
+
+        self.assertEqual(len(item_payments), 2)
+        self.assertEqual(item_payments[0].partyb, "254712345678")
+        self.assertEqual(item_payments[1].amount, 20)
+        self.assertTrue(all(payment.status == "Pending" for payment in item_payments))
+        mock_dispatch.assert_called_once()
+
+        # The item with an invalid number is recorded as skipped, not as paid
+        skipped_item = frappe.get_all(
+            "MPesa B2C Employee Payment Item",
+            filters={"parent": parent.name, "partyb": "12345"},
+            fields=["b2c_payment", "error"],
+        )[0]
+        self.assertIsNone(skipped_item.b2c_payment)
+        self.assertIn("Invalid receiver number", skipped_item.error)
+        self.assertEqual(
+            frappe.db.get_value("MPesa B2C Payment", parent.name, "status"),
+            "Not Initiated",
+        )
+
+    def test_reconciles_interrupted_payments(self) -> None:
+        """Tests payments a crashed job left Sending are set Pending, not resent"""
+        parent = make_bulk_b2c_payment(
+            [
+                {"partyb": "0712345660", "amount": 10},
+                {"partyb": "0712345661", "amount": 20},
+            ],
+            remarks="bulk crash test remarks",
+        )
+
+        with patch.object(
+            bulk_payment, "get_request_credentials", return_value=CREDENTIALS
+        ), patch.object(
+            bulk_payment, "dispatch_payments", side_effect=SystemExit
+        ), patch.object(
+            bulk_payment.frappe.db, "commit"
+        ), patch.object(
+            bulk_payment.frappe, "publish_realtime"
+        ) as mock_publish:
+            with self.assertRaises(SystemExit):
+                bulk_payment.process_bulk_payment(parent.name)
+
+        # The client is told the job stopped, even though it crashed
+        self.assertEqual(mock_publish.call_args.args[1]["stage"], "done")
+        self.assertEqual(
+            frappe.get_all(
+                "MPesa B2C Payment",
+                filters={"bulk_payment": parent.name},
+                pluck="status",
+            ),
+            ["Sending", "Sending"],
+        )
+
+        with patch.object(
+            bulk_payment, "dispatch_payments"
+        ) as mock_dispatch, patch.object(bulk_payment.frappe.db, "commit"):
+            bulk_payment.process_bulk_payment(parent.name)
+
+        mock_dispatch.assert_not_called()
+        self.assertEqual(
+            frappe.get_all(
+                "MPesa B2C Payment",
+                filters={"bulk_payment": parent.name},
+                pluck="status",
+            ),
+            ["Pending", "Pending"],
+        )
+
+    def test_token_miss_leaves_payments_unsent(self) -> None:
+        """Tests a chunk whose requests cannot be built is not marked Sending"""
+        parent = make_bulk_b2c_payment(
+            [{"partyb": "0712345670", "amount": 10}],
+            remarks="bulk token miss test remarks",
+        )
+
+        with patch.object(
+            bulk_dispatcher.access_token_provider,
+            "get_token",
+            side_effect=AccessTokenUnavailableError,
+        ), patch.object(
+            bulk_dispatcher, "get_security_credential", return_value="credential"
+        ), patch.object(
+            bulk_payment, "dispatch_payments"
+        ) as mock_dispatch, patch.object(
+            bulk_payment.frappe.db, "commit"
+        ):
+            with self.assertRaises(AccessTokenUnavailableError):
+                bulk_payment.process_bulk_payment(parent.name)
+
+        mock_dispatch.assert_not_called()
+        self.assertEqual(
+            frappe.get_all(
+                "MPesa B2C Payment",
+                filters={"bulk_payment": parent.name},
+                pluck="status",
+            ),
+            ["Not Initiated"],
+        )
@@ -0,0 +1,71 @@
+# Copyright (c) 2023, Navari Limited and Contributors
+# See license.txt
+
+import base64
+import datetime
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment.encoding_credentials import (
+    load_public_key,
+    rsa_encrypt_encode,
+)
+
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def generate_certificate(private_key: rsa.RSAPrivateKey) -> x509.Certificate:
+    """Generates a self-signed certificate for the given private key"""
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "apisandbox.test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+
+
+class TestEncodingCredentials(FrappeTestCase):
+    """Security Credential encryption tests"""
+
+    def test_load_public_key_from_certificates(self) -> None:
+        """Tests the public key is parsed from PEM and DER certificates and PEM keys"""
+        certificate = generate_certificate(PRIVATE_KEY)
+        expected_numbers = PRIVATE_KEY.public_key().public_numbers()
+
+        for certificate_data in (
+            certificate.public_bytes(serialization.Encoding.PEM),
+            certificate.public_bytes(serialization.Encoding.DER),
+            PRIVATE_KEY.public_key().public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            ),
+        ):
+            public_key = load_public_key(certificate_data)
+            self.assertEqual(public_key.public_numbers(), expected_numbers)
+
+    def test_rsa_encrypt_encode(self) -> None:
+        """Tests the security credential decrypts back to the password with the private key"""
+        certificate = generate_certificate(PRIVATE_KEY)
+        public_key = load_public_key(
+            certificate.public_bytes(serialization.Encoding.PEM)
+        )
+
+        security_credential = rsa_encrypt_encode(b"Safaricom999!*!", public_key)
+        encrypted_password = base64.b64decode(security_credential)
+
+        self.assertEqual(len(encrypted_password), PRIVATE_KEY.key_size // 8)
+        self.assertEqual(
+            PRIVATE_KEY.decrypt(encrypted_password, padding.PKCS1v15()),
+            b"Safaricom999!*!",
+        )
@@ -0,0 +1,64 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import dataclasses
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..custom_exceptions import InsufficientFundsError
+from ..mpesa_b2c_payment import bulk_payment, funds_check
+from .test_mpesa_b2c_payment import make_bulk_b2c_payment
+
+
+class TestFundsCheck(FrappeTestCase):
+    """Bulk payment funds check tests"""
+
+    def test_reject_or_split(self) -> None:
+        """Tests bulk payments exceeding the available funds are rejected, or split"""
+        parent = make_bulk_b2c_payment(
+            [
+                {"partyb": "0712345670", "amount": 10},
+                {"partyb": "0712345671", "amount": 20},
+                {"partyb": "0712345672", "amount": 30},
+            ],
+            remarks="funds check test remarks",
+        )
+
+        b2c_settings = funds_check.get_b2c_settings_snapshot()
+
+        with patch.object(
+            funds_check, "get_available_funds", return_value=35
+        ), patch.object(
+            funds_check,
+            "get_b2c_settings_snapshot",
+            return_value=dataclasses.replace(b2c_settings, funds_check_mode="Reject"),
+        ), patch.object(
+            bulk_payment.frappe, "enqueue"
+        ) as mock_enqueue:
+            with self.assertRaises(InsufficientFundsError):
+                bulk_payment.initiate_bulk_payment(parent.name)
+
+        mock_enqueue.assert_not_called()
+
+        with patch.object(
+            funds_check, "get_available_funds", return_value=35
+        ), patch.object(
+            funds_check,
+            "get_b2c_settings_snapshot",
+            return_value=dataclasses.replace(b2c_settings, funds_check_mode="Split"),
+        ), patch.object(
+            bulk_payment, "get_request_credentials", return_value=None
+        ), patch.object(
+            bulk_payment.frappe.db, "commit"
+        ):
+            bulk_payment.process_bulk_payment(parent.name)
+
+        item_amounts = frappe.get_all(
+            "MPesa B2C Payment",
+            filters={"bulk_payment": parent.name},
+            pluck="amount",
+            order_by="amount",
+        )
+        self.assertEqual(item_amounts, [10, 20])
@@ -0,0 +1,30 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment import http_client
+
+
+class TestHttpClient(FrappeTestCase):
+    """Pooled Daraja session tests"""
+
+    def test_reuses_session(self) -> None:
+        """Tests Daraja requests share one pooled session per worker"""
+        session = http_client.get_session()
+
+        self.assertIs(http_client.get_session(), session)
+
+        stats = http_client.get_connection_stats()
+        self.assertGreaterEqual(stats["requests"], stats["reused_connections"])
+        self.assertTrue(0 <= stats["reuse_ratio"] <= 1)
+
+        with patch.object(session, "request") as mock_request:
+            http_client.daraja_request("GET", "https://example.com/authorise")
+
+        _, kwargs = mock_request.call_args
+        connect_timeout, read_timeout = kwargs["timeout"]
+        self.assertGreater(connect_timeout, 0)
+        self.assertGreater(read_timeout, 0)
@@ -3,6 +3,7 @@
 
 
 import datetime
+import json
 import random
 import string
 from unittest.mock import MagicMock, patch
@@ -19,14 +20,14 @@ from ..custom_exceptions import (
     InsufficientPaymentAmountError,
     InvalidReceiverMobileNumberError,
 )
-from ..mpesa_b2c_payment import mpesa_b2c_payment
+from ..mpesa_b2c_payment import callbacks, mpesa_b2c_payment
 from ..mpesa_b2c_payment.mpesa_b2c_payment import (
+    bulk_update_payment_status,
     extract_transaction_values,
     get_result_details,
-    handle_successful_result_response,
     sanitise_phone_number,
     send_payload,
-    update_doctype_single_values,
+    update_payment_status,
     validate_receiver_mobile_number,
 )
 
@@ -108,6 +109,45 @@ def create_mpesa_b2c_payment() -> None:
     frappe.flags.test_events_created = True
 
 
+def make_b2c_payment(**values) -> Document:
+    """Returns a new, unsaved, B2C Payment with valid values, overridden by values"""
+    return frappe.get_doc(
+        {
+            "doctype": "MPesa B2C Payment",
+            "commandid": "BusinessPayment",
+            "remarks": "test remarks",
+            "partyb": "254708993268",
+            "amount": 10,
+            "occassion": "Testing",
+            "party_type": "Supplier",
+            "account_paid_from": EXPENSE_ACCOUNT,
+            "account_paid_to": INCOME_ACCOUNT,
+            **values,
+        }
+    )
+
+
+def make_bulk_b2c_payment(items: list[dict], **values) -> Document:
+    """Returns a submitted bulk B2C Payment paying the items to suppliers"""
+    payment = frappe.get_doc(
+        {
+            "doctype": "MPesa B2C Payment",
+            "commandid": "BusinessPayment",
+            "remarks": "bulk test remarks",
+            "occassion": "Testing",
+            "party_type": "Supplier",
+            "doctype_to_pay_against": "Purchase Invoice",
+            "account_paid_from": EXPENSE_ACCOUNT,
+            "account_paid_to": INCOME_ACCOUNT,
+            "items": items,
+            **values,
+        }
+    ).insert()
+    payment.submit()
+
+    return payment
+
+
 class TestMPesaB2CPayment(FrappeTestCase):
     """B2C Payment Tests"""
 
@@ -373,7 +413,7 @@ class TestMPesaB2CPayment(FrappeTestCase):
         )
         self.assertEqual(output[4], SUCCESSFUL_TEST_RESULTS["Result"]["TransactionID"])
 
-    @patch.object(mpesa_b2c_payment.requests, "post")
+    @patch.object(mpesa_b2c_payment, "daraja_request")
     def test_send_payload(self, mock_response: MagicMock) -> None:
         """Tests the send_payload() function from the b2c_payment module"""
         mock_response.return_value.status_code = 200
@@ -386,7 +426,9 @@ class TestMPesaB2CPayment(FrappeTestCase):
         self.assertEqual(response["message"], "Success")
         self.assertEqual(status_code, 200)
 
-    @patch.object(mpesa_b2c_payment.requests, "post", side_effect=requests.HTTPError)
+    @patch.object(
+        mpesa_b2c_payment, "daraja_request", side_effect=requests.HTTPError
+    )
     def test_send_payload_error_response(self, mock_response: MagicMock) -> None:
         """Tests instances the send_payload() from the b2c_payment module receives an error response"""
         response, status_code = None, None
@@ -400,8 +442,8 @@ class TestMPesaB2CPayment(FrappeTestCase):
         self.assertIsNone(status_code)
 
     @patch.object(
-        mpesa_b2c_payment.requests,
-        "post",
+        mpesa_b2c_payment,
+        "daraja_request",
         side_effect=requests.exceptions.ConnectionError,
     )
     def test_send_payload_error_connection_failure(
@@ -417,12 +459,12 @@ class TestMPesaB2CPayment(FrappeTestCase):
 
         self.assertIsNone(response)
 
-    def test_handle_successful_result_response(self) -> None:
-        """Tests the handle_successful_result_response() function from the mpesa b2c module"""
+    def test_process_successful_result(self) -> None:
+        """Tests a successful Result sets its payment Paid and saves its transaction"""
         payment = frappe.db.get_value(
             "MPesa B2C Payment",
             {"partyb": "254708993268"},
-            ["originatorconversationid"],
+            ["name", "originatorconversationid"],
             as_dict=True,
         )
         SUCCESSFUL_TEST_RESULTS["Result"][
@@ -435,44 +477,58 @@ class TestMPesaB2CPayment(FrappeTestCase):
             "Value"
         ] = mock_transaction_id
 
-        result = handle_successful_result_response(SUCCESSFUL_TEST_RESULTS["Result"])
-
-        self.assertIsInstance(result, Document)
-        self.assertEqual(result.name, mock_transaction_id)
+        callbacks.process_callback_batch(
+            [
+                frappe._dict(
+                    name="successful-result-callback",
+                    payload=json.dumps(SUCCESSFUL_TEST_RESULTS["Result"]),
+                    callback_type="Result",
+                )
+            ]
+        )
 
-    def test_update_doctype_single_values(self) -> None:
-        """Tests the update_doctype_single_values() function from the b2c payment module"""
-        payment = frappe.db.get_value(
-            "MPesa B2C Payment",
-            {
-                "partyb": "254708993268",
-                "account_paid_from": EXPENSE_ACCOUNT,
-                "account_paid_to": INCOME_ACCOUNT,
-            },
-            ["name", "occassion"],
+        transaction = frappe.db.get_value(
+            "MPesa B2C Payments Transactions",
+            mock_transaction_id,
+            ["name", "b2c_payment_name"],
             as_dict=True,
         )
+        self.assertIsNotNone(transaction)
+        self.assertEqual(transaction.b2c_payment_name, payment.name)
+        self.assertEqual(
+            frappe.db.get_value("MPesa B2C Payment", payment.name, "status"), "Paid"
+        )
 
-        self.assertEqual(payment.occassion, "Testing")
+    def test_update_payment_status(self) -> None:
+        """Tests several fields of one or many B2C Payments are updated together"""
+        payments = [make_b2c_payment().insert() for _ in range(3)]
 
-        new_value = "Unit Testing"
-        update_doctype_single_values(
-            "MPesa B2C Payment", payment, "occassion", new_value
+        update_payment_status(
+            payments[0].name,
+            status="Errored",
+            error_code="2001",
+            error_description="The initiator information is invalid.",
         )
-
-        updated_payment = frappe.db.get_value(
-            "MPesa B2C Payment",
+        bulk_update_payment_status(
             {
-                "partyb": "254708993268",
-                "account_paid_from": EXPENSE_ACCOUNT,
-                "account_paid_to": INCOME_ACCOUNT,
-                "occassion": new_value,
-            },
-            ["name", "occassion"],
-            as_dict=True,
+                payments[1].name: {"status": "Pending"},
+                payments[2].name: {
+                    "status": "Errored",
+                    "error_code": "400",
+                    "error_description": "Bad Request",
+                },
+            }
         )
-        self.assertIsNotNone(updated_payment)
-        self.assertEqual(updated_payment.occassion, new_value)
+
+        for payment in payments:
+            payment.reload()
+
+        self.assertEqual(payments[0].status, "Errored")
+        self.assertEqual(payments[0].error_code, "2001")
+        self.assertEqual(payments[1].status, "Pending")
+        self.assertFalse(payments[1].error_code)
+        self.assertEqual(payments[2].status, "Errored")
+        self.assertEqual(payments[2].error_description, "Bad Request")
 
     def test_validate_receiver_mobile_number(self) -> None:
         """Tests the validate_receiver_mobile_number() from the b2c payment module"""
@@ -516,11 +572,11 @@ class TestMPesaB2CPayment(FrappeTestCase):
         ) as mock_password, patch.object(
             mpesa_b2c_payment, "get_file_path"
         ) as mock_certificate_file, patch.object(
-            mpesa_b2c_payment, "openssl_encrypt_encode"
+            mpesa_b2c_payment, "get_security_credential"
         ) as mock_security_credentials, patch.object(
             mpesa_b2c_payment, "generate_payload"
         ) as mock_payload, patch.object(
-            mpesa_b2c_payment.requests, "post"
+            mpesa_b2c_payment, "daraja_request"
         ) as mock_response, patch.object(
             mpesa_b2c_payment.frappe, "msgprint"
         ) as mock_msgprint, patch.object(
@@ -532,14 +588,12 @@ class TestMPesaB2CPayment(FrappeTestCase):
                 "/path/to/certificate.pem"
             )
 
-            mock_security_credentials.return_value = "security_credentials".encode()
-            encoded_credentials = "security_credentials".encode()
-            credentials = mpesa_b2c_payment.openssl_encrypt_encode(
-                "password".encode(), certificate_file
-            )
+            mock_security_credentials.return_value = "security_credentials"
+            encoded_credentials = "security_credentials"
+            credentials = mpesa_b2c_payment.get_security_credential(certificate_file)
 
             mock_payload.return_value = {"payload": "payload"}
-            payload = mpesa_b2c_payment.generate_payload("", {}, credentials.decode())
+            payload = mpesa_b2c_payment.generate_payload("", {}, credentials)
 
             mock_response.return_value.text = {"message": "Success"}
             mock_response.return_value.status_code = 200
@@ -0,0 +1,70 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..custom_exceptions import UnsupportedReferenceDoctypeError
+from ..mpesa_b2c_payment import payment_items
+
+
+class TestPaymentItems(FrappeTestCase):
+    """Tests of the resolution of the items paying records"""
+
+    def test_resolve_supplier_numbers(self) -> None:
+        """Tests suppliers' numbers are read from their primary contacts"""
+        supplier = frappe.get_doc(
+            {
+                "doctype": "Supplier",
+                "supplier_name": "B2C Payment Items Test Supplier",
+            }
+        ).insert(ignore_if_duplicate=True)
+
+        for first_name, mobile_no, is_primary_contact in (
+            ("Secondary", "0712000001", 0),
+            ("Primary", "0712000002", 1),
+        ):
+            frappe.get_doc(
+                {
+                    "doctype": "Contact",
+                    "first_name": first_name,
+                    "mobile_no": mobile_no,
+                    "is_primary_contact": is_primary_contact,
+                    "links": [{"link_doctype": "Supplier", "link_name": supplier.name}],
+                }
+            ).insert()
+
+        self.assertEqual(
+            payment_items.get_supplier_phone_numbers({supplier.name}),
+            {supplier.name: "0712000002"},
+        )
+
+        with self.assertRaises(UnsupportedReferenceDoctypeError):
+            payment_items.get_payment_items("ToDo", "2023-11-01", "2023-11-30")
+
+    def test_selection(self) -> None:
+        """Tests records are selected on their date range, resuming after the cursor"""
+        with patch.object(payment_items.frappe.db, "sql", return_value=[]) as mock_sql:
+            page = payment_items.get_payment_items(
+                "Purchase Invoice",
+                "2023-11-01",
+                "2023-11-30",
+                after_date="2023-11-15",
+                after_name="ACC-PINV-2023-00010",
+            )
+
+        self.assertEqual(page, {"items": [], "next": None})
+
+        query = mock_sql.call_args.args[0]
+        self.assertIn("`posting_date` BETWEEN '2023-11-01' AND '2023-11-30'", query)
+        self.assertIn("`docstatus`=1", query)
+        self.assertIn("NOT EXISTS", query)
+        # Only records whose item payment is live, or will be retried, are excluded
+        self.assertIn("IN ('Not Initiated','Sending','Pending','Paid')", query)
+        self.assertIn("`next_retry_at` IS NOT NULL", query)
+        # Items skipped for an invalid receiver number do not count as paid
+        self.assertIn("`error`,'')=''", query)
+        self.assertIn("'ACC-PINV-2023-00010'", query)
+        self.assertNotIn("`creation`", query)
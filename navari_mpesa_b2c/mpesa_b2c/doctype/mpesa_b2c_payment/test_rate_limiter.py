@@ -0,0 +1,26 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment import rate_limiter
+
+
+class TestRateLimiter(FrappeTestCase):
+    """Shared token bucket tests"""
+
+    def test_token_bucket(self) -> None:
+        """Tests the shared token bucket allows a burst then limits to the set rate"""
+        key = frappe.cache().make_key(
+            f"{rate_limiter.RATE_LIMIT_KEY}:test:{frappe.generate_hash(length=8)}"
+        )
+
+        self.assertEqual(rate_limiter.try_acquire(key, 1, 2), 0)
+        self.assertEqual(rate_limiter.try_acquire(key, 1, 2), 0)
+
+        wait = rate_limiter.try_acquire(key, 1, 2)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+
+        frappe.cache().delete(key)
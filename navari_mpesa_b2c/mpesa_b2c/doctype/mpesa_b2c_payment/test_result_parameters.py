@@ -0,0 +1,45 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment import result_parameters
+from ..mpesa_b2c_payment.mpesa_b2c_payment import extract_transaction_values
+from .test_mpesa_b2c_payment import SUCCESSFUL_TEST_RESULTS
+
+
+class TestResultParameters(FrappeTestCase):
+    """ResultParameters parsing tests"""
+
+    def test_parse_results_batch(self) -> None:
+        """Tests Results are parsed into columns, datetimes decoded as strptime would"""
+        result = SUCCESSFUL_TEST_RESULTS["Result"]
+        unpadded_result = {
+            "TransactionID": "RK00000002",
+            "ResultParameters": {
+                "ResultParameter": [
+                    {"Key": "TransactionReceipt", "Value": "RK00000002"},
+                    {
+                        "Key": "TransactionCompletedDateTime",
+                        "Value": "7.11.2023 1:45:50",
+                    },
+                ]
+            },
+        }
+
+        columns = result_parameters.parse_results_batch([result, unpadded_result])
+
+        self.assertEqual(
+            columns["transaction_id"], [result["TransactionID"], "RK00000002"]
+        )
+        self.assertEqual(columns["transaction_amount"], [10, None])
+        self.assertEqual(
+            columns["transaction_completed_datetime"],
+            ["2023-11-07 11:45:50.000", "2023-11-07 01:45:50.000"],
+        )
+        self.assertEqual(
+            extract_transaction_values(
+                result["ResultParameters"]["ResultParameter"], result["TransactionID"]
+            )["transaction_completed_datetime"],
+            columns["transaction_completed_datetime"][0],
+        )
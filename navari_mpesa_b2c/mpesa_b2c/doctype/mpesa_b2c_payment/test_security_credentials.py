@@ -0,0 +1,46 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment import security_credentials
+
+
+class TestSecurityCredentials(FrappeTestCase):
+    """SecurityCredential cache tests"""
+
+    def test_cached_until_invalidated(self) -> None:
+        """Tests the security credential is only generated once per settings version"""
+        b2c_settings = MagicMock(
+            version="v1",
+            initiator_password="password",
+            certificate_file="/files/AuthorizationCertificate.cer",
+        )
+        security_credentials.invalidate_security_credentials()
+
+        with tempfile.NamedTemporaryFile(suffix=".cer") as certificate, patch.object(
+            security_credentials, "get_file_path", return_value=certificate.name
+        ), patch.object(security_credentials, "load_public_key"), patch.object(
+            security_credentials,
+            "rsa_encrypt_encode",
+            return_value=b"credential",
+        ) as mock_encrypt:
+            certificate.write(b"certificate")
+            certificate.flush()
+
+            first = security_credentials.get_security_credential(b2c_settings)
+            second = security_credentials.get_security_credential(b2c_settings)
+
+            self.assertEqual(first, "credential")
+            self.assertEqual(second, "credential")
+            mock_encrypt.assert_called_once()
+
+            security_credentials.invalidate_security_credentials()
+            security_credentials.get_security_credential(b2c_settings)
+
+            self.assertEqual(mock_encrypt.call_count, 2)
+
+        security_credentials.invalidate_security_credentials()
@@ -0,0 +1,136 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import dataclasses
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..mpesa_b2c_payment import rate_limiter, status_poller
+from ..mpesa_b2c_payment.mpesa_b2c_payment import extract_transaction_values
+from .test_mpesa_b2c_payment import make_b2c_payment, make_bulk_b2c_payment
+
+
+class TestStatusPoller(FrappeTestCase):
+    """Transaction Status polling tests against a local stub of the status endpoint"""
+
+    def test_poll_pending_payments(self) -> None:
+        """Tests stale Pending payments are queried from a stub status endpoint"""
+        payment = make_b2c_payment(
+            remarks="status poller test remarks", status="Pending"
+        ).insert()
+        bulk_parent = make_bulk_b2c_payment(
+            [{"partyb": "0712345650", "amount": 10}],
+            remarks="status poller test remarks",
+            status="Pending",
+        )
+        stale_modified = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for name in (payment.name, bulk_parent.name):
+            frappe.db.set_value(
+                "MPesa B2C Payment",
+                name,
+                "modified",
+                stale_modified,
+                update_modified=False,
+            )
+
+        queries = []
+
+        class TransactionStatusStub(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                queries.append(json.loads(body))
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"ResponseCode": "0"}')
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), TransactionStatusStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        b2c_settings = dataclasses.replace(
+            status_poller.get_b2c_settings_snapshot(),
+            transaction_status_url=f"http://127.0.0.1:{server.server_port}/query",
+            transaction_status_results_url="https://example.com/status",
+            rate_limit_tps=0,
+        )
+
+        with patch.object(
+            status_poller, "get_b2c_settings_snapshot", return_value=b2c_settings
+        ), patch.object(
+            status_poller, "get_security_credential", return_value="credential"
+        ), patch.object(
+            status_poller.access_token_provider, "get_token", return_value="token"
+        ), patch.object(
+            rate_limiter, "get_b2c_settings_snapshot", return_value=b2c_settings
+        ), patch.object(
+            status_poller.frappe.db, "commit"
+        ):
+            status_poller.poll_pending_payments()
+
+        query = next(
+            query
+            for query in queries
+            if query["OriginalConversationID"] == payment.originatorconversationid
+        )
+        self.assertEqual(query["CommandID"], "TransactionStatusQuery")
+        # A bulk payment's own OriginatorConversationID is never sent
+        self.assertNotIn(
+            bulk_parent.originatorconversationid,
+            [query["OriginalConversationID"] for query in queries],
+        )
+        self.assertIn(payment.originatorconversationid, query["ResultURL"])
+        self.assertGreater(
+            frappe.db.get_value("MPesa B2C Payment", payment.name, "modified"),
+            stale_modified,
+        )
+
+        status_result = {
+            "ResultType": 0,
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "ResultParameters": {
+                "ResultParameter": [
+                    {"Key": "ReceiptNo", "Value": "RK00000003"},
+                    {"Key": "Amount", "Value": 10},
+                    {"Key": "TransactionStatus", "Value": "Completed"},
+                    {"Key": "FinalisedTime", "Value": 20231107114550},
+                ]
+            },
+        }
+        result = status_poller.normalise_status_result(
+            status_result, payment.originatorconversationid
+        )
+
+        self.assertEqual(result["ResultCode"], 0)
+        self.assertEqual(result["TransactionID"], "RK00000003")
+        self.assertEqual(
+            extract_transaction_values(
+                result["ResultParameters"]["ResultParameter"], result["TransactionID"]
+            )["transaction_completed_datetime"],
+            "2023-11-07 11:45:50.000",
+        )
+        self.assertIsNone(
+            status_poller.normalise_status_result(
+                {**status_result, "ResultCode": 2001}, payment.originatorconversationid
+            )
+        )
+
+        # Completed results the transaction cannot be saved from wait for a later query
+        status_result["ResultParameters"]["ResultParameter"][3]["Value"] = "pending"
+        self.assertIsNone(
+            status_poller.normalise_status_result(
+                status_result, payment.originatorconversationid
+            )
+        )
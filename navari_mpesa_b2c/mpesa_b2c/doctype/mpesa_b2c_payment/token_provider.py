@@ -0,0 +1,153 @@
+"""Process-local and Redis backed cache of Daraja access tokens"""
+
+import datetime
+from typing import Callable, Final, NamedTuple
+
+import frappe
+from frappe.utils import get_datetime, now_datetime
+
+from .. import app_logger
+from ..custom_exceptions import AccessTokenUnavailableError
+
+TOKEN_CACHE_KEY: Final[str] = "navari_mpesa_b2c:daraja_access_token"
+TOKEN_LOCK_KEY: Final[str] = "navari_mpesa_b2c:daraja_access_token_lock"
+
+# Tokens are treated as expired this many seconds before their actual expiry time
+TOKEN_EXPIRY_MARGIN: Final[int] = 60
+
+# How long the refresh lock is held at most, and how long other workers wait for it
+TOKEN_LOCK_TIMEOUT: Final[int] = 90
+TOKEN_LOCK_BLOCKING_TIMEOUT: Final[int] = 75
+
+
+class AccessToken(NamedTuple):
+    """A plain (decrypted) Daraja access token and its expiry time"""
+
+    token: str
+    expiry_time: datetime.datetime
+
+    def is_usable(self, margin: int = TOKEN_EXPIRY_MARGIN) -> bool:
+        """Whether the token is still valid for at least margin seconds"""
+        return self.expiry_time - datetime.timedelta(seconds=margin) > now_datetime()
+
+
+class AccessTokenProvider:
+    """
+    Serves Daraja access tokens from, in order: a process-local cache, a site-wide Redis cache
+    and the Daraja Access Tokens doctype.
+    Tokens are fetched from Safaricom's authorization endpoint only by refresh, run in the
+    background. Only one worker per site fetches a new token at a time; the rest wait on a
+    Redis lock and pick up the token the lock holder stored.
+    """
+
+    def __init__(
+        self,
+        load_token: Callable[[], AccessToken | None],
+        fetch_token: Callable[[], AccessToken],
+        request_refresh: Callable[[], None] | None = None,
+    ) -> None:
+        self.load_token = load_token
+        self.fetch_token = fetch_token
+        self.request_refresh = request_refresh
+        self._local_tokens: dict[str, AccessToken] = {}
+
+    def get_token(self) -> str:
+        """
+        Returns a usable access token. Requests are never held up fetching one:
+        if none is cached or stored, a background refresh is requested and
+        AccessTokenUnavailableError raised.
+        """
+        access_token = (
+            self._get_local_token() or self._get_shared_token() or self._load_token()
+        )
+
+        if access_token is None:
+            if self.request_refresh is not None:
+                self.request_refresh()
+
+            error = "No usable Daraja access token, a refresh has been requested"
+            app_logger.error(error)
+            raise AccessTokenUnavailableError(error)
+
+        return access_token.token
+
+    def refresh(self, force: bool = False) -> AccessToken:
+        """
+        Fetches a new access token while holding the site's refresh lock.
+        Unless forced, a token stored by another worker while waiting for the lock is reused.
+        """
+        cache = frappe.cache()
+        lock = cache.lock(
+            cache.make_key(TOKEN_LOCK_KEY),
+            timeout=TOKEN_LOCK_TIMEOUT,
+            blocking_timeout=TOKEN_LOCK_BLOCKING_TIMEOUT,
+        )
+
+        with lock:
+            if not force:
+                access_token = self._get_shared_token()
+                if access_token is not None:
+                    return access_token
+
+            access_token = self.fetch_token()
+            self._set_token(access_token)
+
+        return access_token
+
+    def invalidate(self) -> None:
+        """Drops the cached token from both the local and the shared cache"""
+        self._local_tokens.pop(frappe.local.site, None)
+        frappe.cache().delete_value(TOKEN_CACHE_KEY)
+
+    def _get_local_token(self) -> AccessToken | None:
+        access_token = self._local_tokens.get(frappe.local.site)
+
+        if access_token is not None and access_token.is_usable():
+            return access_token
+
+        return None
+
+    def _get_shared_token(self) -> AccessToken | None:
+        cached = frappe.cache().get_value(TOKEN_CACHE_KEY)
+
+        if not cached:
+            return None
+
+        access_token = AccessToken(cached["token"], get_datetime(cached["expiry_time"]))
+        if not access_token.is_usable():
+            return None
+
+        self._local_tokens[frappe.local.site] = access_token
+        return access_token
+
+    def _load_token(self) -> AccessToken | None:
+        access_token = self.load_token()
+
+        if access_token is None or not access_token.is_usable():
+            return None
+
+        self._set_token(access_token)
+        return access_token
+
+    def _set_token(self, access_token: AccessToken) -> None:
+        self._local_tokens[frappe.local.site] = access_token
+
+        time_to_live = int(
+            (access_token.expiry_time - now_datetime()).total_seconds()
+            - TOKEN_EXPIRY_MARGIN
+        )
+        if time_to_live > 0:
+            frappe.cache().set_value(
+                TOKEN_CACHE_KEY,
+                {
+                    "token": access_token.token,
+                    "expiry_time": str(access_token.expiry_time),
+                },
+                expires_in_sec=time_to_live,
+            )
+
+        app_logger.info(
+            "Access token expiring at %s cached for site %s",
+            access_token.expiry_time,
+            frappe.local.site,
+        )
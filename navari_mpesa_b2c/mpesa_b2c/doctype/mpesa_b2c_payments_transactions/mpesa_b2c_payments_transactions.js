@@ -1,8 +1,23 @@
 // Copyright (c) 2023, Navari Ltd and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("MPesa B2C Payments Transactions", {
-// 	refresh(frm) {
-
-// 	},
-// });
+frappe.ui.form.on("MPesa B2C Payments Transactions", {
+  refresh: function (frm) {
+    if (frm.doc.gl_posting_status === "Failed") {
+      frm.add_custom_button("Retry GL Posting", function () {
+        frappe.call({
+          method:
+            "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions.retry_journal_entry_posting",
+          args: { name: frm.doc.name },
+          callback: function () {
+            frappe.show_alert({
+              message: __("Journal Entry posting queued"),
+              indicator: "blue",
+            });
+            frm.reload_doc();
+          },
+        });
+      });
+    }
+  },
+});
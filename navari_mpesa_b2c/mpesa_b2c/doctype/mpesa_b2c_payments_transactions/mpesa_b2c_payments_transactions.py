@@ -2,14 +2,39 @@
 # For license information, please see license.txt
 
 import datetime
+from collections import defaultdict
+from typing import Final
+
 import frappe
 from frappe.model.document import Document
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Coalesce
 
 from .. import app_logger
 from ..custom_exceptions import (
     InformationMismatchError,
     UnExistentB2CPaymentRecordError,
 )
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
+
+MPESA_B2C_PAYMENT_DOCTYPE: Final[str] = "MPesa B2C Payment"
+MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE: Final[str] = "MPesa B2C Payments Transactions"
+DEFAULT_JOURNAL_ENTRY_POSTING_MODE: Final[str] = "Per Transaction"
+DEFAULT_JOURNAL_ENTRY_POSTING_WINDOW: Final[int] = 15
+MAX_JOURNAL_ENTRY_TRANSACTIONS: Final[int] = 1000
+JOURNAL_ENTRY_SAVEPOINT: Final[str] = "mpesa_b2c_journal_entry"
+MAX_GL_POSTING_ATTEMPTS: Final[int] = 5
+
+# B2C Payment fields a transaction is validated and posted against
+B2C_PAYMENT_FIELDS: Final[list[str]] = [
+    "name",
+    "status",
+    "amount",
+    "account_paid_from",
+    "account_paid_to",
+    "party_type",
+    "party",
+]
 
 
 class MPesaB2CPaymentsTransactions(Document):
@@ -19,20 +44,7 @@ class MPesaB2CPaymentsTransactions(Document):
         """B2C Payments Transactions validations"""
 
         if self.b2c_payment_name:
-            self.fetched_b2c_payment = frappe.db.get_value(
-                "MPesa B2C Payment",
-                {"name": self.b2c_payment_name},
-                [
-                    "name",
-                    "status",
-                    "amount",
-                    "account_paid_from",
-                    "account_paid_to",
-                    "party_type",
-                    "party",
-                ],
-                as_dict=True,
-            )
+            self.fetched_b2c_payment = self.get_b2c_payment()
 
             if not self.fetched_b2c_payment:
                 app_logger.error(
@@ -67,33 +79,285 @@ class MPesaB2CPaymentsTransactions(Document):
                     f"Incorrect Transaction and B2C Payment Amount for B2C payment: {self.b2c_payment_name}"
                 )
 
+    def get_b2c_payment(self) -> dict | None:
+        """
+        Returns the B2C Payment's fields used in validation and the Journal Entry.
+        The callback pipeline, having already loaded the payment, passes them in
+        flags.b2c_payment to save a query. Manual inserts read them from the database.
+        """
+        b2c_payment = self.flags.b2c_payment
+
+        if b2c_payment and b2c_payment.get("name") == self.b2c_payment_name:
+            return b2c_payment
+
+        return frappe.db.get_value(
+            "MPesa B2C Payment",
+            {"name": self.b2c_payment_name},
+            B2C_PAYMENT_FIELDS,
+            as_dict=True,
+        )
+
     def on_update(self) -> None:
-        """Create journal entry after saving successful transaction to the database"""
-        if self.fetched_b2c_payment:
-            journal_entry = frappe.new_doc("Journal Entry")
-            journal_entry.voucher_type = "Journal Entry"
-            journal_entry.posting_date = datetime.datetime.now()
-            journal_entry.append(
-                "accounts",
-                {
-                    "account": self.account_paid_from,
-                    "credit_in_account_currency": self.transaction_amount,
-                },
+        """
+        Queue the journal entry after saving successful transaction to the database.
+        It is posted by a background job, or with its batch when posting per batch,
+        so accounting never holds up the callback.
+        """
+        if not self.fetched_b2c_payment or self.gl_posting_status:
+            return
+
+        self.db_set("gl_posting_status", "Pending", update_modified=False)
+
+        if get_journal_entry_posting_mode() == "Per Transaction":
+            frappe.enqueue(
+                "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions.post_transaction_journal_entry",
+                queue="short",
+                job_id=f"mpesa_b2c_gl_posting::{self.name}",
+                deduplicate=True,
+                enqueue_after_commit=True,
+                transaction_name=self.name,
             )
-            journal_entry.append(
-                "accounts",
-                {
-                    "account": self.account_paid_to,
-                    "debit_in_account_currency": self.transaction_amount,
-                    "party_type": self.fetched_b2c_payment.party_type,
-                    "party": self.fetched_b2c_payment.party,
-                },
+
+
+def get_journal_entry_posting_mode() -> str:
+    """Returns the Journal Entry Posting Mode set in the MPesa B2C Settings"""
+    return (
+        get_b2c_settings_snapshot().journal_entry_posting_mode
+        or DEFAULT_JOURNAL_ENTRY_POSTING_MODE
+    )
+
+
+def post_journal_entry(transactions: list[dict]) -> str:
+    """
+    Creates one Journal Entry for the given transactions and links them to it.
+    Each transaction gets its own party row, referencing the transaction in its remark,
+    while the amounts paid out are credited once per account paid from.
+    """
+    journal_entry = frappe.new_doc("Journal Entry")
+    journal_entry.voucher_type = "Journal Entry"
+    journal_entry.posting_date = datetime.datetime.now()
+
+    credits = defaultdict(float)
+    for transaction in transactions:
+        credits[transaction.account_paid_from] += transaction.transaction_amount
+
+    for account, amount in credits.items():
+        journal_entry.append(
+            "accounts",
+            {"account": account, "credit_in_account_currency": amount},
+        )
+
+    for transaction in transactions:
+        journal_entry.append(
+            "accounts",
+            {
+                "account": transaction.account_paid_to,
+                "debit_in_account_currency": transaction.transaction_amount,
+                "party_type": transaction.party_type,
+                "party": transaction.party,
+                "user_remark": f"{MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE}: {transaction.name}",
+            },
+        )
+
+    journal_entry.insert(ignore_permissions=True)
+
+    transaction_table = frappe.qb.DocType(MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE)
+    (
+        frappe.qb.update(transaction_table)
+        .set(transaction_table.journal_entry, journal_entry.name)
+        .set(transaction_table.gl_posting_status, "Posted")
+        .where(
+            transaction_table.name.isin(
+                [transaction.name for transaction in transactions]
             )
+        )
+    ).run()
+
+    app_logger.info(
+        "Journal Entry %s created successfully from B2C Payments: %s and B2C Payments Transactions: %s",
+        journal_entry.name,
+        ", ".join({transaction.b2c_payment for transaction in transactions}),
+        ", ".join(transaction.name for transaction in transactions),
+    )
+
+    return journal_entry.name
+
+
+def post_transaction_journal_entry(transaction_name: str) -> None:
+    """Posts the Journal Entry of a single Pending transaction. Enqueued on its creation"""
+    transactions = get_pending_transactions([transaction_name])
+
+    if transactions:
+        post_journal_entries(transactions)
+
+
+def post_pending_journal_entries() -> None:
+    """
+    Posts the Journal Entries of all Pending transactions, including retries of failed
+    postings. Runs from the scheduler.
+    When posting per transaction, each transaction gets its own Journal Entry.
+    When posting per batch, transactions of a bulk payment are posted together once none
+    of its payments is still awaiting a result, and other transactions together per
+    posting window. A batch is also posted once its oldest transaction has waited a
+    full posting window.
+    """
+    if get_journal_entry_posting_mode() == "Per Transaction":
+        for transaction in get_pending_transactions():
+            post_transaction_journal_entry(transaction.name)
+            frappe.db.commit()  # nosemgrep
+
+        return
 
-            journal_entry.insert(ignore_permissions=True)
-            app_logger.info(
-                "Journal Entry %s created successfully from B2C Payment: %s and B2C Payments Transaction: %s",
-                journal_entry.name,
-                self.fetched_b2c_payment.name,
-                self.name,
+    b2c_settings = get_b2c_settings_snapshot()
+    window = datetime.timedelta(
+        minutes=b2c_settings.journal_entry_posting_window
+        or DEFAULT_JOURNAL_ENTRY_POSTING_WINDOW
+    )
+
+    batches = defaultdict(list)
+    for transaction in get_pending_transactions():
+        batches[transaction.bulk_payment or ""].append(transaction)
+
+    awaiting_results = get_bulk_payments_awaiting_results(
+        [bulk_payment for bulk_payment in batches if bulk_payment]
+    )
+    window_start = datetime.datetime.now() - window
+
+    for bulk_payment, transactions in batches.items():
+        if transactions[0].creation > window_start and (
+            not bulk_payment or bulk_payment in awaiting_results
+        ):
+            continue
+
+        for start in range(0, len(transactions), MAX_JOURNAL_ENTRY_TRANSACTIONS):
+            batch = transactions[start : start + MAX_JOURNAL_ENTRY_TRANSACTIONS]
+
+            # Lock the batch, skipping any transaction posted since it was read
+            batch = get_pending_transactions(
+                [transaction.name for transaction in batch]
             )
+            if batch:
+                post_journal_entries(batch)
+
+            frappe.db.commit()  # nosemgrep
+
+
+def post_journal_entries(transactions: list[dict]) -> bool:
+    """
+    Posts one Journal Entry for the transactions, returning whether it succeeded.
+    A failed posting is rolled back on its own and counted against each transaction,
+    which is retried by the next scheduled run until MAX_GL_POSTING_ATTEMPTS is reached
+    and it is marked Failed.
+    """
+    frappe.db.savepoint(JOURNAL_ENTRY_SAVEPOINT)
+
+    try:
+        post_journal_entry(transactions)
+
+    except Exception:
+        frappe.db.rollback(save_point=JOURNAL_ENTRY_SAVEPOINT)
+        app_logger.exception(
+            "Failed to post the Journal Entry for B2C Payments Transactions: %s",
+            ", ".join(transaction.name for transaction in transactions),
+        )
+        record_posting_failure(
+            [transaction.name for transaction in transactions], frappe.get_traceback()
+        )
+        return False
+
+    return True
+
+
+def record_posting_failure(transaction_names: list[str], error: str) -> None:
+    """Counts a failed posting attempt, marking transactions out of attempts Failed"""
+    transaction = frappe.qb.DocType(MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE)
+    attempts = Coalesce(transaction.gl_posting_attempts, 0) + 1
+
+    (
+        frappe.qb.update(transaction)
+        # Status is set first so it is computed from the attempts made before this one
+        .set(
+            transaction.gl_posting_status,
+            Case()
+            .when(attempts >= MAX_GL_POSTING_ATTEMPTS, "Failed")
+            .else_("Pending"),
+        )
+        .set(transaction.gl_posting_attempts, attempts)
+        .set(transaction.gl_posting_error, error)
+        .where(transaction.name.isin(transaction_names))
+    ).run()
+
+
+@frappe.whitelist(methods="POST")
+def retry_journal_entry_posting(name: str) -> None:
+    """Queues a transaction whose Journal Entry posting Failed to be posted again"""
+    transaction = frappe.get_doc(MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE, name)
+    transaction.check_permission("write")
+
+    if transaction.gl_posting_status != "Failed":
+        return
+
+    transaction.db_set(
+        {"gl_posting_status": "Pending", "gl_posting_attempts": 0},
+        update_modified=False,
+    )
+    frappe.enqueue(
+        "navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions.post_transaction_journal_entry",
+        queue="short",
+        job_id=f"mpesa_b2c_gl_posting::{name}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        transaction_name=name,
+    )
+
+
+def get_pending_transactions(transaction_names: list[str] | None = None) -> list[dict]:
+    """
+    Returns the transactions awaiting their Journal Entry, oldest first.
+    If transaction_names are given, only those still Pending are returned and
+    they stay locked until commit, so no two workers post the same transaction.
+    """
+    transaction = frappe.qb.DocType(MPESA_B2C_PAYMENTS_TRANSACTIONS_DOCTYPE)
+    payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE)
+
+    query = (
+        frappe.qb.from_(transaction)
+        .join(payment)
+        .on(payment.name == transaction.b2c_payment_name)
+        .select(
+            transaction.name,
+            transaction.transaction_amount,
+            transaction.account_paid_from,
+            transaction.account_paid_to,
+            transaction.creation,
+            payment.name.as_("b2c_payment"),
+            payment.bulk_payment,
+            payment.party_type,
+            payment.party,
+        )
+        .where(transaction.gl_posting_status == "Pending")
+        .orderby(transaction.creation)
+    )
+
+    if transaction_names is not None:
+        query = query.where(transaction.name.isin(transaction_names)).for_update()
+
+    return query.run(as_dict=True)
+
+
+def get_bulk_payments_awaiting_results(bulk_payments: list[str]) -> set[str]:
+    """Returns those of the bulk payments with item payments still awaiting a result"""
+    if not bulk_payments:
+        return set()
+
+    return set(
+        frappe.get_all(
+            MPESA_B2C_PAYMENT_DOCTYPE,
+            filters={
+                "bulk_payment": ["in", bulk_payments],
+                "status": ["in", ["Not Initiated", "Sending", "Pending"]],
+            },
+            pluck="bulk_payment",
+            distinct=True,
+        )
+    )
@@ -3,12 +3,17 @@
 
 import datetime
 import random
+from unittest.mock import MagicMock, patch
 from uuid import uuid4
 
 import frappe
 from frappe.tests.utils import FrappeTestCase
 
 from ..custom_exceptions import InformationMismatchError
+from ..mpesa_b2c_payments_transactions import mpesa_b2c_payments_transactions
+from ..mpesa_b2c_payments_transactions.mpesa_b2c_payments_transactions import (
+    B2C_PAYMENT_FIELDS,
+)
 
 ORIGINATOR_CONVERSATION_ID = str(uuid4())
 ORIGINATOR_CONVERSATION_ID_2 = str(uuid4())
@@ -66,22 +71,28 @@ def create_b2c_payment_transaction() -> None:
         }
     ).insert()
 
-    frappe.get_doc(
-        {
-            "doctype": "MPesa B2C Payments Transactions",
-            "b2c_payment_name": doc.name,
-            "transaction_id": random.randint(100000000, 100000000000),
-            "transaction_amount": 10,
-            "receiver_public_name": "Jane Doe",
-            "recipient_is_registered_customer": "Y",
-            "charges_paid_acct_avlbl_funds": 100,
-            "working_acct_avlbl_funds": 1000000,
-            "utility_acct_avlbl_funds": 10000000,
-            "transaction_completed_datetime": datetime.datetime.now(),
-            "account_paid_from": EXPENSE_ACCOUNT,
-            "account_paid_to": INCOME_ACCOUNT,
-        }
-    ).insert()
+    with patch.object(mpesa_b2c_payments_transactions.frappe, "enqueue") as enqueue:
+        transaction = frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Payments Transactions",
+                "b2c_payment_name": doc.name,
+                "transaction_id": random.randint(100000000, 100000000000),
+                "transaction_amount": 10,
+                "receiver_public_name": "Jane Doe",
+                "recipient_is_registered_customer": "Y",
+                "charges_paid_acct_avlbl_funds": 100,
+                "working_acct_avlbl_funds": 1000000,
+                "utility_acct_avlbl_funds": 10000000,
+                "transaction_completed_datetime": datetime.datetime.now(),
+                "account_paid_from": EXPENSE_ACCOUNT,
+                "account_paid_to": INCOME_ACCOUNT,
+            }
+        ).insert()
+
+    # Run the queued journal entry posting job in the test's transaction
+    enqueue.assert_called_once()
+    assert enqueue.call_args.kwargs["transaction_name"] == transaction.name
+    mpesa_b2c_payments_transactions.post_transaction_journal_entry(transaction.name)
 
     frappe.flags.test_events_created = True
 
@@ -161,6 +172,46 @@ class TestMPesaB2CPaymentsTransactions(FrappeTestCase):
                 }
             ).insert()
 
+    def test_preloaded_b2c_payment_not_fetched_again(self) -> None:
+        """Tests a transaction given its loaded B2C Payment does not query it again"""
+        payment = frappe.db.get_value(
+            "MPesa B2C Payment",
+            {"originatorconversationid": ORIGINATOR_CONVERSATION_ID},
+            B2C_PAYMENT_FIELDS,
+            as_dict=True,
+        )
+        transaction = frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Payments Transactions",
+                "b2c_payment_name": payment.name,
+                "transaction_id": random.randint(100000000, 100000000000),
+                "transaction_amount": 10,
+                "receiver_public_name": "Jane Doe",
+                "recipient_is_registered_customer": "Y",
+                "charges_paid_acct_avlbl_funds": 100,
+                "working_acct_avlbl_funds": 1000000,
+                "utility_acct_avlbl_funds": 10000000,
+                "transaction_completed_datetime": datetime.datetime.now(),
+                "account_paid_from": EXPENSE_ACCOUNT,
+                "account_paid_to": INCOME_ACCOUNT,
+            }
+        )
+        transaction.flags.b2c_payment = payment
+
+        with patch.object(
+            frappe.db, "get_value", wraps=frappe.db.get_value
+        ) as mock_get_value:
+            transaction.insert()
+
+        payment_field_reads = [
+            call
+            for call in mock_get_value.call_args_list
+            if B2C_PAYMENT_FIELDS in call.args
+            or B2C_PAYMENT_FIELDS in call.kwargs.values()
+        ]
+        self.assertEqual(payment_field_reads, [])
+        self.assertEqual(transaction.fetched_b2c_payment, payment)
+
     def test_journal_entry_created_after_successful_payments_transaction(self) -> None:
         """Tests journal entries are created after successful payments"""
         journal_entries = frappe.db.sql(
@@ -174,3 +225,123 @@ class TestMPesaB2CPaymentsTransactions(FrappeTestCase):
         self.assertGreaterEqual(len(journal_entries), 1)
         self.assertIsInstance(journal_entries, list)
         self.assertIsInstance(journal_entries[0], dict)
+
+    def test_journal_entry_posted_per_batch(self) -> None:
+        """Tests Pending transactions are posted in a single Journal Entry per batch"""
+        b2c_settings = MagicMock(
+            journal_entry_posting_mode="Per Batch", journal_entry_posting_window=15
+        )
+        transactions = []
+
+        with patch.object(
+            mpesa_b2c_payments_transactions,
+            "get_b2c_settings_snapshot",
+            return_value=b2c_settings,
+        ):
+            for _ in range(2):
+                payment = frappe.get_doc(
+                    {
+                        "doctype": "MPesa B2C Payment",
+                        "commandid": "SalaryPayment",
+                        "remarks": "test remarks",
+                        "status": "Paid",
+                        "partyb": "254712345678",
+                        "amount": 10,
+                        "occassion": "Testing",
+                        "party_type": "Employee",
+                        "account_paid_from": EXPENSE_ACCOUNT,
+                        "account_paid_to": INCOME_ACCOUNT,
+                    }
+                ).insert()
+                transaction = frappe.get_doc(
+                    {
+                        "doctype": "MPesa B2C Payments Transactions",
+                        "b2c_payment_name": payment.name,
+                        "transaction_id": random.randint(100000000, 100000000000),
+                        "transaction_amount": 10,
+                        "receiver_public_name": "Jane Doe",
+                        "recipient_is_registered_customer": "Y",
+                        "charges_paid_acct_avlbl_funds": 100,
+                        "working_acct_avlbl_funds": 1000000,
+                        "utility_acct_avlbl_funds": 10000000,
+                        "transaction_completed_datetime": datetime.datetime.now(),
+                        "account_paid_from": EXPENSE_ACCOUNT,
+                        "account_paid_to": INCOME_ACCOUNT,
+                    }
+                ).insert()
+                transactions.append(transaction.name)
+
+                # Past the posting window
+                transaction.db_set(
+                    "creation", datetime.datetime.now() - datetime.timedelta(hours=1)
+                )
+
+            self.assertEqual(
+                frappe.db.get_value(
+                    "MPesa B2C Payments Transactions",
+                    transactions[0],
+                    "gl_posting_status",
+                ),
+                "Pending",
+            )
+
+            with patch.object(mpesa_b2c_payments_transactions.frappe.db, "commit"):
+                mpesa_b2c_payments_transactions.post_pending_journal_entries()
+
+        posted = frappe.get_all(
+            "MPesa B2C Payments Transactions",
+            filters={"name": ["in", transactions]},
+            fields=["gl_posting_status", "journal_entry"],
+        )
+        self.assertEqual({row.gl_posting_status for row in posted}, {"Posted"})
+        self.assertEqual(len({row.journal_entry for row in posted}), 1)
+
+        journal_entry = frappe.get_doc("Journal Entry", posted[0].journal_entry)
+        self.assertEqual(len(journal_entry.accounts), 3)
+        self.assertEqual(journal_entry.accounts[0].credit_in_account_currency, 20)
+
+    def test_failed_journal_entry_posting_retried(self) -> None:
+        """Tests failed postings stay Pending for retry until out of attempts"""
+        transaction_name = frappe.get_all(
+            "MPesa B2C Payments Transactions",
+            filters={"gl_posting_status": "Posted"},
+            pluck="name",
+            limit=1,
+        )[0]
+        frappe.db.set_value(
+            "MPesa B2C Payments Transactions",
+            transaction_name,
+            {"gl_posting_status": "Pending", "journal_entry": None},
+        )
+
+        with patch.object(
+            mpesa_b2c_payments_transactions,
+            "post_journal_entry",
+            side_effect=frappe.ValidationError("Accounting period closed"),
+        ):
+            mpesa_b2c_payments_transactions.post_transaction_journal_entry(
+                transaction_name
+            )
+            transaction = frappe.get_doc(
+                "MPesa B2C Payments Transactions", transaction_name
+            )
+            self.assertEqual(transaction.gl_posting_status, "Pending")
+            self.assertEqual(transaction.gl_posting_attempts, 1)
+            self.assertIn("Accounting period closed", transaction.gl_posting_error)
+
+            transaction.db_set(
+                "gl_posting_attempts",
+                mpesa_b2c_payments_transactions.MAX_GL_POSTING_ATTEMPTS - 1,
+            )
+            mpesa_b2c_payments_transactions.post_transaction_journal_entry(
+                transaction_name
+            )
+
+        self.assertEqual(
+            frappe.db.get_value(
+                "MPesa B2C Payments Transactions",
+                transaction_name,
+                "gl_posting_status",
+            ),
+            "Failed",
+        )
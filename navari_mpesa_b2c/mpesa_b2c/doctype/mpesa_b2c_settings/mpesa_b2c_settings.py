@@ -2,8 +2,13 @@
 # For license information, please see license.txt
 
 import re
+from dataclasses import dataclass
+from typing import Any, Final
 
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, flt
+from frappe.utils.password import get_decrypted_password
 
 from ..custom_exceptions import InvalidURLError
 
@@ -12,6 +17,9 @@ from ..custom_exceptions import (
     InvalidAuthenticationCertificateFileError,
 )
 
+MPESA_B2C_SETTINGS_DOCTYPE: Final[str] = "MPesa B2C Settings"
+SETTINGS_VERSION_KEY: Final[str] = "navari_mpesa_b2c:settings_version"
+
 
 class MPesaB2CSettings(Document):
     """MPesa B2C Settings Doctype"""
@@ -45,6 +53,153 @@ class MPesaB2CSettings(Document):
                 app_logger.error(self.errors)
                 raise InvalidAuthenticationCertificateFileError(self.errors)
 
+    def on_update(self) -> None:
+        """Drop the settings snapshots cached by every worker"""
+        invalidate_b2c_settings_snapshot()
+
+
+@dataclass(frozen=True)
+class B2CSettingsSnapshot:
+    """
+    An immutable copy of the MPesa B2C Settings, with the secrets already decrypted.
+    Supports both attribute and dict-style (get) access.
+    """
+
+    version: str
+    consumer_key: str
+    consumer_secret: str
+    initiator_name: str
+    initiator_password: str
+    organisation_shortcode: str
+    authorization_url: str
+    payment_url: str
+    results_url: str
+    queue_timeout_url: str
+    transaction_status_url: str
+    transaction_status_results_url: str
+    certificate_file: str
+    token_refresh_margin: int
+    connect_timeout: float
+    read_timeout: float
+    max_concurrent_requests: int
+    bulk_chunk_size: int
+    funds_check_mode: str
+    rate_limit_tps: float
+    rate_limit_burst: int
+    callback_batch_size: int
+    callback_flush_interval: float
+    journal_entry_posting_mode: str
+    journal_entry_posting_window: int
+    max_retry_attempts: int
+    retry_base_delay: int
+    status_query_after: int
+    access_token_retention_count: int
+    access_token_retention_hours: int
+
+    def get(self, field: str, default: Any = None) -> Any:
+        """Returns the value of the setting named field"""
+        return getattr(self, field, default)
+
+
+_settings_snapshots: dict[str, B2CSettingsSnapshot] = {}
+
+
+def get_b2c_settings_snapshot() -> B2CSettingsSnapshot:
+    """
+    Returns this worker's snapshot of the MPesa B2C Settings.
+    The snapshot is reloaded only when the site-wide settings version,
+    bumped whenever the settings are saved, no longer matches it.
+    """
+    version = get_settings_version()
+    snapshot = _settings_snapshots.get(frappe.local.site)
+
+    if snapshot is None or snapshot.version != version:
+        snapshot = load_b2c_settings_snapshot(version)
+        _settings_snapshots[frappe.local.site] = snapshot
+
+    return snapshot
+
+
+def load_b2c_settings_snapshot(version: str) -> B2CSettingsSnapshot:
+    """Reads the MPesa B2C Settings and decrypts its secrets"""
+    settings = frappe.db.get_singles_dict(MPESA_B2C_SETTINGS_DOCTYPE)
+
+    return B2CSettingsSnapshot(
+        version=version,
+        consumer_key=settings.get("consumer_key"),
+        consumer_secret=get_decrypted_password(
+            MPESA_B2C_SETTINGS_DOCTYPE,
+            MPESA_B2C_SETTINGS_DOCTYPE,
+            "consumer_secret",
+            raise_exception=False,
+        ),
+        initiator_name=settings.get("initiator_name"),
+        initiator_password=get_decrypted_password(
+            MPESA_B2C_SETTINGS_DOCTYPE,
+            MPESA_B2C_SETTINGS_DOCTYPE,
+            "initiator_password",
+            raise_exception=False,
+        ),
+        organisation_shortcode=settings.get("organisation_shortcode"),
+        authorization_url=settings.get("authorization_url"),
+        payment_url=settings.get("payment_url"),
+        results_url=settings.get("results_url"),
+        queue_timeout_url=settings.get("queue_timeout_url"),
+        transaction_status_url=settings.get("transaction_status_url"),
+        transaction_status_results_url=settings.get("transaction_status_results_url"),
+        certificate_file=settings.get("certificate_file"),
+        token_refresh_margin=cint(settings.get("token_refresh_margin")),
+        connect_timeout=flt(settings.get("connect_timeout")),
+        read_timeout=flt(settings.get("read_timeout")),
+        max_concurrent_requests=cint(settings.get("max_concurrent_requests")),
+        bulk_chunk_size=cint(settings.get("bulk_chunk_size")),
+        funds_check_mode=settings.get("funds_check_mode"),
+        rate_limit_tps=flt(settings.get("rate_limit_tps")),
+        rate_limit_burst=cint(settings.get("rate_limit_burst")),
+        callback_batch_size=cint(settings.get("callback_batch_size")),
+        callback_flush_interval=flt(settings.get("callback_flush_interval")),
+        journal_entry_posting_mode=settings.get("journal_entry_posting_mode"),
+        journal_entry_posting_window=cint(settings.get("journal_entry_posting_window")),
+        max_retry_attempts=cint(settings.get("max_retry_attempts")),
+        retry_base_delay=cint(settings.get("retry_base_delay")),
+        status_query_after=cint(settings.get("status_query_after")),
+        access_token_retention_count=cint(
+            settings.get("access_token_retention_count")
+        ),
+        access_token_retention_hours=cint(
+            settings.get("access_token_retention_hours")
+        ),
+    )
+
+
+def get_settings_version() -> str:
+    """Returns the site-wide settings version, initialising it if missing"""
+    cache = frappe.cache()
+    key = cache.make_key(SETTINGS_VERSION_KEY)
+
+    version = cache.get(key)
+    if version is None:
+        cache.set(key, frappe.generate_hash(length=12), nx=True)
+        version = cache.get(key)
+
+    return version.decode()
+
+
+def invalidate_b2c_settings_snapshot() -> None:
+    """
+    Bumps the settings version so every worker reloads its snapshot.
+    The version is bumped again after commit so no worker caches
+    settings read before the change was committed.
+    """
+    _settings_snapshots.pop(frappe.local.site, None)
+    _bump_settings_version()
+    frappe.db.after_commit.add(_bump_settings_version)
+
+
+def _bump_settings_version() -> None:
+    cache = frappe.cache()
+    cache.set(cache.make_key(SETTINGS_VERSION_KEY), frappe.generate_hash(length=12))
+
 
 def validate_url(url: str) -> bool:
     """
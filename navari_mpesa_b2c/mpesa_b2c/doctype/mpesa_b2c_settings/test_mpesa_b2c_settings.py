@@ -4,8 +4,8 @@
 import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from ..mpesa_b2c_settings.mpesa_b2c_settings import get_b2c_settings_snapshot
 from ..mpesa_b2c_payment.mpesa_b2c_payment import (
-    get_b2c_settings,
     get_certificate_file,
     generate_payload,
 )
@@ -148,16 +148,15 @@ class TestMPesaB2CSettings(FrappeTestCase):
                 }
             ).insert()
 
-    def test_get_b2c_settings_function(self) -> None:
-        """Tests the get_b2c_settings() function from the b2c payment module"""
-        b2c_settings = frappe.db.get_singles_dict("MPesa B2C Settings")
-        consumer_key, consumer_secret, authorization_url = get_b2c_settings(
-            b2c_settings
-        )
+    def test_authorization_settings_snapshot(self) -> None:
+        """Tests the authorization settings are read into the settings snapshot"""
+        b2c_settings = get_b2c_settings_snapshot()
 
-        self.assertEqual(consumer_key, "1234567890")
-        self.assertEqual(authorization_url, "https://example.com/api/method/handler")
-        self.assertEqual(consumer_secret, "secret")
+        self.assertEqual(b2c_settings.consumer_key, "1234567890")
+        self.assertEqual(
+            b2c_settings.authorization_url, "https://example.com/api/method/handler"
+        )
+        self.assertEqual(b2c_settings.consumer_secret, "secret")
 
     def test_get_certificate_file_function_valid(self) -> None:
         """Tests the get_certificate_file() function from the b2c payment module"""
@@ -222,3 +221,32 @@ class TestMPesaB2CSettings(FrappeTestCase):
             '"QueueTimeOutURL": "https://example.com/api/method/handler"' in payload
         )
         self.assertTrue('"InitiatorName": "tester"' in payload)
+
+    def test_settings_snapshot_reloaded_after_update(self) -> None:
+        """Tests the cached settings snapshot is replaced once the settings are saved"""
+        snapshot = get_b2c_settings_snapshot()
+
+        self.assertIs(get_b2c_settings_snapshot(), snapshot)
+        self.assertEqual(snapshot.consumer_secret, snapshot.get("consumer_secret"))
+
+        frappe.get_doc(
+            {
+                "doctype": "MPesa B2C Settings",
+                "consumer_key": "1234567890",
+                "initiator_name": "snapshot tester",
+                "results_url": "https://example.com/api/method/handler",
+                "authorization_url": "https://example.com/api/method/handler",
+                "organisation_shortcode": "951753",
+                "consumer_secret": "snapshot-secret",
+                "initiator_password": "snapshot-password",
+                "queue_timeout_url": "https://example.com/api/method/handler",
+                "payment_url": "https://example.com/api/method/handler",
+            }
+        ).insert(ignore_mandatory=True)
+
+        new_snapshot = get_b2c_settings_snapshot()
+
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertEqual(new_snapshot.initiator_name, "snapshot tester")
+        self.assertEqual(new_snapshot.consumer_secret, "snapshot-secret")
+        self.assertEqual(new_snapshot.initiator_password, "snapshot-password")
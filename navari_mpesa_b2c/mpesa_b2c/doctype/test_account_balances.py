@@ -0,0 +1,52 @@
+# Copyright (c) 2026, Navari Limited and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from . import account_balances
+
+
+class TestAccountBalances(FrappeTestCase):
+    """Account balance time series tests"""
+
+    def test_account_balances(self) -> None:
+        """Tests the newest balances are kept as latest, and history is downsampled"""
+        shortcode = "test-balances"
+        self.addCleanup(
+            frappe.cache().delete, *account_balances.get_balance_keys(shortcode)
+        )
+
+        account_balances.record_balances(
+            [
+                {
+                    "transaction_completed_datetime": "2023-11-07 11:45:50.000",
+                    "working_acct_avlbl_funds": 900,
+                    "utility_acct_avlbl_funds": 100,
+                },
+                # Arrives after, but was completed before, the Result above
+                {
+                    "transaction_completed_datetime": "2023-11-07 11:15:00.000",
+                    "working_acct_avlbl_funds": 1000,
+                    "utility_acct_avlbl_funds": 100,
+                },
+                {
+                    "transaction_completed_datetime": "2023-11-07 12:05:00.000",
+                    "working_acct_avlbl_funds": 800,
+                    "utility_acct_avlbl_funds": 100,
+                },
+            ],
+            shortcode,
+        )
+
+        latest = account_balances.read_latest_balance(shortcode)
+        self.assertEqual(latest["working"], 800)
+        self.assertIsNone(latest["charges_paid"])
+
+        history = account_balances.get_balance_history(
+            "2023-11-07 11:00:00", "2023-11-07 13:00:00", 3600, shortcode
+        )
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history[0]["working"], 900)
+        self.assertEqual(history[0]["min_working"], 900)
+        self.assertEqual(history[1]["working"], 800)
@@ -0,0 +1,8 @@
+from navari_mpesa_b2c.mpesa_b2c.doctype.mpesa_b2c_payment.payment_items import (
+    add_selection_indexes,
+)
+
+
+def execute() -> None:
+    """Index the selection of the records B2C Payments are made against"""
+    add_selection_indexes()
@@ -0,0 +1,42 @@
+from uuid import uuid4
+
+import frappe
+from frappe.query_builder.functions import Count
+
+MPESA_B2C_PAYMENT_DOCTYPE = "MPesa B2C Payment"
+
+
+def execute() -> None:
+    """
+    Give B2C Payments sharing an OriginatorConversationID new ones, before the
+    field is made unique. The earliest payment keeps the ID its Results report.
+    """
+    if not frappe.db.table_exists(MPESA_B2C_PAYMENT_DOCTYPE):
+        return
+
+    payment = frappe.qb.DocType(MPESA_B2C_PAYMENT_DOCTYPE)
+    duplicate_ids = (
+        frappe.qb.from_(payment)
+        .select(payment.originatorconversationid)
+        .where(payment.originatorconversationid.isnotnull())
+        .groupby(payment.originatorconversationid)
+        .having(Count("*") > 1)
+    ).run(pluck=True)
+
+    for originator_conversation_id in duplicate_ids:
+        names = frappe.get_all(
+            MPESA_B2C_PAYMENT_DOCTYPE,
+            filters={"originatorconversationid": originator_conversation_id},
+            pluck="name",
+            order_by="creation",
+        )
+
+        # Blank IDs were never sent, so none of them is kept
+        for name in names[1:] if originator_conversation_id else names:
+            frappe.db.set_value(
+                MPESA_B2C_PAYMENT_DOCTYPE,
+                name,
+                "originatorconversationid",
+                str(uuid4()),
+                update_modified=False,
+            )